@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+###############
+# @file friendsoffriends.py
+#
+# @brief Links catalog objects into friends-of-friends groups
+###############
+'''
+Friends-of-friends grouping of catalog objects.
+
+Two objects are friends if they lie within the linking length of each
+other, and a group is every object that can be reached from another
+through a chain of friends: the connected components of the friendship
+graph. The friends are found with the radius queries of matching.py, a
+block of objects at a time, and merged with a UnionFind over array rows,
+so that millions of objects are grouped with whole-array operations:
+
+        groups = friendsOfFriends(cat, 2.0)     # SkyCatalog: 2 arcsec
+        groups[i]                               # group of row i
+        (offsets, rows) = groupMembers(groups)  # rows of group g are
+                                                # rows[offsets[g]:offsets[g+1]]
+
+        groups = friendsOfFriends(pos, 0.1, minMembers = 5)
+
+Groups are numbered from 0 in order of their first row. Groups with
+fewer than minMembers objects (isolated objects, by default none) get
+group -1. pos may be an (n, ndim) array or a Catalog; for a SkyCatalog
+the linking length is in arcsec, and friends are linked on the sphere.
+'''
+
+import numpy
+
+import matching
+
+###############################
+
+class UnionFind(object):
+    '''Disjoint sets of the rows 0..n-1, merged a whole array of pairs
+       at a time. Each set is represented by its smallest row.'''
+
+    def __init__(self, n):
+
+        self.parent = numpy.arange(n)
+
+    ###################
+
+    def __len__(self):
+        return len(self.parent)
+
+    ###################
+
+    def _compress(self):
+        '''Points every row straight at its representative.'''
+
+        parent = self.parent
+        while True:
+            grand = parent[parent]
+            if (grand == parent).all():
+                break
+            parent = grand
+        self.parent = parent
+
+    ###################
+
+    def find(self, rows = None):
+        '''Representatives of rows (of all rows, if None).'''
+
+        self._compress()
+        if rows is None:
+            return self.parent.copy()
+        return self.parent[numpy.asarray(rows, dtype = numpy.intp)]
+
+    ###################
+
+    def union(self, a, b):
+        '''Merges the set of a[i] with that of b[i], for every i.'''
+
+        a = numpy.asarray(a, dtype = numpy.intp)
+        b = numpy.asarray(b, dtype = numpy.intp)
+        if a.shape != b.shape:
+            raise ValueError, "Give as many rows to a as to b"
+
+        # each round hooks every representative that is the larger of a
+        # pair onto the smallest representative it is paired with, so
+        # representatives only ever point at smaller rows
+        while len(a) > 0:
+            self._compress()
+            ra = self.parent[a]
+            rb = self.parent[b]
+            apart = ra != rb
+            (a, b, ra, rb) = (a[apart], b[apart], ra[apart], rb[apart])
+            high = numpy.maximum(ra, rb)
+            low = numpy.minimum(ra, rb)
+            # with repeated indices the last assignment wins
+            order = numpy.argsort(low)[::-1]
+            self.parent[high[order]] = low[order]
+
+    ###################
+
+    def groups(self):
+        '''Group number of every row, numbering the sets from 0 in order
+           of their smallest row.'''
+
+        roots = self.find()
+        isRoot = roots == numpy.arange(len(roots))
+        number = numpy.cumsum(isRoot) - 1
+        return number[roots]
+
+################################
+
+def _linkSetup(pos, linkingLength):
+    '''(positions, radius, sky ra/dec or None) to link with.'''
+
+    if isinstance(pos, matching.SkyCatalog):
+        return (pos.pos, None, (pos.ra, pos.dec))
+    if isinstance(pos, matching.Catalog):
+        return (pos.pos, linkingLength, None)
+    pos = numpy.asarray(pos, dtype = numpy.float64)
+    if pos.ndim != 2:
+        raise ValueError, "Positions must be an (n, ndim) array"
+    return (pos, linkingLength, None)
+
+def friendsOfFriends(pos, linkingLength, engine = 'grid', minMembers = 1,
+                     blockRows = 10**6, workers = None):
+    '''Friends-of-friends group number of each of pos, an (n, ndim) array,
+       Catalog or SkyCatalog (linkingLength in arcsec), or -1 for objects
+       in groups of fewer than minMembers. Friends are found blockRows
+       objects at a time, with an index of the given engine; workers is
+       as for matching's radius queries.'''
+
+    if not linkingLength > 0:
+        raise ValueError, "linkingLength must be positive"
+    (positions, radius, sky) = _linkSetup(pos, linkingLength)
+    n = len(positions)
+
+    if sky is None:
+        index = matching.buildIndex(positions, radius, engine)
+    else:
+        index = matching.SkyIndex(sky[0], sky[1], linkingLength, engine)
+
+    sets = UnionFind(n)
+    for start in range(0, n, blockRows):
+        stop = min(start + blockRows, n)
+        if sky is None:
+            (offsets, friends) = index.query_radius(positions[start:stop],
+                                                    radius,
+                                                    workers = workers)
+        else:
+            (offsets, friends) = index.query_radius(sky[0][start:stop],
+                                                    sky[1][start:stop],
+                                                    linkingLength,
+                                                    workers = workers)
+        rows = numpy.repeat(numpy.arange(start, stop), numpy.diff(offsets))
+        # each pair is found from both ends; one is enough
+        later = friends > rows
+        sets.union(rows[later], friends[later])
+
+    groups = sets.groups()
+    if minMembers > 1:
+        small = numpy.bincount(groups, minlength = 1) < minMembers
+        kept = numpy.cumsum(~small) - 1
+        groups = numpy.where(small[groups], -1, kept[groups])
+    return groups
+
+################################
+
+def groupMembers(groups):
+    '''Rows of each group, CSR style: those of group g are
+       rows[offsets[g]:offsets[g+1]], in increasing order. Rows of group
+       -1 are left out.'''
+
+    groups = numpy.asarray(groups)
+    rows = numpy.nonzero(groups >= 0)[0]
+    rows = rows[numpy.argsort(groups[rows], kind = 'mergesort')]
+    counts = numpy.bincount(groups[rows], minlength = 0)
+    offsets = numpy.zeros(len(counts) + 1, dtype = numpy.intp)
+    numpy.cumsum(counts, out = offsets[1:])
+    return (offsets, rows)
+
+
+###############################
+# TESTING
+###############################
+
+import unittest
+
+def _bruteGroups(pos, linkingLength):
+    '''Reference answer: groups found by walking the friends of each
+       object in turn.'''
+    n = len(pos)
+    groups = -numpy.ones(n, dtype = int)
+    ngroups = 0
+    for seed in range(n):
+        if groups[seed] >= 0:
+            continue
+        groups[seed] = ngroups
+        stack = [seed]
+        while stack:
+            i = stack.pop()
+            d = numpy.sqrt(((pos - pos[i])**2).sum(axis = 1))
+            for j in numpy.nonzero((d <= linkingLength) & (groups < 0))[0]:
+                groups[j] = ngroups
+                stack.append(j)
+        ngroups += 1
+    return groups
+
+###########
+
+class TestUnionFind(unittest.TestCase):
+
+    def testUnion(self):
+        sets = UnionFind(8)
+        sets.union([7, 5], [6, 7])
+        sets.union([], [])
+        sets.union([2, 6, 1], [3, 2, 1])
+        self.assertEqual([0, 1, 2, 2, 4, 2, 2, 2], sets.find().tolist())
+        self.assertEqual([0, 1, 2, 2, 3, 2, 2, 2], sets.groups().tolist())
+        self.assertEqual([2, 4], sets.find([7, 4]).tolist())
+        self.assertRaises(ValueError, lambda: sets.union([1], [2, 3]))
+
+    def testLongChain(self):
+        # a chain joined from the far end in shuffled order
+        rand = numpy.random.RandomState(12)
+        n = 10000
+        order = rand.permutation(n - 1)
+        sets = UnionFind(n)
+        sets.union(order + 1, order)
+        self.failUnless((sets.find() == 0).all())
+
+###########
+
+class TestFriendsOfFriends(unittest.TestCase):
+
+    def setUp(self):
+        # clumps, and objects scattered between them
+        rand = numpy.random.RandomState(13)
+        centres = rand.uniform(0, 20, size = (30, 2))
+        clumps = (centres[:, None, :] +
+                  rand.normal(scale = 0.2, size = (30, 20, 2))).reshape(-1, 2)
+        self.pos = numpy.concatenate([clumps,
+                                      rand.uniform(0, 20, size = (400, 2))])
+
+    def testMatchesBruteForce(self):
+        expected = _bruteGroups(self.pos, 0.3)
+        for engine in ('grid', 'kdtree'):
+            groups = friendsOfFriends(self.pos, 0.3, engine = engine,
+                                      blockRows = 97)
+            self.assertEqual(expected.tolist(), groups.tolist())
+
+    def testChain(self):
+        x = numpy.arange(50) * 0.9
+        pos = numpy.transpose([x, numpy.zeros(50)])
+        self.assertEqual([0] * 50, friendsOfFriends(pos, 1.).tolist())
+        self.assertEqual(range(50), friendsOfFriends(pos, 0.8).tolist())
+
+    def testMinMembersAndMembers(self):
+        groups = friendsOfFriends(self.pos, 0.3)
+        big = friendsOfFriends(self.pos, 0.3, minMembers = 5)
+        sizes = numpy.bincount(groups)
+        self.assertEqual((sizes[groups] < 5).tolist(), (big < 0).tolist())
+        self.assertEqual(range(big.max() + 1), numpy.unique(big[big >= 0])
+                         .tolist())
+
+        (offsets, rows) = groupMembers(big)
+        self.assertEqual(big.max() + 1, len(offsets) - 1)
+        for g in range(len(offsets) - 1):
+            members = rows[offsets[g]:offsets[g+1]]
+            self.assertEqual(numpy.nonzero(big == g)[0].tolist(),
+                             members.tolist())
+
+    def testCatalogs(self):
+        cat = matching.Catalog(self.pos[:,0], self.pos[:,1],
+                               numpy.arange(len(self.pos)))
+        self.assertEqual(_bruteGroups(self.pos, 0.3).tolist(),
+                         friendsOfFriends(cat, 0.3).tolist())
+
+        # a pair across RA = 0 and a pair across the pole
+        sky = matching.SkyCatalog([359.9999, 0.0001, 10., 190., 50.],
+                                  [0., 0., 89.9999, 89.9999, 45.],
+                                  numpy.arange(5))
+        self.assertEqual([0, 0, 1, 1, 2],
+                         friendsOfFriends(sky, 1.).tolist())
+        self.assertEqual([0, 0, 1, 1, -1],
+                         friendsOfFriends(sky, 1., minMembers = 2).tolist())
+
+    def testEmpty(self):
+        self.assertEqual([], friendsOfFriends(numpy.zeros((0, 2)),
+                                              1.).tolist())
+        self.assertRaises(ValueError,
+                          lambda: friendsOfFriends(self.pos, 0.))
+
+
+###########
+
+if __name__ == '__main__':
+    suites = []
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(TestUnionFind))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase( \
+            TestFriendsOfFriends))
+    unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(suites))
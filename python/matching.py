@@ -1,9 +1,136 @@
 #################
 # utility functions
 ###############
+'''
+Positional matching of catalogs.
 
-from math import sqrt
-from numpy import *
+A KDTree indexes an (n, ndim) array of positions. It is stored as flat
+numpy arrays rather than as node objects: the positions are reordered so
+that every node of a balanced binary tree covers a contiguous run of
+them, node i has children 2i+1 and 2i+2, and every leaf sits at the same
+depth. Queries are made for many points at once, walking the tree one
+level at a time with whole arrays of (point, node) pairs:
+
+        tree = KDTree(cat2.pos)
+        (offsets, indices) = tree.query_radius(cat1.pos, 0.5)
+        # the rows of cat2 within 0.5 of cat1.pos[i] are
+        # indices[offsets[i]:offsets[i+1]], in increasing order
+
+        matches = matchCatalogs(cat1, cat2, 0.5)
+
+For a fixed, small matching radius a GridIndex is usually faster: the
+positions are binned into square cells of side cellSize, sorted by cell,
+and a query only looks in the cells around each point (the 3x3 block
+when r <= cellSize). Both indices answer the same queries, and
+matchCatalogs takes either:
+
+        grid = GridIndex(cat2.pos, cellSize = 0.5)
+        (offsets, indices) = grid.query_radius(cat1.pos, 0.5)
+
+        matchCatalogs(cat1, cat2, 0.5, engine = 'grid')
+
+matchCatalogs returns a Matches object, which holds the pairs in the
+same compact CSR form, with their distances, rather than as dicts of
+lists:
+
+        matches = matchCatalogs(cat1, cat2, 0.5)
+        matches.neighbors(i)            # rows of cat2 matching cat1 row i
+        (rows1, rows2) = matches.pairs()
+        nearest = matches.best()        # closest cat2 row, or -1
+        (match1, match2) = matches.oneToOne()   # unique pairs, closest
+                                                # first
+        (cat1Index, cat2Index) = matches.toDicts(cat1.id, cat2.id)
+
+Sky positions are matched on the sphere. A SkyCatalog takes RA and Dec in
+degrees and indexes them as 3D unit vectors, so separations are true
+great-circle ones, across RA = 0/360 and at the poles alike; tolerances
+and distances are then in arcsec:
+
+        cat = SkyCatalog(ra, dec, id)
+        matches = matchCatalogs(cat, refcat, 1.5)        # within 1.5"
+
+        sky = SkyIndex(refcat.ra, refcat.dec)
+        (offsets, indices, arcsec) = sky.query_radius(ra, dec, 1.5,
+                                                      return_distance = True)
+
+Catalogs too big for memory can be matched from disk with streamMatch.
+Each catalog is read in chunks, either from imcat text (columns by name
+or number) or from arrays that live on disk, such as .npy files (opened
+memory-mapped), PyTables arrays or pytableshelf ArrayProxies:
+
+        cat1 = TextCatalogReader('deep.cat', ['x'])     # x is 2 columns
+        cat2 = ArrayCatalogReader(['ref_x.npy', 'ref_y.npy'])
+        output = open('matches.txt', 'w')
+        for (rows1, rows2, dist) in streamMatch(cat1, cat2, 0.5):
+            numpy.savetxt(output, numpy.transpose([rows1, rows2, dist]),
+                          fmt = '%d %d %g')
+
+The positions are partitioned on disk into tiles of about tileRows
+objects, catalog 2 with a margin of the tolerance around each tile, and
+the tiles are then matched one at a time; memory use is set by tileRows
+and chunkRows, not by the size of the catalogs. Rows are counted from 0
+in file order. Blocks come out tile by tile, each sorted by rows1 then
+rows2. With sky = True the two columns are RA and Dec in degrees, the
+tiles are cubes in unit-vector space, and tolerance is in arcsec.
+
+Radius queries (and so matchCatalogs) can be spread over several
+processes with workers = n. The index is built once and inherited by
+forked workers without copying; each worker answers whole chunks of the
+(spatially sorted) query points, and the chunks are merged in order, so
+the result is the same whatever the number of workers:
+
+        matches = matchCatalogs(cat1, cat2, 0.5, engine = 'grid',
+                                workers = 8)
+
+Both indices, and SkyIndex, also answer k-nearest-neighbour queries for
+many points at once. Each point gets a radius that should hold at least k
+rows (for a KDTree, the k-th closest row of a nearby node; for a
+GridIndex, a guess from the density of its occupied cells), doubled
+wherever it falls short, and the k closest rows are picked from a radius
+query. With exclude_self = True the points are the indexed positions
+themselves, and row i is not counted as a neighbour of point i:
+
+        (distances, indices) = tree.query_knn(points, 5)
+        # indices[i] are the 5 rows closest to points[i], closest first
+
+        (distances, indices) = tree.query_knn(cat2.pos, 5,
+                                              exclude_self = True)
+
+A built index (KDTree, GridIndex or SkyIndex) can be saved to a flat
+binary file and reopened later without rebuilding it. The arrays are
+memory-mapped read-only, so opening takes milliseconds whatever the size,
+pages are only read when a query touches them, and every process that
+opens the same file shares one copy in the page cache:
+
+        sky = SkyIndex(refcat.ra, refcat.dec, 1.5, engine = 'grid',
+                       ids = refcat.id)
+        sky.save('refcat.idx', source = refcat.pos)
+
+        sky = loadIndex('refcat.idx', source = refcat.pos)
+
+The file starts with a magic string, the format version and a header
+holding the array layout and a CRC32 of each array. loadIndex refuses a
+file written with another format version, a truncated file or a damaged
+header, and with verify = True also checks the arrays against their
+CRCs (which reads the whole file). source, any string or arrays that
+identify what was indexed (the positions, or a catalog file name and
+modification time), is stored as a digest; given again to loadIndex, a
+mismatch means the index is stale and raises ValueError.
+'''
+
+import errno
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import struct
+import tempfile
+import zlib
+import numpy
 
 ###############################
 
@@ -12,8 +139,8 @@ class Catalog(object):
     def __init__(self, x, y, id):
 
         self.nentries = len(x)
-        self.pos = vstack([x,y]).transpose()
-        self.id = id
+        self.pos = numpy.vstack([x,y]).transpose()
+        self.id = numpy.asarray(id)
 
 
     def filter(self, filt):
@@ -25,109 +152,1862 @@ class Catalog(object):
 
 #########################
 
-SPLIT=10
+def unitVectors(ra, dec):
+    '''(n, 3) unit vectors pointing to ra, dec, in degrees.'''
+
+    ra = numpy.radians(numpy.asarray(ra, dtype = numpy.float64))
+    dec = numpy.radians(numpy.asarray(dec, dtype = numpy.float64))
+    cosDec = numpy.cos(dec)
+    return numpy.vstack([cosDec * numpy.cos(ra), cosDec * numpy.sin(ra),
+                         numpy.sin(dec)]).transpose()
+
+def _chord(arcsec):
+    '''Straight-line distance between unit vectors arcsec apart.'''
+    return 2. * numpy.sin(numpy.radians(arcsec / 3600.) / 2.)
+
+def _arcsec(chord):
+    return 3600. * numpy.degrees(2. * numpy.arcsin(numpy.minimum(chord / 2.,
+                                                                 1.)))
+
+###############################
+
+class SkyCatalog(Catalog):
+    '''Catalog of ra, dec in degrees; pos holds their unit vectors.'''
+
+    def __init__(self, ra, dec, id):
+
+        self.ra = numpy.asarray(ra, dtype = numpy.float64)
+        self.dec = numpy.asarray(dec, dtype = numpy.float64)
+        self.nentries = len(self.ra)
+        self.pos = unitVectors(self.ra, self.dec)
+        self.id = numpy.asarray(id)
+
+    def filter(self, filt):
+
+        return SkyCatalog(self.ra[filt], self.dec[filt], self.id[filt])
+
+#########################
+
+SPLIT=16
 
 def buildTrie(cat):
 
-    if len(x) > SPLIT:
-        return Node(cat)
-    else:
-        return Leaf(cat)
+    return KDTree(cat.pos, leafSize = SPLIT, ids = cat.id)
 
 ########################
 
-class Trie(object):
+def _expandRanges(starts, counts):
+    '''Concatenation of arange(start, start + count) for each pair.'''
 
-    def __init__(self, cat):
+    total = counts.sum()
+    if total == 0:
+        return numpy.zeros(0, dtype = numpy.intp)
+    ends = numpy.cumsum(counts)
+    return numpy.repeat(starts - (ends - counts), counts) + \
+        numpy.arange(total)
 
-        self.range = ((min(cat.pos[:,0]), max(cat.pos[:,0])),
-            (min(cat.pos[:,1]), max(cat.pos[:,1])))
+########################
 
-    def findNeighbors(self, coord, within, neighbors = []):
-        
-        for pos, dim in zip(coord, self.range):
-            if (pos + within) < dim[0] or \
-                    (pos - within) > dim[1]:
-                return neighbors
-            return self._findNeighbors(coord, within, neighbors)
-        
-##########################
+def _firstOf(values, n):
+    '''Mask of the first occurrence of each value in an array of ints
+       in [0, n).'''
 
+    first = numpy.empty(n, dtype = numpy.intp)
+    # with repeated indices the last assignment wins, so assigning in
+    # reverse leaves the first position of each value
+    first[values[::-1]] = numpy.arange(len(values) - 1, -1, -1)
+    return first[values] == numpy.arange(len(values))
 
+########################
 
-class Leaf(Trie):
+def _asPositions(pos):
 
-    def __init__(self, cat):
-        Trie.__init__(self, cat)
-        self.cat = cat
-        self.range = _getRange(cat)
+    pos = numpy.asarray(pos, dtype = numpy.float64)
+    if pos.ndim != 2:
+        raise ValueError, "Positions must be an (n, ndim) array"
+    return pos
 
-    def _findNeighbors(self, coord, within, neighbors = []):
+########################
 
-        ds = self.cat.pos - coord
-        dist = numpy.sqrt((ds*ds).sum(axis=1))
-    
-        neighbors.extend(self.cat.id[dist < within].tolist())
-        return neighbors
+# (index, method, points, arguments) for the queries of a forked worker;
+# only ever set in the worker, by its Pool initializer
+_forked = None
 
+def _forkedSetup(index, method, points, arguments):
+    global _forked
+    _forked = (index, method, points, arguments)
 
-############################
-        
+def _forkedChunk(start):
+    (index, method, points, arguments) = _forked
+    return index._chunk(method, points, arguments, start)
+
+def _chunkOf(value, start, size):
+    '''The part of a per-point argument for points[start:start + size]:
+       value itself if it is the same for all points.'''
+
+    if numpy.ndim(value) == 0:
+        return value
+    return value[start:start + size]
+
+########################
+
+class SpatialIndex(object):
+    '''Batch radius queries over an (n, ndim) array of positions.
+       Subclasses find candidate pairs for a chunk of points in
+       _radiusChunk. ids, if given, are what findNeighbors reports.'''
+
+    # queries are handled this many points at a time, to bound memory
+    chunkSize = 8192
+
+    # what saveIndex writes: numbers and arrays that make up the index
+    _scalars = ['npoints', 'ndim']
+    _arrays = []
+
+    def __init__(self, pos, ids = None):
+
+        self.npoints = len(pos)
+        self.ndim = pos.shape[1]
+        self.ids = ids
+
+    ###################
+
+    def __len__(self):
+        return self.npoints
+
+    ###################
+
+    def _chunk(self, method, points, arguments, start):
+        '''method for the chunk of points from start, and its part of
+           each of arguments.'''
+
+        size = self.chunkSize
+        return getattr(self, method)(points[start:start + size],
+                                     *[_chunkOf(value, start, size)
+                                       for value in arguments])
+
+    ###################
+
+    def _mapChunks(self, method, points, arguments, starts, workers):
+        '''method (_radiusChunk or _knnChunk) of each chunk of points, in
+           order, computed by up to workers forked processes.'''
+
+        if workers is None or workers <= 1 or len(starts) <= 1:
+            for start in starts:
+                yield self._chunk(method, points, arguments, start)
+            return
+
+        # the workers inherit the index and points when they are forked,
+        # through the initializer's arguments rather than a global of this
+        # process, so concurrent queries from other threads cannot mix
+        pool = multiprocessing.Pool(min(workers, len(starts)), _forkedSetup,
+                                    (self, method, points, arguments))
+        try:
+            batch = max(1, len(starts) // (4 * workers))
+            for result in pool.imap(_forkedChunk, starts, batch):
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    ###################
+
+    def _radiusPairs(self, points, r, workers = None):
+        '''All (point, row, distance) pairs within r, sorted by point
+           and then row. r is a single radius or one per point.'''
+
+        points = numpy.asarray(points, dtype = numpy.float64)
+        if points.ndim != 2 or points.shape[1] != self.ndim:
+            raise ValueError, "Points must be an (n, %d) array" % self.ndim
+        r = numpy.asarray(r, dtype = numpy.float64)
+        if r.ndim != 0 and r.shape != (len(points),):
+            raise ValueError, "Give one radius, or one per point"
+
+        # neighbouring points are queried together, so that each chunk
+        # touches a compact part of the index
+        order = self._queryOrder(points)
+        points = points[order]
+        if r.ndim != 0:
+            r = r[order]
+
+        queries = []
+        rows = []
+        dist2 = []
+        starts = []
+        if self.npoints > 0:
+            starts = range(0, len(points), self.chunkSize)
+        for (start, (q, t, d)) in zip(starts,
+                                      self._mapChunks('_radiusChunk',
+                                                      points, (r,), starts,
+                                                      workers)):
+            queries.append(order[q + start])
+            rows.append(t)
+            dist2.append(d)
+
+        if not queries:
+            empty = numpy.zeros(0, dtype = numpy.intp)
+            return (empty, empty.copy(), numpy.zeros(0))
+        queries = numpy.concatenate(queries)
+        rows = numpy.concatenate(rows)
+        dist2 = numpy.concatenate(dist2)
+        order = numpy.argsort(queries * numpy.int64(self.npoints) + rows)
+        return (queries[order], rows[order], numpy.sqrt(dist2[order]))
+
+    ###################
+
+    def _queryOrder(self, points):
+        '''Order in which to query points: by the index's cell if it has
+           cells, else along the first axis.'''
+
+        return numpy.argsort(points[:, 0], kind = 'mergesort')
+
+    ###################
+
+    def query_radius(self, points, r, return_distance = False,
+                     workers = None):
+        '''Rows of the index within r of each of points, CSR style: those
+           of points[i] are indices[offsets[i]:offsets[i+1]], in increasing
+           order. r is a single radius or one per point. Returns (offsets,
+           indices), or (offsets, indices, distances) if return_distance.
+           workers > 1 shares the queries among that many forked
+           processes.'''
+
+        points = numpy.asarray(points, dtype = numpy.float64)
+        (queries, rows, dist) = self._radiusPairs(points, r, workers)
+        counts = numpy.bincount(queries, minlength = len(points))
+        offsets = numpy.zeros(len(points) + 1, dtype = numpy.intp)
+        numpy.cumsum(counts, out = offsets[1:])
+        if return_distance:
+            return (offsets, rows, dist)
+        return (offsets, rows)
+
+    ###################
+
+    def findNeighbors(self, coord, within):
+        '''ids (or rows, if the index has no ids) within distance within
+           of a single position coord.'''
+
+        (offsets, rows) = self.query_radius([coord], within)
+        if self.ids is None:
+            return rows.tolist()
+        return numpy.asarray(self.ids)[rows].tolist()
+
+
+    ###################
+
+    def _knnChunk(self, points, r, k, selfRows):
+        '''(distances, rows, found) of the k closest rows within r of each
+           of a modest number of points, leaving out selfRows if given;
+           found is False where fewer than k rows are in reach.'''
+
+        (query, rows, dist2) = self._radiusChunk(points, r)
+        if selfRows is not None:
+            others = rows != selfRows[query]
+            (query, rows, dist2) = (query[others], rows[others],
+                                    dist2[others])
+        order = numpy.argsort(query * numpy.int64(self.npoints) + rows)
+        (query, rows, dist2) = (query[order], rows[order], dist2[order])
+        counts = numpy.bincount(query, minlength = len(points))
+        firsts = numpy.cumsum(counts) - counts
+        rank = numpy.arange(len(query)) - firsts[query]
+
+        # each point's candidates go in a row of a table, padded with
+        # infinite distances, unless a few points have most of them
+        width = max(k, counts.max())
+        sortAll = len(points) * width > 4 * len(query) + len(points) * k
+        if sortAll:
+            order = numpy.lexsort((dist2, query))
+            (rows, dist2) = (rows[order], dist2[order])
+            width = k
+        keep = rank < width
+        table = numpy.empty((len(points), width))
+        table.fill(numpy.inf)
+        table[query[keep], rank[keep]] = dist2[keep]
+        ids = numpy.zeros((len(points), width), dtype = numpy.intp)
+        ids[query[keep], rank[keep]] = rows[keep]
+        if not sortAll:
+            # candidates are in row order, which a stable sort keeps for
+            # equal distances
+            best = numpy.argsort(table, axis = 1, kind = 'mergesort')[:, :k]
+            pick = numpy.arange(len(points))[:, None]
+            (table, ids) = (table[pick, best], ids[pick, best])
+        return (numpy.sqrt(table), ids, counts >= k)
+
+    ###################
+
+    def query_knn(self, points, k, exclude_self = False, workers = None):
+        '''The k rows of the index closest to each of points, closest
+           first (ties by row). Returns (distances, indices), both of shape
+           (len(points), k). With exclude_self, points[i] is row i of the
+           index, which is then left out of its own neighbours. workers is
+           as for query_radius.'''
 
-class Node(Trie):
+        points = numpy.asarray(points, dtype = numpy.float64)
+        if points.ndim != 2 or points.shape[1] != self.ndim:
+            raise ValueError, "Points must be an (n, %d) array" % self.ndim
+        if exclude_self and len(points) != self.npoints:
+            raise ValueError, "exclude_self needs one point per row"
+        wanted = k + int(bool(exclude_self))
+        if k < 1 or wanted > self.npoints:
+            raise ValueError, "k must be between 1 and %d" % \
+                (self.npoints - int(bool(exclude_self)))
 
-    def __init__(self,cat):
+        order = self._queryOrder(points)
+        points = points[order]
+        distances = numpy.empty((len(points), k))
+        indices = numpy.empty((len(points), k), dtype = numpy.intp)
+        radius = self._knnRadius(points, wanted)
+        todo = numpy.arange(len(points))
+        while len(todo) > 0:
+            selfRows = None
+            if exclude_self:
+                selfRows = order[todo]
+            starts = range(0, len(todo), self.chunkSize)
+            found = []
+            for (start, (dist, rows, ok)) in zip(starts, self._mapChunks(
+                    '_knnChunk', points[todo], (radius[todo], k, selfRows),
+                    starts, workers)):
+                which = todo[start:start + len(ok)][ok]
+                distances[which] = dist[ok]
+                indices[which] = rows[ok]
+                found.append(ok)
 
-        Trie.__init__(self, cat)
-        self.left = None
-        self.right = None
+            # points with too few rows in reach look twice as far
+            todo = todo[~numpy.concatenate(found)]
+            radius[todo] *= 2
 
-        if (self.range[0][1] - self.range[0][0]) > \
-                (self.range[1][1] - self.range[1][0]):
-            splitaxis = cat.pos[:,0]
+        unsorted = numpy.empty_like(order)
+        unsorted[order] = numpy.arange(len(order))
+        return (distances[unsorted], indices[unsorted])
+
+    ###################
+
+    def save(self, filename, source = None):
+        '''Writes the index to filename, for loadIndex.'''
+
+        saveIndex(self, filename, source)
+
+########################
+
+class KDTree(SpatialIndex):
+    '''Balanced KD-tree over an (n, ndim) array of positions, held in flat
+       arrays.'''
+
+    _scalars = SpatialIndex._scalars + ['leafSize', 'depth', 'nnodes',
+                                        'firstLeaf']
+    _arrays = ['perm', 'data', 'bounds', 'lo', 'hi']
+
+    def __init__(self, pos, leafSize = 16, ids = None):
+
+        pos = _asPositions(pos)
+        if leafSize < 2:
+            raise ValueError, "leafSize must be at least 2"
+        SpatialIndex.__init__(self, pos, ids)
+        self.leafSize = leafSize
+
+        depth = 0
+        while (self.npoints >> depth) > leafSize:
+            depth += 1
+        self.depth = depth
+        self.nnodes = 2**(depth + 1) - 1
+        self.firstLeaf = 2**depth - 1
+
+        self._build(pos)
+
+    ###################
+
+    def _build(self, pos):
+
+        n = self.npoints
+        perm = numpy.arange(n)
+        data = pos
+
+        # reorder level by level: each node's points are sorted along its
+        # widest dimension, and split in half between its children
+        for level in range(self.depth):
+            nseg = 2**level
+            bounds = (numpy.arange(nseg + 1) * n) // nseg
+            seg = numpy.repeat(numpy.arange(nseg), numpy.diff(bounds))
+            lo = numpy.minimum.reduceat(data, bounds[:-1], axis = 0)
+            hi = numpy.maximum.reduceat(data, bounds[:-1], axis = 0)
+            extent = hi - lo
+            axis = extent.argmax(axis = 1)
+            span = extent[numpy.arange(nseg), axis]
+            span[span == 0] = 1.
+            coord = data[numpy.arange(n), axis[seg]]
+            key = seg + 0.5 * (coord - lo[seg, axis[seg]]) / span[seg]
+            order = numpy.argsort(key, kind = 'quicksort')
+            data = data[order]
+            perm = perm[order]
+
+        self.perm = perm
+        self.data = numpy.ascontiguousarray(data)
+
+        nleaves = 2**self.depth
+        self.bounds = (numpy.arange(nleaves + 1) * n) // nleaves
+
+        # bounding boxes of the leaves, then of each level above
+        self.lo = numpy.empty((self.nnodes, self.ndim))
+        self.hi = numpy.empty((self.nnodes, self.ndim))
+        if n == 0:
+            self.lo[:] = numpy.inf
+            self.hi[:] = -numpy.inf
+            return
+        leaves = slice(self.firstLeaf, self.nnodes)
+        self.lo[leaves] = numpy.minimum.reduceat(data, self.bounds[:-1],
+                                                 axis = 0)
+        self.hi[leaves] = numpy.maximum.reduceat(data, self.bounds[:-1],
+                                                 axis = 0)
+        for level in range(self.depth - 1, -1, -1):
+            nodes = numpy.arange(2**level - 1, 2**(level + 1) - 1)
+            self.lo[nodes] = numpy.minimum(self.lo[2*nodes + 1],
+                                           self.lo[2*nodes + 2])
+            self.hi[nodes] = numpy.maximum(self.hi[2*nodes + 1],
+                                           self.hi[2*nodes + 2])
+
+    ###################
+
+    def _boxDistance2(self, points, nodes):
+        '''Squared distance from each point to the box of its node.'''
+
+        below = self.lo[nodes] - points
+        above = points - self.hi[nodes]
+        gap = numpy.maximum(numpy.maximum(below, above), 0.)
+        return (gap * gap).sum(axis = 1)
+
+    ###################
+
+    def _knnRadius(self, points, k):
+        '''A radius around each point that holds at least k rows: the
+           distance to the k-th closest row of the deepest node, on the way
+           down towards the point, that still has k rows.'''
+
+        level = 0
+        while level < self.depth and (self.npoints >> (level + 1)) >= k:
+            level += 1
+        # the leaves under each node at that level
+        span = 2**(self.depth - level)
+
+        radius = numpy.empty(len(points))
+        for start in range(0, len(points), self.chunkSize):
+            chunk = points[start:start + self.chunkSize]
+            nodes = numpy.zeros(len(chunk), dtype = numpy.intp)
+            for step in range(level):
+                left = 2 * nodes + 1
+                nearer = self._boxDistance2(chunk, left) <= \
+                    self._boxDistance2(chunk, left + 1)
+                nodes = numpy.where(nearer, left, left + 1)
+
+            first = (nodes - (2**level - 1)) * span
+            starts = self.bounds[first]
+            counts = self.bounds[first + span] - starts
+            rows = _expandRanges(starts, counts)
+            query = numpy.repeat(numpy.arange(len(chunk)), counts)
+            diff = self.data[rows] - chunk[query]
+
+            # the nodes differ in size by at most one row
+            table = numpy.empty((len(chunk), counts.max()))
+            table.fill(numpy.inf)
+            rank = numpy.arange(len(rows)) - \
+                (numpy.cumsum(counts) - counts)[query]
+            table[query, rank] = (diff * diff).sum(axis = 1)
+            kth = numpy.partition(table, k - 1, axis = 1)[:, k - 1]
+            # a little slack, so that rounding cannot lose the k-th row
+            radius[start:start + len(chunk)] = numpy.sqrt(kth) * (1 + 1e-9)
+        return radius
+
+    ###################
+
+    def _radiusChunk(self, points, r):
+        '''(point, row, squared distance) of all pairs within r, for a
+           modest number of points. r is a single radius or one per
+           point.'''
+
+        r2 = numpy.asarray(r, dtype = numpy.float64)**2
+        perPoint = r2.ndim != 0
+        query = numpy.arange(len(points))
+        nodes = numpy.zeros(len(points), dtype = numpy.intp)
+
+        for level in range(self.depth + 1):
+            limit = r2[query] if perPoint else r2
+            keep = self._boxDistance2(points[query], nodes) <= limit
+            query = query[keep]
+            nodes = nodes[keep]
+            if level < self.depth:
+                query = numpy.concatenate([query, query])
+                nodes = numpy.concatenate([2*nodes + 1, 2*nodes + 2])
+
+        leaf = nodes - self.firstLeaf
+        starts = self.bounds[leaf]
+        counts = self.bounds[leaf + 1] - starts
+        rows = _expandRanges(starts, counts)
+        query = numpy.repeat(query, counts)
+
+        diff = self.data[rows] - points[query]
+        dist2 = (diff * diff).sum(axis = 1)
+        close = dist2 <= (r2[query] if perPoint else r2)
+        return (query[close], self.perm[rows[close]], dist2[close])
+
+########################
+
+class GridIndex(SpatialIndex):
+    '''Positions binned into cells of side cellSize, held sorted by
+       cell. A radius query visits the block of cells within r of each
+       point, found by searchsorted on the sorted cell numbers.'''
+
+    _scalars = SpatialIndex._scalars + ['cellSize', 'ncells']
+    _arrays = ['origin', 'shape', 'strides', 'perm', 'cellIds', 'data',
+               'cellStarts']
+
+    # radii that would visit more cells than this around each point (as
+    # far-off kNN queries can) are searched in a KDTree instead
+    maxOffsets = 125
+
+    def __init__(self, pos, cellSize, ids = None):
+
+        pos = _asPositions(pos)
+        if not cellSize > 0:
+            raise ValueError, "cellSize must be positive"
+        SpatialIndex.__init__(self, pos, ids)
+        self.cellSize = float(cellSize)
+        self.tree = None
+
+        if self.npoints == 0:
+            self.origin = numpy.zeros(self.ndim)
+            self.shape = numpy.ones(self.ndim, dtype = numpy.int64)
         else:
-            splitaxis = cat.pos[:1]
+            self.origin = pos.min(axis = 0)
+            self.shape = self._cells(pos.max(axis = 0)[None, :])[0] + 1
+        if numpy.prod(self.shape.astype(numpy.float64)) > 2.**62:
+            raise ValueError, "Too many cells; use a larger cellSize"
+        self.strides = numpy.ones(self.ndim, dtype = numpy.int64)
+        for dim in range(self.ndim - 2, -1, -1):
+            self.strides[dim] = self.strides[dim + 1] * self.shape[dim + 1]
+
+        cellIds = (self._cells(pos) * self.strides).sum(axis = 1)
+        self.perm = numpy.argsort(cellIds, kind = 'mergesort')
+        self.cellIds = cellIds[self.perm]
+        self.data = pos[self.perm]
 
-        split = median(splitaxis)
+        # where each cell starts in the sorted points; looked up directly
+        # when the table is not much bigger than the points themselves
+        self.ncells = int(numpy.prod(self.shape))
+        self.cellStarts = None
+        if self.ncells <= 4 * self.npoints + 1024:
+            self.cellStarts = numpy.searchsorted(self.cellIds,
+                                                 numpy.arange(self.ncells + 1))
 
-        self.left = buildTrie(cat.filter(splitaxis <= split))
-        self.right = buildTrie(cat.filter(splitaxis > split))
+    ###################
 
+    def _cells(self, points):
+        return numpy.floor((points - self.origin) /
+                           self.cellSize).astype(numpy.int64)
 
-    def findNeighbors(self, coord, within, neighbors = []):
+    ###################
+
+    def _queryOrder(self, points):
+
+        cells = numpy.clip(self._cells(points), 0, self.shape - 1)
+        return numpy.argsort((cells * self.strides).sum(axis = 1),
+                             kind = 'mergesort')
+
+    ###################
+
+    def _knnRadius(self, points, k):
+        '''First guess at a radius around each point that holds k rows:
+           that of a ball holding k rows at the mean density of the
+           occupied cells.'''
+
+        occupied = 1 + numpy.count_nonzero(numpy.diff(self.cellIds))
+        ball = math.pi**(self.ndim / 2.) / math.gamma(self.ndim / 2. + 1)
+        cells = k * occupied / (self.npoints * ball)
+        return numpy.repeat(self.cellSize * cells**(1. / self.ndim),
+                            len(points))
+
+    ###################
+
+    def _tree(self):
+        '''KDTree of the sorted positions, built when first needed.'''
+
+        # loadIndex makes GridIndexes without calling __init__
+        if getattr(self, 'tree', None) is None:
+            self.tree = KDTree(self.data)
+        return self.tree
+
+    ###################
+
+    def _radiusChunk(self, points, r):
+        '''(point, row, squared distance) of all pairs within r, for a
+           modest number of points. r is a single radius or one per
+           point.'''
+
+        r2 = numpy.asarray(r, dtype = numpy.float64)**2
+        perPoint = r2.ndim != 0
+        reach = int(numpy.ceil(numpy.max(r) / self.cellSize))
+        if (2 * reach + 1)**self.ndim > self.maxOffsets:
+            (query, rows, dist2) = self._tree()._radiusChunk(points, r)
+            return (query, self.perm[rows], dist2)
+        cells = self._cells(points)
+
+        queries = []
+        starts = []
+        counts = []
+        for step in itertools.product(range(-reach, reach + 1),
+                                      repeat = self.ndim):
+            neighbour = cells + step
+            inside = ((neighbour >= 0) & (neighbour < self.shape)).all(axis = 1)
+            query = numpy.nonzero(inside)[0]
+            cellIds = (neighbour[query] * self.strides).sum(axis = 1)
+            if self.cellStarts is None:
+                start = numpy.searchsorted(self.cellIds, cellIds, 'left')
+                stop = numpy.searchsorted(self.cellIds, cellIds, 'right')
+            else:
+                start = self.cellStarts[cellIds]
+                stop = self.cellStarts[cellIds + 1]
+            occupied = stop > start
+            queries.append(query[occupied])
+            starts.append(start[occupied])
+            counts.append((stop - start)[occupied])
+
+        counts = numpy.concatenate(counts)
+        rows = _expandRanges(numpy.concatenate(starts), counts)
+        query = numpy.repeat(numpy.concatenate(queries), counts)
+
+        diff = self.data[rows] - points[query]
+        dist2 = (diff * diff).sum(axis = 1)
+        close = dist2 <= (r2[query] if perPoint else r2)
+        return (query[close], self.perm[rows[close]], dist2[close])
+
+############################
+
+engines = {'kdtree' : lambda pos, tolerance, ids:
+               KDTree(pos, leafSize = SPLIT, ids = ids),
+           'grid' : lambda pos, tolerance, ids:
+               GridIndex(pos, cellSize = tolerance, ids = ids)}
+
+def buildIndex(pos, tolerance, engine = 'kdtree', ids = None):
+    '''Index of pos suited to queries of radius tolerance, using one of
+       engines.'''
+
+    if engine not in engines:
+        raise ValueError, "Unknown engine %s; choose from %s" % \
+            (engine, ', '.join(sorted(engines.keys())))
+    return engines[engine](pos, tolerance, ids)
 
-        neighbors.extend(self.left.findNeighbors(coord, within, neighbors))
-        neighbors.extend(self.right.findNeighbors(coord, within, neighbors))
-        return neighbors
-        
 ################################
 
 
-def matchCatalogs(catalog1,catalog2,dist):
-    #lists of entry objects
+class Matches(object):
+    '''Pairs between n1 rows of one catalog and n2 of another, CSR style:
+       the rows of the second matched to row i of the first are
+       indices[offsets[i]:offsets[i+1]], at distances[offsets[i]:...]
+       (distances may be None).'''
 
-    cat1Index = {}
-    cat2Index = {}
+    def __init__(self, offsets, indices, n2, distances = None):
+        self.offsets = offsets
+        self.indices = indices
+        self.distances = distances
+        self.n1 = len(offsets) - 1
+        self.n2 = n2
+
+    def __len__(self):
+        return len(self.indices)
 
-    trie = buildKDTrie(cat2)
+    ###################
 
-    for i in xrange(len(cat2)):
-        cat2Index[cat2.id[i]] = []
-    
-    for i in xrange(len(cat1)):
-        curId = cat1.id[i]
-        neighbors = trie.findNeighbors(cat1.pos[i], tolerance)
-        cat1Index[curId] = neighbors
-        for id in neighbors:
-            cat2Index[id].append(curId)
+    def counts(self):
+        '''Number of matches of each row of the first catalog.'''
+        return numpy.diff(self.offsets)
 
-    return (cat1Index, cat2Index)
-        
+    def neighbors(self, i):
+        return self.indices[self.offsets[i]:self.offsets[i+1]]
 
+    def pairs(self):
+        '''(rows1, rows2): every matched pair, ordered by rows1.'''
+        return (numpy.repeat(numpy.arange(self.n1), self.counts()),
+                self.indices)
 
+    ###################
+
+    def transpose(self):
+        '''The same pairs, seen from the second catalog.'''
+
+        (rows1, rows2) = self.pairs()
+        order = numpy.lexsort((rows1, rows2))
+        counts = numpy.bincount(rows2, minlength = self.n2)
+        offsets = numpy.zeros(self.n2 + 1, dtype = numpy.intp)
+        numpy.cumsum(counts, out = offsets[1:])
+        distances = None
+        if self.distances is not None:
+            distances = self.distances[order]
+        return Matches(offsets, rows1[order], self.n1, distances)
+
+    ###################
+
+    def _needDistances(self):
+        if self.distances is None:
+            raise ValueError, "These matches have no distances"
+
+    def best(self):
+        '''For each row of the first catalog, its closest match in the
+           second (the lowest row on ties), or -1.'''
+
+        self._needDistances()
+        best = -numpy.ones(self.n1, dtype = numpy.intp)
+        if len(self) == 0:
+            return best
+        (rows1, rows2) = self.pairs()
+        matched = numpy.nonzero(self.counts())[0]
+        closest = numpy.minimum.reduceat(self.distances,
+                                         self.offsets[matched])
+        nearest = numpy.nonzero(self.distances ==
+                                numpy.repeat(closest,
+                                             self.counts()[matched]))[0]
+        # within a row the indices increase, so the first is the lowest
+        nearest = nearest[_firstOf(rows1[nearest], self.n1)]
+        best[rows1[nearest]] = rows2[nearest]
+        return best
+
+    ###################
+
+    def oneToOne(self):
+        '''Unique pairing: pairs are accepted closest first, each row
+           of either catalog being used at most once. Returns (match1,
+           match2), the partner of each row of either catalog, or -1.'''
+
+        self._needDistances()
+        (rows1, rows2) = self.pairs()
+        # pairs are ordered by rows1 and rows2 already, so ties in
+        # distance stay in that order
+        order = numpy.argsort(self.distances, kind = 'mergesort')
+        rows1 = rows1[order]
+        rows2 = rows2[order]
+
+        match1 = -numpy.ones(self.n1, dtype = numpy.intp)
+        match2 = -numpy.ones(self.n2, dtype = numpy.intp)
+
+        # Each round accepts every pair that is the closest remaining one
+        # of both its rows. This always includes the closest pair left,
+        # and gives the same result as taking the pairs one at a time.
+        while len(rows1):
+            mutual = _firstOf(rows1, self.n1) & _firstOf(rows2, self.n2)
+
+            match1[rows1[mutual]] = rows2[mutual]
+            match2[rows2[mutual]] = rows1[mutual]
+            free = (match1[rows1] < 0) & (match2[rows2] < 0)
+            rows1 = rows1[free]
+            rows2 = rows2[free]
+
+        return (match1, match2)
+
+    ###################
+
+    def toDicts(self, ids1, ids2):
+        '''(index1, index2): dicts from the ids of each catalog to lists
+           of the matching ids in the other, as matchCatalogs used to
+           return. Only sensible for modest catalogs.'''
+
+        ids1 = numpy.asarray(ids1).tolist()
+        ids2 = numpy.asarray(ids2)
+        matched = ids2[self.indices].tolist()
+
+        index1 = {}
+        index2 = {}
+        for id in ids2.tolist():
+            index2[id] = []
+        for (i, curId) in enumerate(ids1):
+            neighbors = matched[self.offsets[i]:self.offsets[i+1]]
+            index1[curId] = neighbors
+            for id in neighbors:
+                index2[id].append(curId)
+
+        return (index1, index2)
+
+############################
+
+class SkyIndex(object):
+    '''Radius queries in arcsec around ra, dec positions (degrees). The
+       positions are indexed as unit vectors; for the grid engine,
+       tolerance (arcsec) sets the cell size.'''
+
+    def __init__(self, ra, dec, tolerance = None, engine = 'kdtree',
+                 ids = None):
+
+        if engine == 'grid' and tolerance is None:
+            raise ValueError, "The grid engine needs a tolerance"
+        chord = None
+        if tolerance is not None:
+            chord = _chord(tolerance)
+        self.index = buildIndex(unitVectors(ra, dec), chord, engine, ids)
+
+    def __len__(self):
+        return len(self.index)
+
+    def query_radius(self, ra, dec, r, return_distance = False,
+                     workers = None):
+        '''As SpatialIndex.query_radius, for positions ra, dec and radius
+           r in arcsec; distances are in arcsec.'''
+
+        result = self.index.query_radius(unitVectors(ra, dec), _chord(r),
+                                         return_distance, workers)
+        if return_distance:
+            return result[:2] + (_arcsec(result[2]),)
+        return result
+
+    def query_knn(self, ra, dec, k, exclude_self = False, workers = None):
+        '''As SpatialIndex.query_knn, for positions ra, dec; distances
+           are in arcsec.'''
+
+        (chords, indices) = self.index.query_knn(unitVectors(ra, dec), k,
+                                                 exclude_self, workers)
+        return (_arcsec(chords), indices)
+
+    def save(self, filename, source = None):
+        '''Writes the index to filename, for loadIndex.'''
+
+        saveIndex(self, filename, source)
+
+################################
+
+# index files: magic, format version, header length and header CRC32,
+# then a JSON header and the arrays, each starting on a multiple of
+# _ALIGN bytes
+_MAGIC = 'MATCHIDX'
+_PREFIX = struct.Struct('<8sIII')
+_ALIGN = 64
+FORMAT_VERSION = 1
+
+indexTypes = {'KDTree' : KDTree,
+              'GridIndex' : GridIndex}
+
+def _fingerprint(source):
+    '''Digest of a string, an array or a sequence of arrays.'''
+
+    if source is None:
+        return None
+    digest = hashlib.sha1()
+    if isinstance(source, basestring):
+        digest.update(source)
+    else:
+        if isinstance(source, numpy.ndarray):
+            source = [source]
+        for array in source:
+            array = numpy.ascontiguousarray(array)
+            digest.update('%s%s' % (array.dtype.str, array.shape))
+            digest.update(buffer(array))
+    return digest.hexdigest()
+
+def _crc(array, chunkBytes = 2**24):
+
+    raw = array.reshape(-1).view(numpy.uint8)
+    crc = 0
+    for start in range(0, len(raw), chunkBytes):
+        crc = zlib.crc32(buffer(raw[start:start + chunkBytes]), crc)
+    return crc & 0xffffffff
+
+def _aligned(offset):
+    return -(-offset // _ALIGN) * _ALIGN
+
+def saveIndex(index, filename, source = None):
+    '''Writes a KDTree, GridIndex or SkyIndex to filename. source, if
+       given, identifies what was indexed, so that loadIndex can tell
+       when the index is stale. The file is replaced atomically.'''
+
+    sky = isinstance(index, SkyIndex)
+    if sky:
+        index = index.index
+    kind = type(index).__name__
+    if indexTypes.get(kind) is not type(index):
+        raise TypeError, "Cannot save a %s" % kind
+
+    arrays = [(name, getattr(index, name)) for name in index._arrays]
+    if index.ids is not None:
+        arrays.append(('ids', index.ids))
+    layout = {}
+    data = []
+    offset = 0
+    for (name, array) in arrays:
+        if array is None:
+            layout[name] = None
+            continue
+        array = numpy.ascontiguousarray(array)
+        if array.dtype.hasobject:
+            raise ValueError, "Cannot save %s of dtype object" % name
+        offset = _aligned(offset)
+        layout[name] = {'dtype' : array.dtype.str,
+                        'shape' : list(array.shape),
+                        'offset' : offset,
+                        'crc' : _crc(array)}
+        data.append((offset, array))
+        offset += array.nbytes
+
+    header = {'kind' : kind,
+              'sky' : sky,
+              'source' : _fingerprint(source),
+              'scalars' : dict([(name,
+                                 numpy.array(getattr(index, name)).item())
+                                for name in index._scalars]),
+              'arrays' : layout}
+    # arrays start after the header, at an offset the header records
+    start = 0
+    while True:
+        header['start'] = start
+        header['size'] = start + offset
+        text = json.dumps(header, sort_keys = True)
+        if _PREFIX.size + len(text) <= start:
+            break
+        start = _aligned(_PREFIX.size + len(text))
+    text = text.ljust(start - _PREFIX.size)
+
+    # created with the mode open() would give it, which mkstemp does not;
+    # the name only has to be unique, so O_EXCL retries on a clash
+    while True:
+        tmpname = '%s.%d.%s.tmp' % (filename, os.getpid(),
+                                    os.urandom(4).encode('hex'))
+        try:
+            fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0666)
+            break
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    try:
+        output = os.fdopen(fd, 'wb')
+        output.write(_PREFIX.pack(_MAGIC, FORMAT_VERSION, len(text),
+                                  zlib.crc32(text) & 0xffffffff))
+        output.write(text)
+        for (offset, array) in data:
+            output.seek(start + offset)
+            output.write(buffer(array))
+        output.truncate(header['size'])
+        output.close()
+        os.rename(tmpname, filename)
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+def loadIndex(filename, verify = False, source = None):
+    '''Opens an index written by saveIndex, with its arrays memory-mapped
+       read-only. verify = True checks the arrays against their CRCs;
+       source, if given, must be what the index was saved with.'''
+
+    input = open(filename, 'rb')
+    try:
+        prefix = input.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size or \
+                _PREFIX.unpack(prefix)[0] != _MAGIC:
+            raise ValueError, "%s is not an index file" % filename
+        (magic, version, length, crc) = _PREFIX.unpack(prefix)
+        if version != FORMAT_VERSION:
+            raise ValueError, "%s has index format %d, not %d; rebuild it" \
+                % (filename, version, FORMAT_VERSION)
+        text = input.read(length)
+    finally:
+        input.close()
+    if len(text) != length or zlib.crc32(text) & 0xffffffff != crc:
+        raise ValueError, "%s has a damaged header" % filename
+    header = json.loads(text)
+    if os.path.getsize(filename) != header['size']:
+        raise ValueError, "%s is truncated" % filename
+    if source is not None and _fingerprint(source) != header['source']:
+        raise ValueError, "%s is stale: it indexes other positions" \
+            % filename
+
+    cls = indexTypes[header['kind']]
+    index = cls.__new__(cls)
+    for (name, value) in header['scalars'].iteritems():
+        setattr(index, str(name), value)
+    index.ids = None
+    for (name, spec) in header['arrays'].iteritems():
+        array = None
+        if spec is not None:
+            shape = tuple(spec['shape'])
+            dtype = numpy.dtype(str(spec['dtype']))
+            if numpy.prod(shape) == 0:
+                array = numpy.zeros(shape, dtype = dtype)
+            else:
+                array = numpy.memmap(filename, dtype, 'r',
+                                     header['start'] + spec['offset'],
+                                     shape).view(numpy.ndarray)
+            if verify and _crc(array) != spec['crc']:
+                raise ValueError, "%s: %s does not match its checksum" % \
+                    (filename, name)
+        setattr(index, str(name), array)
+
+    if header['sky']:
+        sky = SkyIndex.__new__(SkyIndex)
+        sky.index = index
+        return sky
+    return index
+
+################################
+
+
+def matchCatalogs(cat1, cat2, tolerance, engine = 'kdtree',
+                  distances = True, workers = None):
+    '''Matches between the rows of cat1 and cat2 within tolerance of each
+       other, with their distances unless distances = False. engine is
+       'kdtree' or 'grid'. For SkyCatalogs, tolerance and distances are
+       in arcsec. workers > 1 shares the queries among that many forked
+       processes.'''
+
+    sky = isinstance(cat1, SkyCatalog)
+    if sky != isinstance(cat2, SkyCatalog):
+        raise TypeError, "Cannot match a SkyCatalog with a planar Catalog"
+    radius = tolerance
+    if sky:
+        radius = _chord(tolerance)
+
+    index = buildIndex(cat2.pos, radius, engine)
+    result = index.query_radius(cat1.pos, radius,
+                                return_distance = distances,
+                                workers = workers)
+    if distances:
+        (offsets, rows, dist) = result
+        if sky:
+            dist = _arcsec(dist)
+    else:
+        (offsets, rows) = result
+        dist = None
+    return Matches(offsets, rows, len(cat2), dist)
+
+
+############################
+
+def _imcatColumns(filename):
+    '''{name : (first column, width)} from the contents section of an
+       imcat text catalog's preamble, or {} if it has none.'''
+
+    columns = {}
+    reVar = re.compile('^# (?P<type>\w+)\s+(?P<dim>[0-9 ]+)\s+(?P<name>\w+)')
+    nextColumn = 0
+    left = 0
+    input = open(filename)
+    try:
+        for line in input:
+            if not line.startswith('#'):
+                break
+            match = re.match('#\s+(?P<section>\w+):\s*(?P<nvars>\d+)?\s*$',
+                             line)
+            if match is not None:
+                left = 0
+                if match.group('section') == 'contents':
+                    left = int(match.group('nvars'))
+                continue
+            if left > 0:
+                left -= 1
+                match = reVar.match(line)
+                if match is None:
+                    raise ValueError, "Catalog Format Error: %s" % line
+                # the first number is the count of dimensions
+                width = 1
+                for dim in re.findall('(\d+)\s*', match.group('dim'))[1:]:
+                    width *= int(dim)
+                columns[match.group('name')] = (nextColumn, width)
+                nextColumn += width
+    finally:
+        input.close()
+    return columns
+
+############################
+
+class TextCatalogReader(object):
+    '''Reads positions from an imcat (lc) text catalog, chunkRows lines
+       at a time. columns are names from the catalog's contents (a vector
+       column supplies all its components) or column numbers.'''
+
+    def __init__(self, filename, columns, chunkRows = 100000):
+
+        self.filename = filename
+        self.chunkRows = chunkRows
+
+        contents = None
+        self.usecols = []
+        for column in columns:
+            if isinstance(column, (int, long)):
+                self.usecols.append(column)
+                continue
+            if contents is None:
+                contents = _imcatColumns(filename)
+            if column not in contents:
+                raise KeyError, "No column %s in %s" % (column, filename)
+            (first, width) = contents[column]
+            self.usecols.extend(range(first, first + width))
+
+    def chunks(self):
+        '''Yields (n, ncolumns) arrays of positions, in file order.'''
+
+        input = open(self.filename)
+        try:
+            data = (line for line in input
+                    if not line.startswith('#') and line.strip())
+            while True:
+                lines = list(itertools.islice(data, self.chunkRows))
+                if not lines:
+                    break
+                yield numpy.loadtxt(lines, usecols = self.usecols,
+                                    ndmin = 2)
+        finally:
+            input.close()
+
+############################
+
+class ArrayCatalogReader(object):
+    '''Reads positions chunkRows at a time from one array-like per
+       column: .npy filenames (memory-mapped), numpy memmaps, PyTables
+       arrays or pytableshelf ArrayProxies.'''
+
+    def __init__(self, columns, chunkRows = 100000):
+
+        self.columns = []
+        for column in columns:
+            if isinstance(column, basestring):
+                column = numpy.load(column, mmap_mode = 'r')
+            self.columns.append(column)
+        self.chunkRows = chunkRows
+
+    def chunks(self):
+
+        nrows = len(self.columns[0])
+        for start in range(0, nrows, self.chunkRows):
+            yield numpy.column_stack([numpy.asarray(column[start:start +
+                                                           self.chunkRows],
+                                                    dtype = numpy.float64)
+                                      for column in self.columns])
+
+############################
+
+class _Tiling(object):
+    '''Cubic tiles of side size over the box lo..hi, numbered
+       row-major.'''
+
+    def __init__(self, lo, hi, size):
+        self.lo = lo
+        self.size = size
+        self.shape = numpy.maximum(numpy.floor((hi - lo) / size), 0) \
+            .astype(numpy.int64) + 1
+        self.strides = numpy.ones(len(lo), dtype = numpy.int64)
+        for dim in range(len(lo) - 2, -1, -1):
+            self.strides[dim] = self.strides[dim + 1] * self.shape[dim + 1]
+
+    def cells(self, pos):
+        return numpy.clip(numpy.floor((pos - self.lo) / self.size)
+                          .astype(numpy.int64), 0, self.shape - 1)
+
+    def tiles(self, pos):
+        return (self.cells(pos) * self.strides).sum(axis = 1)
+
+    def tilesWithMargin(self, pos, margin):
+        '''(point, tile) for every tile whose box, grown by margin,
+           holds each point. margin must be less than half a tile.'''
+
+        low = self.cells(pos - margin)
+        high = self.cells(pos + margin)
+        points = []
+        tiles = []
+        for step in itertools.product((0, 1), repeat = len(self.lo)):
+            step = numpy.array(step, dtype = bool)
+            ok = ((high > low) | ~step).all(axis = 1)
+            cells = numpy.where(step, high, low)[ok]
+            points.append(numpy.nonzero(ok)[0])
+            tiles.append((cells * self.strides).sum(axis = 1))
+        return (numpy.concatenate(points), numpy.concatenate(tiles))
+
+############################
+
+def _positions(reader, sky):
+    '''(first row, positions) for each chunk of reader.'''
+
+    row = 0
+    for chunk in reader.chunks():
+        if sky:
+            pos = unitVectors(chunk[:,0], chunk[:,1])
+        else:
+            pos = chunk
+        yield (row, pos)
+        row += len(chunk)
+
+def _tilePlan(readers, sky, radius, tileRows, sampleSize = 100000):
+    '''Chooses tiles holding about tileRows objects each, from the
+       bounds of all positions and an evenly thinned sample of them.'''
+
+    lo = hi = None
+    seen = 0
+    sample = []
+    stride = 1
+    kept = 0
+    for reader in readers:
+        for (row, pos) in _positions(reader, sky):
+            if not len(pos):
+                continue
+            if lo is None:
+                lo = pos.min(axis = 0)
+                hi = pos.max(axis = 0)
+            lo = numpy.minimum(lo, pos.min(axis = 0))
+            hi = numpy.maximum(hi, pos.max(axis = 0))
+            part = pos[(-seen) % stride::stride]
+            sample.append(part)
+            kept += len(part)
+            seen += len(pos)
+            if kept > 2 * sampleSize:
+                sample = [numpy.concatenate(sample)[::2]]
+                kept = len(sample[0])
+                stride *= 2
+
+    if lo is None:
+        return None
+    sample = numpy.concatenate(sample)
+    scale = float(seen) / len(sample)
+
+    # halve the tiles until the fullest should fit, but keep them at least
+    # four margins across
+    size = max((hi - lo).max(), 4 * radius)
+    while size / 2 >= 4 * radius:
+        tiling = _Tiling(lo, hi, size)
+        fullest = numpy.bincount(tiling.tiles(sample)).max() * scale
+        if fullest <= tileRows:
+            break
+        size /= 2
+    return _Tiling(lo, hi, size)
+
+def _appendTiles(tmpdir, which, tiles, rows, pos):
+
+    order = numpy.argsort(tiles, kind = 'mergesort')
+    tiles = tiles[order]
+    records = numpy.empty(len(rows), dtype = [('row', numpy.int64),
+                                              ('pos', numpy.float64,
+                                               (pos.shape[1],))])
+    records['row'] = rows[order]
+    records['pos'] = pos[order]
+    bounds = numpy.nonzero(numpy.diff(tiles))[0] + 1
+    starts = numpy.concatenate([[0], bounds])
+    stops = numpy.concatenate([bounds, [len(tiles)]])
+    for (start, stop) in zip(starts, stops):
+        output = open(os.path.join(tmpdir, '%d.%d' % (tiles[start], which)),
+                      'ab')
+        try:
+            records[start:stop].tofile(output)
+        finally:
+            output.close()
+
+def _readTile(tmpdir, tile, which, ndim):
+
+    filename = os.path.join(tmpdir, '%d.%d' % (tile, which))
+    if not os.path.exists(filename):
+        return (numpy.zeros(0, dtype = numpy.int64), numpy.zeros((0, ndim)))
+    records = numpy.fromfile(filename, dtype = [('row', numpy.int64),
+                                                ('pos', numpy.float64,
+                                                 (ndim,))])
+    os.remove(filename)
+    return (records['row'], records['pos'])
+
+def streamMatch(reader1, reader2, tolerance, sky = False, tileRows = 10**6,
+                engine = 'grid', tmpdir = None):
+    '''Generator of (rows1, rows2, distances) arrays matching every object
+       read by reader1 to those read by reader2 within tolerance, without
+       holding either catalog in memory. Temporary tiles are written under
+       tmpdir.'''
+
+    radius = tolerance
+    if sky:
+        radius = _chord(tolerance)
+
+    tiling = _tilePlan([reader1, reader2], sky, radius, tileRows)
+    if tiling is None:
+        return
+
+    workdir = tempfile.mkdtemp(prefix = 'streammatch', dir = tmpdir)
+    try:
+        ndim = len(tiling.lo)
+        withCat1 = set()
+        for (row, pos) in _positions(reader1, sky):
+            tiles = tiling.tiles(pos)
+            withCat1.update(numpy.unique(tiles).tolist())
+            _appendTiles(workdir, 1, tiles, row + numpy.arange(len(pos)), pos)
+        for (row, pos) in _positions(reader2, sky):
+            (points, tiles) = tiling.tilesWithMargin(pos, radius)
+            _appendTiles(workdir, 2, tiles, row + points, pos[points])
+
+        for tile in sorted(withCat1):
+            (rows1, pos1) = _readTile(workdir, tile, 1, ndim)
+            (rows2, pos2) = _readTile(workdir, tile, 2, ndim)
+            if not len(rows2):
+                continue
+            index = buildIndex(pos2, radius, engine)
+            (queries, local, dist) = index._radiusPairs(pos1, radius)
+            (matched1, matched2) = (rows1[queries], rows2[local])
+            order = numpy.lexsort((matched2, matched1))
+            dist = dist[order]
+            if sky:
+                dist = _arcsec(dist)
+            yield (matched1[order], matched2[order], dist)
+    finally:
+        shutil.rmtree(workdir, ignore_errors = True)
 
 
 #############################
+#TESTING
+#############################
+
+import threading
+import unittest
+
+def _bruteRadius(pos, points, r):
+    '''Reference answer: sorted rows of pos within r of each point.'''
+    result = []
+    for point in points:
+        d = numpy.sqrt(((pos - point)**2).sum(axis = 1))
+        result.append(numpy.nonzero(d <= r)[0].tolist())
+    return result
+
+def _rows(offsets, indices):
+    return [indices[offsets[i]:offsets[i+1]].tolist()
+            for i in range(len(offsets) - 1)]
+
+def _bruteKnn(pos, points, k, exclude_self = False):
+    '''Reference answer: (distances, rows) of the k closest rows.'''
+    distances = []
+    rows = []
+    for (i, point) in enumerate(points):
+        d = numpy.sqrt(((pos - point)**2).sum(axis = 1))
+        order = numpy.lexsort((numpy.arange(len(pos)), d))
+        if exclude_self:
+            order = order[order != i]
+        distances.append(d[order[:k]])
+        rows.append(order[:k])
+    return (numpy.array(distances), numpy.array(rows))
+
+###########
+
+class TestKDTree(unittest.TestCase):
+
+    def setUp(self):
+        rand = numpy.random.RandomState(3)
+        self.pos = rand.uniform(0, 10, size = (2000, 2))
+        self.points = rand.uniform(-1, 11, size = (300, 2))
+
+    def testMatchesBruteForce(self):
+        for leafSize in (2, 5, 16, 5000):
+            tree = KDTree(self.pos, leafSize = leafSize)
+            (offsets, indices) = tree.query_radius(self.points, 0.4)
+            self.assertEqual(_bruteRadius(self.pos, self.points, 0.4),
+                             _rows(offsets, indices))
+
+    def testDistances(self):
+        tree = KDTree(self.pos)
+        (offsets, indices, dist) = tree.query_radius(self.points, 0.4,
+                                                     return_distance = True)
+        for i in range(len(self.points)):
+            part = slice(offsets[i], offsets[i+1])
+            expected = numpy.sqrt(((self.pos[indices[part]] -
+                                    self.points[i])**2).sum(axis = 1))
+            self.failUnless(numpy.allclose(expected, dist[part]))
+
+    def testSmallChunks(self):
+        tree = KDTree(self.pos)
+        tree.chunkSize = 7
+        (offsets, indices) = tree.query_radius(self.points, 0.3)
+        self.assertEqual(_bruteRadius(self.pos, self.points, 0.3),
+                         _rows(offsets, indices))
+
+    def testDegenerate(self):
+        pos = numpy.zeros((50, 2))
+        (offsets, indices) = KDTree(pos).query_radius([[0, 0], [1, 1]], 0.)
+        self.assertEqual([range(50), []], _rows(offsets, indices))
+
+        (offsets, indices) = KDTree(numpy.zeros((0, 2))).query_radius(
+            [[0, 0]], 1.)
+        self.assertEqual([[]], _rows(offsets, indices))
+
+        tree = KDTree(numpy.array([[1., 2.]]))
+        self.assertEqual([0], tree.findNeighbors([1, 2.5], 0.6))
+
+    def testThreeDimensions(self):
+        rand = numpy.random.RandomState(4)
+        pos = rand.normal(size = (500, 3))
+        points = rand.normal(size = (50, 3))
+        (offsets, indices) = KDTree(pos, leafSize = 4).query_radius(points, .5)
+        self.assertEqual(_bruteRadius(pos, points, .5),
+                         _rows(offsets, indices))
+
+    def testKnn(self):
+        for (leafSize, k) in ((2, 1), (8, 5), (16, 40), (5000, 3)):
+            tree = KDTree(self.pos, leafSize = leafSize)
+            (distances, indices) = tree.query_knn(self.points, k)
+            (bruteDist, bruteRows) = _bruteKnn(self.pos, self.points, k)
+            self.assertEqual(bruteRows.tolist(), indices.tolist())
+            self.failUnless(numpy.allclose(bruteDist, distances))
+
+        # a duplicate of a point is still its neighbour, at distance 0
+        pos = numpy.concatenate([self.pos, self.pos[:1]])
+        (distances, indices) = KDTree(pos).query_knn(pos, 2,
+                                                     exclude_self = True)
+        self.assertEqual([2000, 0], [indices[0, 0], indices[2000, 0]])
+        self.assertEqual(_bruteKnn(pos, pos, 2, True)[1].tolist(),
+                         indices.tolist())
+
+        tree = KDTree(self.pos)
+        self.assertRaises(ValueError, lambda: tree.query_knn(self.points, 0))
+        self.assertRaises(ValueError,
+                          lambda: tree.query_knn(self.pos, 2000, True))
+
+###########
+
+class TestGridIndex(unittest.TestCase):
+
+    def setUp(self):
+        rand = numpy.random.RandomState(5)
+        self.pos = rand.uniform(0, 10, size = (2000, 2))
+        self.points = rand.uniform(-1, 11, size = (300, 2))
+
+    def testMatchesBruteForce(self):
+        for (cellSize, r) in ((0.4, 0.4), (1., 0.4), (0.15, 0.4)):
+            grid = GridIndex(self.pos, cellSize)
+            (offsets, indices) = grid.query_radius(self.points, r)
+            self.assertEqual(_bruteRadius(self.pos, self.points, r),
+                             _rows(offsets, indices))
+
+    def testSameAsTree(self):
+        tree = KDTree(self.pos).query_radius(self.points, 0.3,
+                                             return_distance = True)
+        grid = GridIndex(self.pos, 0.3).query_radius(self.points, 0.3,
+                                                     return_distance = True)
+        for (a, b) in zip(tree, grid):
+            self.failUnless(numpy.allclose(a, b))
+
+    def testThreeDimensions(self):
+        rand = numpy.random.RandomState(6)
+        pos = rand.normal(size = (500, 3))
+        points = rand.normal(size = (50, 3))
+        (offsets, indices) = GridIndex(pos, .5).query_radius(points, .5)
+        self.assertEqual(_bruteRadius(pos, points, .5),
+                         _rows(offsets, indices))
+
+    def testRadiusPerPoint(self):
+        r = numpy.linspace(0., 1., len(self.points))
+        for index in (KDTree(self.pos, leafSize = 4), GridIndex(self.pos, .3)):
+            (offsets, indices) = index.query_radius(self.points, r)
+            expected = [_bruteRadius(self.pos, [point], radius)[0]
+                        for (point, radius) in zip(self.points, r)]
+            self.assertEqual(expected, _rows(offsets, indices))
+        self.assertRaises(ValueError,
+                          lambda: index.query_radius(self.points, r[:10]))
+
+    def testEmpty(self):
+        grid = GridIndex(numpy.zeros((0, 2)), 1.)
+        (offsets, indices) = grid.query_radius([[0., 0.]], 1.)
+        self.assertEqual([[]], _rows(offsets, indices))
+
+    def testWorkers(self):
+        grid = GridIndex(self.pos, 0.3)
+        grid.chunkSize = 16
+        serial = grid.query_radius(self.points, 0.3, return_distance = True)
+        for workers in (2, 3):
+            parallel = grid.query_radius(self.points, 0.3,
+                                         return_distance = True,
+                                         workers = workers)
+            for (a, b) in zip(serial, parallel):
+                self.assertEqual(a.tolist(), b.tolist())
+
+        cat1 = Catalog(self.points[:,0], self.points[:,1], numpy.arange(300))
+        cat2 = Catalog(self.pos[:,0], self.pos[:,1], numpy.arange(2000))
+        matches = matchCatalogs(cat1, cat2, 0.3, workers = 2)
+        self.assertEqual(serial[1].tolist(), matches.indices.tolist())
+
+    def testKnn(self):
+        # clustered positions, so that some guesses fall short
+        pos = numpy.concatenate([self.pos, self.pos[:200] * 0.01])
+        for (cellSize, k) in ((0.3, 1), (0.05, 7)):
+            grid = GridIndex(pos, cellSize)
+            (distances, indices) = grid.query_knn(self.points, k)
+            (bruteDist, bruteRows) = _bruteKnn(pos, self.points, k)
+            self.assertEqual(bruteRows.tolist(), indices.tolist())
+            self.failUnless(numpy.allclose(bruteDist, distances))
+
+        (distances, indices) = grid.query_knn(pos, 3, exclude_self = True)
+        self.assertEqual(_bruteKnn(pos, pos, 3, True)[1].tolist(),
+                         indices.tolist())
+
+    def testFarQueries(self):
+        # far outside the grid, the cells around a point are not searched
+        # one by one
+        points = numpy.array([[5., 210.], [-150., -150.], [5., 5.]])
+        grid = GridIndex(self.pos, 0.1)
+        self.failUnless(grid.tree is None)
+        (distances, indices) = grid.query_knn(points, 4)
+        self.failIf(grid.tree is None)
+        (bruteDist, bruteRows) = _bruteKnn(self.pos, points, 4)
+        self.assertEqual(bruteRows.tolist(), indices.tolist())
+        self.failUnless(numpy.allclose(bruteDist, distances))
+
+        (offsets, indices) = grid.query_radius(points, 201.)
+        self.assertEqual(_bruteRadius(self.pos, points, 201.),
+                         _rows(offsets, indices))
+
+    def testConcurrentWorkers(self):
+        # queries from two threads, each shared among forked workers
+        grids = [GridIndex(self.pos, 0.3), GridIndex(self.pos[::-1], 0.2)]
+        results = [None, None]
+        def query(i):
+            grids[i].chunkSize = 16
+            results[i] = grids[i].query_radius(self.points, 0.3 - 0.1 * i,
+                                               workers = 2)
+        threads = [threading.Thread(target = query, args = (i,))
+                   for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(2):
+            grids[i].chunkSize = 8192
+            serial = grids[i].query_radius(self.points, 0.3 - 0.1 * i)
+            self.assertEqual(serial[1].tolist(), results[i][1].tolist())
+
+    def testEngines(self):
+        self.assertRaises(ValueError,
+                          lambda: buildIndex(self.pos, 0.1, 'octree'))
+        self.failUnless(isinstance(buildIndex(self.pos, 0.1, 'grid'),
+                                   GridIndex))
+
+###########
+
+class TestMatchCatalogs(unittest.TestCase):
+
+    def testMatch(self):
+        cat1 = Catalog(numpy.array([0., 1., 5.]), numpy.array([0., 0., 5.]),
+                       numpy.array([10, 11, 12]))
+        cat2 = Catalog(numpy.array([0.1, 0.9, 1.05, 9.]),
+                       numpy.array([0., 0., 0., 9.]),
+                       numpy.array([20, 21, 22, 23]))
+        matches = matchCatalogs(cat1, cat2, 0.2)
+        (cat1Index, cat2Index) = matches.toDicts(cat1.id, cat2.id)
+        self.assertEqual({10 : [20], 11 : [21, 22], 12 : []}, cat1Index)
+        self.assertEqual({20 : [10], 21 : [11], 22 : [11], 23 : []},
+                         cat2Index)
+        grid = matchCatalogs(cat1, cat2, 0.2, engine = 'grid')
+        self.assertEqual((cat1Index, cat2Index),
+                         grid.toDicts(cat1.id, cat2.id))
+
+        self.assertEqual([0, 1, 3, 3], matches.offsets.tolist())
+        self.assertEqual([0, 1, 2], matches.indices.tolist())
+        self.failUnless(numpy.allclose([.1, .1, .05], matches.distances))
+        self.assertEqual([0, 2, -1], matches.best().tolist())
+        noDist = matchCatalogs(cat1, cat2, 0.2, distances = False)
+        self.assertEqual(None, noDist.distances)
+        self.assertRaises(ValueError, noDist.best)
+
+    def testTranspose(self):
+        matches = Matches(numpy.array([0, 2, 3, 3]),
+                          numpy.array([1, 2, 1]), 4,
+                          numpy.array([.1, .2, .3]))
+        back = matches.transpose()
+        self.assertEqual([0, 0, 2, 3, 3], back.offsets.tolist())
+        self.assertEqual([0, 1, 0], back.indices.tolist())
+        self.assertEqual([.1, .3, .2], back.distances.tolist())
+        self.assertEqual([[0, 0, 1], [1, 2, 1]],
+                         [a.tolist() for a in matches.pairs()])
+
+    def testOneToOne(self):
+        # row 0 of the first catalog is closest to 0 and 1; row 1 is
+        # closest to 0 but loses it to row 0
+        matches = Matches(numpy.array([0, 2, 4, 5]),
+                          numpy.array([0, 1, 0, 1, 2]), 4,
+                          numpy.array([.1, .2, .15, .5, .4]))
+        self.assertEqual([0, 0, 2], matches.best().tolist())
+        (match1, match2) = matches.oneToOne()
+        self.assertEqual([0, 1, 2], match1.tolist())
+        self.assertEqual([0, 1, 2, -1], match2.tolist())
+
+    def testOneToOneGreedy(self):
+        rand = numpy.random.RandomState(8)
+        pos1 = rand.uniform(0, 5, size = (300, 2))
+        pos2 = rand.uniform(0, 5, size = (300, 2))
+        cat1 = Catalog(pos1[:,0], pos1[:,1], numpy.arange(300))
+        cat2 = Catalog(pos2[:,0], pos2[:,1], numpy.arange(300))
+        matches = matchCatalogs(cat1, cat2, 0.4)
+        (match1, match2) = matches.oneToOne()
+
+        # the same pairing, made one pair at a time
+        (rows1, rows2) = matches.pairs()
+        expected = -numpy.ones(300, dtype = int)
+        taken = set()
+        for k in numpy.argsort(matches.distances, kind = 'mergesort'):
+            if expected[rows1[k]] < 0 and rows2[k] not in taken:
+                expected[rows1[k]] = rows2[k]
+                taken.add(rows2[k])
+        self.assertEqual(expected.tolist(), match1.tolist())
+        for (i, j) in enumerate(match1):
+            if j >= 0:
+                self.assertEqual(i, match2[j])
+
+    def testFilter(self):
+        cat = Catalog(numpy.arange(5.), numpy.arange(5.) * 2,
+                      numpy.arange(5))
+        sub = cat.filter(cat.pos[:,0] > 2)
+        self.assertEqual(2, len(sub))
+        self.assertEqual([3, 4], sub.id.tolist())
+        self.assertEqual([6., 8.], sub.pos[:,1].tolist())
+
+    def testFindNeighbors(self):
+        cat = Catalog(numpy.arange(5.), numpy.zeros(5),
+                      numpy.array(['a', 'b', 'c', 'd', 'e']))
+        self.assertEqual(['b', 'c', 'd'],
+                         buildTrie(cat).findNeighbors([2., 0.1], 1.1))
+
+
+###########
+
+def _separation(ra1, dec1, ra2, dec2):
+    '''Haversine separation in arcsec.'''
+    (ra1, dec1, ra2, dec2) = [numpy.radians(x) for x in (ra1, dec1, ra2, dec2)]
+    h = numpy.sin((dec2 - dec1) / 2)**2 + \
+        numpy.cos(dec1) * numpy.cos(dec2) * numpy.sin((ra2 - ra1) / 2)**2
+    return 3600 * numpy.degrees(2 * numpy.arcsin(numpy.sqrt(h)))
+
+class TestSky(unittest.TestCase):
+
+    def setUp(self):
+        # a patch straddling RA = 0, and one around the north pole
+        rand = numpy.random.RandomState(9)
+        ra = numpy.concatenate([rand.uniform(-0.02, 0.02, 400) % 360,
+                                rand.uniform(0, 360, 400)])
+        dec = numpy.concatenate([rand.uniform(-0.02, 0.02, 400),
+                                 rand.uniform(89.98, 90, 400)])
+        self.ref = SkyCatalog(ra, dec, numpy.arange(800))
+        ra = ra + rand.normal(scale = 1e-4, size = 800)
+        dec = numpy.minimum(dec + rand.normal(scale = 1e-4, size = 800), 90)
+        self.cat = SkyCatalog(ra % 360, dec, numpy.arange(800))
+
+    def brute(self, r):
+        return [numpy.nonzero(_separation(ra, dec, self.ref.ra,
+                                          self.ref.dec) <= r)[0].tolist()
+                for (ra, dec) in zip(self.cat.ra, self.cat.dec)]
+
+    def testMatchesBruteForce(self):
+        for engine in ('kdtree', 'grid'):
+            matches = matchCatalogs(self.cat, self.ref, 2., engine = engine)
+            self.assertEqual(self.brute(2.),
+                             [matches.neighbors(i).tolist()
+                              for i in range(len(self.cat))])
+            (rows1, rows2) = matches.pairs()
+            expected = _separation(self.cat.ra[rows1], self.cat.dec[rows1],
+                                   self.ref.ra[rows2], self.ref.dec[rows2])
+            self.failUnless(numpy.allclose(expected, matches.distances,
+                                           atol = 1e-6))
+
+    def testWrapAndPole(self):
+        index = SkyIndex([359.9999, 0., 123.], [0., 89.9999, 89.9999],
+                         tolerance = 1., engine = 'grid')
+        (offsets, indices, dist) = index.query_radius(
+            [0.0001, 303.], [0., 89.9999], 1., return_distance = True)
+        self.assertEqual([[0], [1, 2]], _rows(offsets, indices))
+        # 0.0001 deg from the pole, 57 and 180 degrees of RA apart
+        self.failUnless(numpy.allclose([0.72, 0.72 * numpy.sin(
+                        numpy.radians(57. / 2)), 0.72], dist, atol = 0.001))
+
+    def testKnn(self):
+        for engine in ('kdtree', 'grid'):
+            index = SkyIndex(self.ref.ra, self.ref.dec, 5., engine)
+            (arcsec, indices) = index.query_knn(self.cat.ra, self.cat.dec, 3)
+            for i in range(0, 800, 37):
+                sep = _separation(self.cat.ra[i], self.cat.dec[i],
+                                  self.ref.ra, self.ref.dec)
+                self.assertEqual(numpy.argsort(sep)[:3].tolist(),
+                                 indices[i].tolist())
+                self.failUnless(numpy.allclose(numpy.sort(sep)[:3],
+                                               arcsec[i], atol = 1e-6))
+
+    def testMixedCatalogs(self):
+        flat = Catalog(numpy.zeros(2), numpy.zeros(2), numpy.arange(2))
+        self.assertRaises(TypeError,
+                          lambda: matchCatalogs(flat, self.ref, 1.))
+        self.assertEqual([1, 2], self.ref.filter(
+                numpy.array([1, 2])).id.tolist())
+
+
+###########
+
+class TestStreamMatch(unittest.TestCase):
+
+    def setUp(self):
+        rand = numpy.random.RandomState(10)
+        self.pos1 = rand.uniform(0, 20, size = (700, 2))
+        self.pos2 = rand.uniform(5, 25, size = (900, 2))
+        self.pos2[::3] = self.pos1[:300:1] + 0.01
+
+        self.textfile = 'streamtest.cat'
+        output = open(self.textfile, 'w')
+        output.write('# header: 1\n# text 1 1 history made up\n')
+        output.write('# contents: 3\n# number 1 1 id\n')
+        output.write('# number 1 2 x\n# number 1 1 mag\n')
+        for (i, (x, y)) in enumerate(self.pos1):
+            output.write('%d %.17g %.17g 21.5\n' % (i, x, y))
+        output.close()
+        self.npyfiles = ['streamtest_x.npy', 'streamtest_y.npy']
+        numpy.save(self.npyfiles[0], self.pos2[:,0])
+        numpy.save(self.npyfiles[1], self.pos2[:,1])
+
+    def tearDown(self):
+        for filename in [self.textfile] + self.npyfiles:
+            os.remove(filename)
+
+    def collect(self, blocks):
+        blocks = list(blocks)
+        rows1 = numpy.concatenate([b[0] for b in blocks])
+        rows2 = numpy.concatenate([b[1] for b in blocks])
+        dist = numpy.concatenate([b[2] for b in blocks])
+        order = numpy.lexsort((rows2, rows1))
+        return (len(blocks), rows1[order], rows2[order], dist[order])
+
+    def testReaders(self):
+        chunks = list(TextCatalogReader(self.textfile, ['x'],
+                                        chunkRows = 100).chunks())
+        self.assertEqual(7, len(chunks))
+        self.failUnless((numpy.concatenate(chunks) == self.pos1).all())
+        chunks = list(TextCatalogReader(self.textfile, [3, 'id'],
+                                        chunkRows = 1000).chunks())
+        self.assertEqual([21.5, 0], chunks[0][0].tolist())
+        self.assertRaises(KeyError,
+                          lambda: TextCatalogReader(self.textfile, ['y']))
+        chunks = list(ArrayCatalogReader(self.npyfiles, 256).chunks())
+        self.assertEqual([256, 256, 256, 132], [len(c) for c in chunks])
+
+    def testMatchesInMemory(self):
+        for engine in ('grid', 'kdtree'):
+            (nblocks, rows1, rows2, dist) = self.collect(streamMatch(
+                    TextCatalogReader(self.textfile, ['x'], chunkRows = 90),
+                    ArrayCatalogReader(self.npyfiles, chunkRows = 110),
+                    0.3, tileRows = 60, engine = engine))
+            self.failUnless(nblocks > 4)
+            cat1 = Catalog(self.pos1[:,0], self.pos1[:,1], numpy.arange(700))
+            cat2 = Catalog(self.pos2[:,0], self.pos2[:,1], numpy.arange(900))
+            matches = matchCatalogs(cat1, cat2, 0.3)
+            (expected1, expected2) = matches.pairs()
+            self.assertEqual(expected1.tolist(), rows1.tolist())
+            self.assertEqual(expected2.tolist(), rows2.tolist())
+            self.failUnless(numpy.allclose(matches.distances, dist))
+
+    def testSky(self):
+        rand = numpy.random.RandomState(11)
+        ra = rand.uniform(-0.05, 0.05, 500) % 360
+        dec = rand.uniform(-0.05, 0.05, 500)
+        cat1 = SkyCatalog(ra, dec, numpy.arange(500))
+        cat2 = SkyCatalog((ra + 1e-4) % 360, dec, numpy.arange(500))
+        (nblocks, rows1, rows2, dist) = self.collect(streamMatch(
+                ArrayCatalogReader([ra, dec], chunkRows = 64),
+                ArrayCatalogReader([cat2.ra, cat2.dec], chunkRows = 64),
+                20., sky = True, tileRows = 50))
+        self.failUnless(nblocks > 1)
+        matches = matchCatalogs(cat1, cat2, 20.)
+        self.assertEqual(matches.pairs()[1].tolist(), rows2.tolist())
+        self.failUnless(numpy.allclose(matches.distances, dist))
+
+    def testEmpty(self):
+        empty = ArrayCatalogReader([numpy.zeros(0), numpy.zeros(0)])
+        self.assertEqual([], list(streamMatch(empty, empty, 1.)))
+
+
+###########
+
+class TestIndexFile(unittest.TestCase):
+
+    def setUp(self):
+        rand = numpy.random.RandomState(11)
+        self.pos = rand.uniform(0, 10, size = (2000, 2))
+        self.points = rand.uniform(-1, 11, size = (300, 2))
+        self.filename = 'indextest.idx'
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def corrupt(self, offset, value):
+        output = open(self.filename, 'r+b')
+        output.seek(offset)
+        output.write(value)
+        output.close()
+
+    def testRoundTrip(self):
+        for index in (KDTree(self.pos, leafSize = 8, ids = numpy.arange(2000)),
+                      GridIndex(self.pos, 0.3),
+                      GridIndex(self.pos, 0.05)):
+            index.save(self.filename, source = self.pos)
+            loaded = loadIndex(self.filename, verify = True,
+                               source = self.pos)
+            self.assertEqual(type(index), type(loaded))
+            self.failIf(loaded.data.flags.writeable)
+            for (a, b) in zip(index.query_radius(self.points, 0.3, True),
+                              loaded.query_radius(self.points, 0.3, True)):
+                self.assertEqual(a.tolist(), b.tolist())
+            self.assertEqual(index.findNeighbors([5., 5.], 0.5),
+                             loaded.findNeighbors([5., 5.], 0.5))
+
+    def testSkyAndEmpty(self):
+        sky = SkyIndex(self.pos[:,0], self.pos[:,1] - 5, ids = self.pos[:,0])
+        saveIndex(sky, self.filename)
+        loaded = loadIndex(self.filename)
+        self.failUnless(isinstance(loaded, SkyIndex))
+        for (a, b) in zip(sky.query_radius([1., 2.], [0., 3.], 3600.),
+                          loaded.query_radius([1., 2.], [0., 3.], 3600.)):
+            self.assertEqual(a.tolist(), b.tolist())
+
+        KDTree(numpy.zeros((0, 2))).save(self.filename)
+        loaded = loadIndex(self.filename, verify = True)
+        self.assertEqual(0, len(loaded))
+        self.assertEqual([], loaded.findNeighbors([0., 0.], 1.))
+
+    def testFileMode(self):
+        umask = os.umask(022)
+        try:
+            KDTree(self.pos).save(self.filename)
+        finally:
+            os.umask(umask)
+        self.assertEqual(0644, os.stat(self.filename).st_mode & 0777)
+
+    def testStale(self):
+        KDTree(self.pos).save(self.filename, source = 'ref.cat 1234')
+        loadIndex(self.filename, source = 'ref.cat 1234')
+        self.assertRaises(ValueError, lambda:
+                              loadIndex(self.filename, source = 'ref.cat 99'))
+
+    def testDamaged(self):
+        GridIndex(self.pos, 0.3).save(self.filename)
+        size = os.path.getsize(self.filename)
+
+        # a flipped byte in the arrays is only found when verifying
+        self.corrupt(size - 1, 'x')
+        loadIndex(self.filename)
+        self.assertRaises(ValueError, lambda:
+                              loadIndex(self.filename, verify = True))
+
+        self.corrupt(_PREFIX.size + 2, '#')
+        self.assertRaises(ValueError, lambda: loadIndex(self.filename))
+
+        GridIndex(self.pos, 0.3).save(self.filename)
+        self.corrupt(8, struct.pack('<I', FORMAT_VERSION + 1))
+        self.assertRaises(ValueError, lambda: loadIndex(self.filename))
+
+        GridIndex(self.pos, 0.3).save(self.filename)
+        output = open(self.filename, 'r+b')
+        output.truncate(size - 8)
+        output.close()
+        self.assertRaises(ValueError, lambda: loadIndex(self.filename))
+
 
+###########
 
-    
+if __name__ == '__main__':
+    suites = []
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(TestKDTree))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(TestGridIndex))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase( \
+            TestMatchCatalogs))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(TestSky))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase( \
+            TestStreamMatch))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase( \
+            TestIndexFile))
+    unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(suites))
@@ -5,13 +5,113 @@
 
    Provides a framework for autorecovery, and rerunning, of parts of the 
    pipeline
+
+   If a Journal (or a filename for one) is passed to run() or runPipeline(),
+   the storage keys each savepoint assigned or deleted are appended to it
+   on disk as soon as the savepoint finishes. Running again with the same
+   journal, and no explicit resume, restores those keys into storage and
+   skips every savepoint up to and including the last one that finished.
+   Only assignments and deletions of storage keys are journaled, not
+   in-place changes to stored objects. Journaled storage must be a dict
+   (or act like one).
+
+   Stages can also declare what they depend on, and be run as a graph
+   rather than in the order run() calls them:
+
+       class Photometry(Pipeline):
+           @savepoint
+           def detect(self): ...
+           @savepoint(after=['detect'])
+           def photometerB(self): ...
+           @savepoint(after=['detect'])
+           def photometerV(self): ...
+           @branchingsavepoint(after=['photometerB', 'photometerV'])
+           def haveColours(self): ...
+           @savepoint(after=['haveColours'])
+           def colourCut(self): ...
+
+       Photometry().run(storage, workers=8)     # or processes=True
+
+   A Pipeline without its own _run() calls runStages(), which starts every
+   stage as soon as all of its dependencies have finished, on up to
+   workers threads, or forked processes which send their storage changes
+   back to the parent. The two are not mixed: with processes=True no
+   threads are started, so stages are always forked from a single-threaded
+   parent. A branchingsavepoint that returns False prunes
+   everything downstream of it. resume=name skips the stages that come
+   before name in (definition-ordered) topological order, and a journal
+   skips every stage it records, as in linear pipelines. Concurrent stages
+   share storage, so they should write to different keys.
+
+   Stages that name the storage keys they read can be memoized:
+
+       @savepoint(inputs=['catalog', 'pixelScale'])
+       def measureShapes(self): ...
+
+       runPipeline(pipeline, storage, cache='stagecache')
+
+   Such a stage is looked up in the cache under a hash of those inputs,
+   its arguments and its code; if found, its storage changes (and return
+   value) are restored rather than recomputed. The cache directory is
+   trimmed to StageCache.maxBytes, least recently used first, and can be
+   inspected or purged with stagecache.py.
+
+   Every stage that runs (or is restored from the cache) appends a dict
+   to pipeline.metrics: stage, start, wall and cpu seconds, peakRSSDelta
+   (bytes by which the peak resident size of the process, or of the
+   largest of its finished child processes, grew), bytesWritten
+   (through self[key] = value) and cached. Only arrays and strings are
+   counted in bytesWritten, unless the pipeline's pickleSizes is set, which
+   counts anything else by the size of its pickle (at the cost of pickling
+   every write). Save them after a run with
+
+       pipeline.saveMetrics('metrics.json')     # or .csv
+
+   CPU time and peak RSS are process-wide (including finished child
+   processes), so they overlap between stages that run concurrently.
+
+   Many runs of one pipeline can share a pool of worker processes:
+
+       jobs = [({'cluster' : name}, {'zmin' : 0.2}) for name in clusters]
+       results = runBatch(MyPipeline, jobs, processes = 8, retries = 2,
+                          journalDir = 'journals')
+       print batchReport(results)
+
+   Each job is (storage, keywords) as runPipeline would take them, or
+   (storage, keywords, name); storage is a dict (updated in place with the
+   job's final storage) or a picklable callable that opens the storage in
+   the worker, such as functools.partial(pytableshelf.open, 'cluster1.h5').
+   A failed job is rerun up to retries times; with a journalDir, each job
+   is journaled there under its name (by default a hash of its storage and
+   keywords), so a rerun, even by a later runBatch over a reordered job
+   list, resumes after its last finished stage. The journal of a job that
+   finishes is removed.
+
+   Storage can be any dict-like object. When intermediate results would
+   not fit in memory, pytableshelf.SpillStorage keeps to a memory budget
+   by moving the least recently used large values to a temporary HDF5
+   file, and reads them back when a stage uses them again.
 '''
 
 __cvs_id__ = "$Id: pipeline.py,v 1.1 2008-01-17 19:12:38 dapple Exp $"
 
 ################
 
+import UserDict
+import Queue
+import cPickle
+import csv
+import hashlib
+import json
 import logging
+import multiprocessing
+import os
+import resource
+import sys
+import thread
+import threading
+import time
+import traceback
 from decorator import decorator
 
 log = logging.getLogger('shearpipeline.pipeline')
@@ -21,9 +121,16 @@ log = logging.getLogger('shearpipeline.pipeline')
 
 class Pipeline(object):
 
+    # count writes of values other than arrays and strings by pickling them
+    pickleSizes = False
+
     def __init__(self):
         self.storage = None
         self.resume = None
+        self.resumeAfter = None
+        self.journal = None
+        self.cache = None
+        self.metrics = []
 
     #########################
 
@@ -34,74 +141,1036 @@ class Pipeline(object):
 
     def __setitem__(self,key,value):
         self.storage[key] = value
+        self._countWrites([value])
+
+    ##########################
+
+    def _countWrites(self, values):
+        '''Add the size of values to the bytes written by the stage
+           running in this thread.'''
+
+        local = self.__dict__.get('_stageLocal')
+        if local is None or getattr(local, 'written', None) is None:
+            return
+        local.written += sum([_sizeof(value, self.pickleSizes)
+                              for value in values])
 
     ##########################
 
     def run(self, storage = None, resume = None,
                     *args, **keywords):
+        '''Keywords journal, cache, workers and processes are taken by
+           run(); the rest are passed to _run().'''
 
+        journal = keywords.pop('journal', None)
+        cache = keywords.pop('cache', None)
         if storage is not None:
             self.storage = storage
         elif self.storage is None:
             self.storage = {}
-        self.resume = resume
+        # without new storage, e.g. when called by runPipeline, an
+        # existing resume point stands unless a new one is given
+        if storage is not None or resume is not None:
+            self.resume = resume
+        self.metrics = []
+        if journal is not None:
+            self.useJournal(journal)
+        if cache is not None:
+            self.useCache(cache)
         return self._run(*args, **keywords)
 
+    ##########################
+
+    def _run(self, workers = None, processes = False):
+        self.runStages(workers = workers, processes = processes)
+
+    ##########################
+
+    def useJournal(self, journal):
+        '''Record finished savepoints in journal, after restoring storage
+           from it and, unless a resume point was given, arranging to
+           skip the savepoints it records.'''
+
+        if isinstance(journal, basestring):
+            journal = Journal(journal)
+        self.journal = journal
+
+        lastStage = journal.replay(self.storage)
+        if self.resume is None:
+            self.resumeAfter = lastStage
+        if not isinstance(self.storage, TrackedStorage):
+            self.storage = TrackedStorage(self.storage)
+
+    ##########################
+
+    def saveMetrics(self, filename, format = None):
+        '''Write self.metrics to filename as format 'json' or 'csv'
+           (by default, whichever the filename ends with).'''
+
+        if format is None:
+            format = os.path.splitext(filename)[1][1:].lower()
+        if format not in ('json', 'csv'):
+            raise ValueError, "Unknown metrics format: %s" % format
+
+        output = file(filename, 'wb')
+        try:
+            if format == 'json':
+                json.dump(self.metrics, output, indent = 1)
+            else:
+                writer = csv.DictWriter(output, metricsFields)
+                writer.writerow(dict(zip(metricsFields, metricsFields)))
+                writer.writerows(self.metrics)
+        finally:
+            output.close()
+
+    ##########################
+
+    def useCache(self, cache):
+        '''Restore stages that declare their inputs from cache (a
+           StageCache or a directory name) when those inputs are
+           unchanged, and save their outputs there when they run.'''
+
+        if isinstance(cache, basestring):
+            cache = StageCache(cache)
+        self.cache = cache
+        if not isinstance(self.storage, TrackedStorage):
+            self.storage = TrackedStorage(self.storage)
+
+    ##########################
+
+    def stages(self):
+        '''All savepoints and branchingsavepoints of this pipeline, as
+           a dict of name -> decorated method.'''
+
+        stages = {}
+        for name in dir(type(self)):
+            method = getattr(type(self), name, None)
+            if getattr(method, 'stageFunction', None) is not None:
+                stages[name] = getattr(self, name)
+        return stages
+
+    ##########################
+
+    def stageOrder(self):
+        '''Stage names in topological order of their dependencies, ties
+           broken by where the stages are defined.'''
+
+        stages = self.stages()
+        for (name, method) in stages.iteritems():
+            for dep in method.after:
+                if dep not in stages:
+                    raise ValueError, "%s depends on unknown stage %s" % \
+                        (name, dep)
+
+        def position(name):
+            code = stages[name].stageFunction.func_code
+            return (code.co_filename, code.co_firstlineno, name)
+
+        order = []
+        placed = set()
+        remaining = sorted(stages.keys(), key = position)
+        while remaining:
+            for name in remaining:
+                if set(stages[name].after) <= placed:
+                    break
+            else:
+                raise ValueError, "Stage dependencies form a cycle: %s" % \
+                    ', '.join(remaining)
+            order.append(name)
+            placed.add(name)
+            remaining.remove(name)
+        return order
+
+    ##########################
+
+    def runStages(self, workers = None, processes = False):
+        '''Run every stage once its dependencies are done, up to workers
+           at a time, on threads or (processes = True) processes forked
+           from this thread.'''
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if not isinstance(self.storage, TrackedStorage):
+            self.storage = TrackedStorage(self.storage)
+
+        stages = self.stages()
+        order = self.stageOrder()
+
+        skip = set()
+        if self.resume is not None:
+            if self.resume in stages:
+                skip.update(order[:order.index(self.resume)])
+            else:
+                # as in a linear run, an unknown resume point skips all
+                skip.update(order)
+        elif self.journal is not None:
+            skip.update(self.journal.stages())
+        self.resume = None
+        self.resumeAfter = None
+
+        # name -> 'done', 'false' (a branch that said no) or 'pruned'
+        state = {}
+        started = set()
+        finished = Queue.Queue()
+        # name -> (process, receiver, start) of stages run in processes
+        forked = {}
+        running = 0
+        failure = None
+
+        while True:
+            changed = True
+            while changed:
+                changed = False
+                for name in order:
+                    if name in state or name in started:
+                        continue
+                    method = stages[name]
+                    if [dep for dep in method.after if dep not in state]:
+                        continue
+                    if [dep for dep in method.after \
+                            if state[dep] != 'done']:
+                        log.log(20, '%s pruned.' % name)
+                        state[name] = 'pruned'
+                        changed = True
+                    elif name in skip and not method.branching:
+                        log.log(20, '%s already complete. Skipping.' % name)
+                        state[name] = 'done'
+                        changed = True
+                    elif failure is None and running < workers:
+                        started.add(name)
+                        running += 1
+                        if processes:
+                            self._forkStage(name, forked, finished)
+                        else:
+                            thread = threading.Thread(
+                                target = self._stageWorker,
+                                args = (name, finished))
+                            thread.setDaemon(True)
+                            thread.start()
+
+            if running == 0:
+                break
+
+            # waits in short steps, which unlike a bare get() can be
+            # interrupted
+            while True:
+                self._collectForked(forked, finished)
+                try:
+                    (name, result, error) = finished.get(True, 0.05)
+                    break
+                except Queue.Empty:
+                    pass
+            running -= 1
+            if error is not None:
+                if failure is None:
+                    failure = error
+                state[name] = 'pruned'
+            elif stages[name].branching and not result:
+                state[name] = 'false'
+            else:
+                state[name] = 'done'
+
+        if failure is not None:
+            raise failure
+
+    ##########################
+
+    def _stageWorker(self, name, finished, runner = None, start = None):
+        '''Run stage name and put (name, result, error) on finished.
+           Anything it raises, even KeyboardInterrupt or SystemExit, is
+           passed on as its error.'''
+
+        try:
+            method = getattr(self, name)
+            result = _runStage(self, method.stageFunction, method.branching,
+                               (self,), {}, runner, start)
+            finished.put((name, result, None))
+        except BaseException, e:
+            log.log(40, 'Stage %s failed: %s' % (name, e))
+            finished.put((name, None, e))
+
+    ##########################
+
+    def _forkStage(self, name, forked, finished):
+        '''Start stage name in a forked process, adding it to forked; a
+           stage the cache can restore is restored straight away.'''
+
+        f = getattr(self, name).stageFunction
+        cache = getattr(self, 'cache', None)
+        if cache is not None:
+            key = _stageKey(self, f, (), {})
+            if key is not None and os.path.exists(cache._path(key)):
+                self._stageWorker(name, finished)
+                return
+
+        start = _usage()
+        (process, receiver) = self._startProcess(f)
+        forked[name] = (process, receiver, start)
+
+    ##########################
+
+    def _collectForked(self, forked, finished):
+        '''Finish the stages in forked whose processes have sent back their
+           results (or died).'''
+
+        for (name, (process, receiver, start)) in forked.items():
+            if not receiver.poll():
+                continue
+            del forked[name]
+            f = getattr(self, name).stageFunction
+            runner = lambda: self._finishProcess(f, process, receiver)
+            self._stageWorker(name, finished, runner, start)
+
+    ##########################
+
+    def _startProcess(self, f):
+        '''Fork a process that runs f(self) and sends back its result and
+           storage changes; returns (process, receiver).'''
+
+        (receiver, sender) = multiprocessing.Pipe(False)
+
+        def child():
+            try:
+                self.storage.changes()
+                result = f(self)
+                (assigned, deleted) = self.storage.changes()
+                sender.send((None, (result, assigned, deleted)))
+            except Exception, e:
+                sender.send((traceback.format_exc(), None))
+
+        process = multiprocessing.Process(target = child)
+        process.start()
+        # only the child may write, so its death ends the pipe
+        sender.close()
+        return (process, receiver)
+
+    ##########################
+
+    def _finishProcess(self, f, process, receiver):
+        '''Wait for the process of _startProcess, apply the storage
+           changes it made here, and return its result.'''
+
+        try:
+            (error, result) = receiver.recv()
+        except EOFError:
+            error = 'Subprocess died with exit code %s' % process.exitcode
+        process.join()
+        receiver.close()
+        if error is not None:
+            raise RuntimeError, "Stage %s failed:\n%s" % (f.__name__, error)
+        (result, assigned, deleted) = result
+        _applyChanges(self.storage, assigned, deleted)
+        self._countWrites(assigned.values())
+        return result
+
 
 #########################################
 
-@decorator
-def branchingsavepoint(f, *args, **kw):
+class TrackedStorage(UserDict.DictMixin):
+    '''Wraps pipeline storage, remembering which keys have been assigned
+       or deleted since the last call to changes().'''
+
+    def __init__(self, storage):
+        self.storage = storage
+        # each thread (i.e. each concurrently running stage) is tracked
+        # separately
+        self.local = threading.local()
+
+    def _changed(self):
+        if not hasattr(self.local, 'changed'):
+            self.local.changed = set()
+        return self.local.changed
+
+    def __getitem__(self, key):
+        return self.storage[key]
+
+    def __setitem__(self, key, value):
+        self.storage[key] = value
+        self._changed().add(key)
+
+    def __delitem__(self, key):
+        del self.storage[key]
+        self._changed().add(key)
+
+    def has_key(self, key):
+        return key in self.storage
+
+    __contains__ = has_key
+
+    def keys(self):
+        return self.storage.keys()
+
+    def changes(self):
+        '''Returns (assigned, deleted): a dict of the keys this thread
+           assigned since its last call, with their current values, and a
+           list of the keys it deleted.'''
+        assigned = {}
+        deleted = []
+        for key in self._changed():
+            if key in self.storage:
+                assigned[key] = self.storage[key]
+            else:
+                deleted.append(key)
+        self.local.changed = set()
+        return (assigned, deleted)
+
+    def touch(self, keys):
+        '''Mark keys as changed by this thread.'''
+        self._changed().update(keys)
+
+
+#########################################
+
+class Journal(object):
+    '''Append-only log of finished savepoints, one pickled
+       (stage name, assigned, deleted) record per savepoint.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    ##########################
+
+    def records(self):
+        '''Read back all complete records. A record cut short by a crash
+           is dropped from the file.'''
+
+        if not os.path.exists(self.filename):
+            return []
+
+        records = []
+        input = file(self.filename, 'rb')
+        try:
+            good = 0
+            while True:
+                try:
+                    records.append(cPickle.load(input))
+                    good = input.tell()
+                except EOFError:
+                    break
+                except (cPickle.UnpicklingError, ValueError,
+                        AttributeError, IndexError):
+                    log.log(30, 'Truncating damaged journal %s' % \
+                                self.filename)
+                    break
+        finally:
+            input.close()
+
+        if good != os.path.getsize(self.filename):
+            output = file(self.filename, 'r+b')
+            try:
+                output.truncate(good)
+            finally:
+                output.close()
+
+        return records
+
+    ##########################
+
+    def replay(self, storage):
+        '''Apply every record to storage; returns the name of the last
+           finished stage, or None for an empty journal.'''
+
+        lastStage = None
+        for (stage, assigned, deleted) in self.records():
+            storage.update(assigned)
+            for key in deleted:
+                if key in storage:
+                    del storage[key]
+            lastStage = stage
+        return lastStage
+
+    ##########################
+
+    def stages(self):
+        '''Names of all stages the journal records as finished.'''
+        return set([stage for (stage, assigned, deleted) in self.records()])
+
+    ##########################
+
+    def record(self, stage, assigned, deleted):
+
+        with self.lock:
+            output = file(self.filename, 'ab')
+            try:
+                cPickle.dump((stage, assigned, deleted), output,
+                             cPickle.HIGHEST_PROTOCOL)
+                output.flush()
+                os.fsync(output.fileno())
+            finally:
+                output.close()
+
+    ##########################
+
+    def clear(self):
+
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+#########################################
+
+def _finishStage(self, f_name, branching, result):
+
+    journal = getattr(self, 'journal', None)
+    if journal is not None and not branching:
+        (assigned, deleted) = self.storage.changes()
+        journal.record(f_name, assigned, deleted)
+
+    if branching:
+        log.log(20, 'Returning %s' % str(result))
+    else:
+        log.log(20,'Done.')
+    return result
+
+#########################################
+
+def _applyChanges(storage, assigned, deleted):
+
+    for (key, value) in assigned.iteritems():
+        storage[key] = value
+    for key in deleted:
+        if key in storage:
+            del storage[key]
+
+#########################################
+
+def _codeDigest(code, digest):
+
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names))
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            _codeDigest(const, digest)
+        else:
+            digest.update(repr(const))
+
+#########################################
+
+def _stageKey(self, f, args, kw):
+    '''Hash of the stage's code, arguments and declared storage inputs,
+       or None if the stage declares no inputs or they cannot be
+       pickled.'''
+
+    inputs = getattr(getattr(type(self), f.__name__, None), 'inputs', None)
+    if inputs is None:
+        return None
+
+    digest = hashlib.sha1()
+    digest.update(f.__name__)
+    _codeDigest(f.func_code, digest)
+    try:
+        digest.update(cPickle.dumps((args, sorted(kw.items()),
+                                     f.func_defaults),
+                                    cPickle.HIGHEST_PROTOCOL))
+        for key in sorted(inputs):
+            digest.update(cPickle.dumps(key, cPickle.HIGHEST_PROTOCOL))
+            if key in self.storage:
+                digest.update(cPickle.dumps(self.storage[key],
+                                            cPickle.HIGHEST_PROTOCOL))
+            else:
+                digest.update('\0missing')
+    except (cPickle.PicklingError, TypeError), e:
+        log.log(30, 'Cannot hash inputs of %s, not caching: %s' % \
+                    (f.__name__, e))
+        return None
+    return digest.hexdigest()
+
+#########################################
+
+def _sizeof(value, pickled = False):
+    '''Bytes in an array or string; for anything else, the bytes in its
+       pickle if pickled, or else 0.'''
+
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, (int, long)):
+        return nbytes
+    if isinstance(value, str):
+        return len(value)
+    if not pickled:
+        return 0
+    try:
+        return len(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+    except (cPickle.PicklingError, TypeError):
+        return 0
+
+#########################################
+
+def _usage():
+    '''(wall, cpu seconds, peak RSS in bytes) of this process so far,
+       CPU including that of finished child processes, and RSS that of
+       the largest of them if it is larger, as for forked stages.'''
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    # ru_maxrss is in bytes on Mac OS X, and kilobytes elsewhere
+    rss = max(own.ru_maxrss, children.ru_maxrss)
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return (time.time(), cpu, rss)
+
+metricsFields = ['stage', 'start', 'wall', 'cpu', 'peakRSSDelta',
+                 'bytesWritten', 'cached']
+
+#########################################
+
+def _runStage(self, f, branching, args, kw, runner = None, start = None):
+    '''Run stage f, through runner if given, measuring it from start (the
+       _usage() when it really began) or from now.'''
+
+    if '_stageLocal' not in self.__dict__:
+        self._stageLocal = threading.local()
+    local = self._stageLocal
+    # a stage called from inside another counts towards both
+    outer = getattr(local, 'written', None)
+    local.written = 0
+    if start is None:
+        start = _usage()
+    metrics = {'stage' : f.__name__, 'start' : start[0], 'cached' : False}
+
+    try:
+        result = _runStageMeasured(self, f, branching, args, kw, runner,
+                                   metrics)
+    finally:
+        end = _usage()
+        metrics['wall'] = end[0] - start[0]
+        metrics['cpu'] = end[1] - start[1]
+        metrics['peakRSSDelta'] = end[2] - start[2]
+        metrics['bytesWritten'] = local.written
+        if outer is None:
+            local.written = None
+        else:
+            local.written = outer + metrics['bytesWritten']
+        if not hasattr(self, 'metrics'):
+            self.metrics = []
+        self.metrics.append(metrics)
+    return result
+
+#########################################
+
+def _runStageMeasured(self, f, branching, args, kw, runner, metrics):
+
+    f_name = f.__name__
+    log.log(20, 'Entering %s...' % f_name)
+
+    cache = getattr(self, 'cache', None)
+    key = None
+    if cache is not None:
+        key = _stageKey(self, f, args[1:], kw)
+    if key is not None:
+        entry = cache.get(key)
+        if entry is not None:
+            (result, assigned, deleted) = entry
+            log.log(20, 'Restored %s from cache.' % f_name)
+            metrics['cached'] = True
+            _applyChanges(self.storage, assigned, deleted)
+            self._countWrites(assigned.values())
+            return _finishStage(self, f_name, branching, result)
+        # keep this stage's changes apart from any made before it
+        (assigned, deleted) = self.storage.changes()
+        earlier = assigned.keys() + deleted
+
+    if runner is None:
+        result = f(*args,**kw)
+    else:
+        result = runner()
+
+    if key is not None:
+        (assigned, deleted) = self.storage.changes()
+        cache.put(key, f_name, (result, assigned, deleted))
+        self.storage.touch(earlier + assigned.keys() + deleted)
+
+    return _finishStage(self, f_name, branching, result)
+
+#########################################
+
+def _branchingsavepoint(f, *args, **kw):
     
     self = args[0]
     f_name = f.__name__
     if self.resume == f_name:
         self.resume = None
 
-    log.log(20, 'Entering %s...' % f_name)
-
-    isTrue = f(*args,**kw)
-    
-    log.log(20, 'Returning %s' % str(isTrue))
-    
-    return isTrue
+    return _runStage(self, f, True, args, kw)
     
 
 #########################################
 
-@decorator
-def savepoint(f, *args, **kw):
-    '''To be applied to instance methods of a class.'''
+def _savepoint(f, *args, **kw):
 
     self = args[0]
     f_name = f.__name__
-    if self.resume is None or \
+    resumeAfter = getattr(self, 'resumeAfter', None)
+    if resumeAfter is not None:
+        if resumeAfter == f_name:
+            self.resumeAfter = None
+        log.log(20, '%s already complete. Skipping.' % f_name)
+
+    elif self.resume is None or \
             self.resume == f_name:
         self.resume = None
 
-        log.log(20, 'Entering %s...' % f_name)
-        
-        f(*args,**kw)
-            
-        log.log(20,'Done.')
+        _runStage(self, f, False, args, kw)
 
     else:
         log.log(20, '%s already complete. Skipping.' % f_name)
 
 
+#########################################
+
+def _stageDecorator(caller, branching):
+
+    def stage(f = None, after = None, inputs = None):
+        if f is None:
+            return lambda f: stage(f, after = after, inputs = inputs)
+        wrapped = decorator(caller, f)
+        wrapped.stageFunction = f
+        wrapped.after = list(after or [])
+        wrapped.inputs = inputs
+        wrapped.branching = branching
+        return wrapped
+
+    return stage
+
+branchingsavepoint = _stageDecorator(_branchingsavepoint, True)
+branchingsavepoint.__doc__ = \
+    '''Marks a method that decides which way the pipeline goes; it is run
+       even when resuming. Use as @branchingsavepoint or
+       @branchingsavepoint(after=[...], inputs=[...]).'''
+
+savepoint = _stageDecorator(_savepoint, False)
+savepoint.__doc__ = \
+    '''To be applied to instance methods of a class. Use as @savepoint or
+       @savepoint(after=[...], inputs=[...]) to declare the stages it
+       depends on and the storage keys it reads (which makes it cacheable).'''
+
+
+#########################################
+
+class StageCache(object):
+    '''Outputs of savepoints, one file per entry in directory, named by
+       the hash of the stage's inputs. Once the files total more than
+       maxBytes the least recently used are removed.'''
+
+    suffix = '.stage'
+
+    def __init__(self, directory, maxBytes = 2**30):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    ##########################
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    ##########################
+
+    def get(self, key):
+        '''The (result, assigned, deleted) stored under key, or None.'''
+
+        path = self._path(key)
+        try:
+            input = file(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                cPickle.load(input)
+                entry = cPickle.load(input)
+            except (EOFError, cPickle.UnpicklingError, ValueError), e:
+                log.log(30, 'Ignoring damaged cache entry %s: %s' % (path, e))
+                return None
+        finally:
+            input.close()
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry
+
+    ##########################
+
+    def put(self, key, stage, entry):
+
+        path = self._path(key)
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), thread.get_ident())
+        output = file(tmp, 'wb')
+        try:
+            try:
+                cPickle.dump((stage, time.time()), output,
+                             cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump(entry, output, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                output.close()
+        except (cPickle.PicklingError, TypeError), e:
+            log.log(30, 'Cannot cache outputs of %s: %s' % (stage, e))
+            os.remove(tmp)
+            return
+        os.rename(tmp, path)
+        self.evict()
+
+    ##########################
+
+    def entries(self):
+        '''List of (key, stage, bytes, created, last used), most recently
+           used first.'''
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                input = file(path, 'rb')
+                try:
+                    (stage, created) = cPickle.load(input)
+                finally:
+                    input.close()
+            except (OSError, IOError, EOFError, cPickle.UnpicklingError,
+                    ValueError):
+                continue
+            entries.append((name[:-len(self.suffix)], stage, stat.st_size,
+                            created, stat.st_mtime))
+        entries.sort(key = lambda entry: entry[4], reverse = True)
+        return entries
+
+    ##########################
+
+    def size(self):
+        return sum([entry[2] for entry in self.entries()])
+
+    ##########################
+
+    def evict(self, maxBytes = None):
+        '''Remove least recently used entries until the rest fit in
+           maxBytes (default self.maxBytes). Returns the keys removed.'''
+
+        if maxBytes is None:
+            maxBytes = self.maxBytes
+        if maxBytes is None:
+            return []
+
+        removed = []
+        with self.lock:
+            entries = self.entries()
+            total = sum([entry[2] for entry in entries])
+            while entries and total > maxBytes:
+                (key, stage, nbytes, created, used) = entries.pop()
+                self._remove(key)
+                removed.append(key)
+                total -= nbytes
+        return removed
+
+    ##########################
+
+    def purge(self, stage = None):
+        '''Remove every entry, or every entry of stage. Returns the keys
+           removed.'''
+
+        removed = []
+        with self.lock:
+            for entry in self.entries():
+                if stage is None or entry[1] == stage:
+                    self._remove(entry[0])
+                    removed.append(entry[0])
+        return removed
+
+    ##########################
+
+    def _remove(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
 #########################################
         
 
 def runPipeline(pipeline, storage = None, resume = None, method = 'run',
-                **keywords):
+                journal = None, cache = None, **keywords):
 
-    storage.update(keywords)
+    if storage is None:
+        storage = {}
+    if keywords:
+        storage.update(keywords)
 
     pipeline.storage = storage
     pipeline.resume = resume
+    pipeline.metrics = []
+    if journal is not None:
+        pipeline.useJournal(journal)
+    if cache is not None:
+        pipeline.useCache(cache)
     
     getattr(pipeline, method)()
 
+
+#########################################
+
+def _batchJob(index, pipeline, storage, keywords, method):
+    '''Runs one job of runBatch in a pool worker.'''
+
+    start = time.time()
+    result = {'index' : index, 'status' : 'done', 'error' : None,
+              'storage' : None, 'metrics' : []}
+    opened = None
+    try:
+        if callable(storage):
+            storage = opened = storage()
+        instance = pipeline()
+        try:
+            runPipeline(instance, storage = storage, method = method,
+                        **keywords)
+        finally:
+            result['metrics'] = getattr(instance, 'metrics', [])
+            if opened is not None and hasattr(opened, 'close'):
+                opened.close()
+        if opened is None and isinstance(storage, dict):
+            result['storage'] = storage
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.time() - start
+    return result
+
+#########################################
+
+def _jobName(job):
+    '''The name of a runBatch job: the one it is given, or a hash of its
+       storage and keywords.'''
+
+    if len(job) > 2:
+        return str(job[2])
+
+    (storage, keywords) = job[:2]
+    if isinstance(storage, dict):
+        storage = sorted(storage.items())
+    try:
+        pickled = cPickle.dumps((storage, sorted((keywords or {}).items())),
+                                cPickle.HIGHEST_PROTOCOL)
+    except (cPickle.PicklingError, TypeError), e:
+        raise ValueError, \
+            "Cannot hash job to name its journal; name it instead: %s" % e
+    return hashlib.sha1(pickled).hexdigest()
+
+#########################################
+
+def runBatch(pipeline, jobs, processes = None, retries = 1, method = 'run',
+             journalDir = None):
+    '''Run pipeline (a class, or any picklable callable returning a
+       Pipeline) once per (storage, keywords[, name]) job, on a pool of
+       processes (default one per CPU). Failed jobs are retried up to
+       retries times, resuming from journalDir/job-<name>.journal when
+       journalDir is given; that journal is removed once the job is done.
+
+       Returns one dict per job, in job order, with index, status ('done'
+       or 'failed'), attempts, seconds (of the last attempt), error (its
+       traceback, if it failed) and metrics.'''
+
+    journals = [None] * len(jobs)
+    if journalDir is not None:
+        if not os.path.isdir(journalDir):
+            os.makedirs(journalDir)
+        names = [_jobName(job) for job in jobs]
+        if len(set(names)) != len(names):
+            raise ValueError, \
+                "Jobs must differ, or be named apart, to be journaled"
+        for (index, job) in enumerate(jobs):
+            if 'journal' not in (job[1] or {}):
+                journals[index] = os.path.join(journalDir,
+                                               'job-%s.journal' % names[index])
+
+    results = [None] * len(jobs)
+    attempts = [0] * len(jobs)
+    pending = {}
+    pool = multiprocessing.Pool(processes)
+
+    def submit(index):
+        (storage, keywords) = jobs[index][:2]
+        keywords = dict(keywords or {})
+        if journals[index] is not None:
+            keywords['journal'] = journals[index]
+        attempts[index] += 1
+        pending[index] = pool.apply_async(_batchJob,
+                                          (index, pipeline, storage,
+                                           keywords, method))
+
+    try:
+        for index in range(len(jobs)):
+            submit(index)
+
+        while pending:
+            ready = [index for (index, job) in pending.iteritems() \
+                         if job.ready()]
+            if not ready:
+                time.sleep(0.01)
+                continue
+
+            for index in ready:
+                job = pending.pop(index)
+                try:
+                    result = job.get()
+                except Exception:
+                    # the job could not be sent to or from the worker
+                    result = {'index' : index, 'status' : 'failed',
+                              'error' : traceback.format_exc(),
+                              'storage' : None, 'metrics' : [],
+                              'seconds' : 0.}
+
+                if result['status'] == 'failed':
+                    log.log(30, 'Job %d failed (attempt %d):\n%s' % \
+                                (index, attempts[index], result['error']))
+                    if attempts[index] <= retries:
+                        submit(index)
+                        continue
+
+                if result['status'] == 'done' and \
+                        journals[index] is not None:
+                    Journal(journals[index]).clear()
+
+                storage = jobs[index][0]
+                final = result.pop('storage')
+                if final is not None and isinstance(storage, dict):
+                    for key in storage.keys():
+                        if key not in final:
+                            del storage[key]
+                    storage.update(final)
+
+                result['attempts'] = attempts[index]
+                results[index] = result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    log.log(20, batchReport(results))
+    return results
+
+#########################################
+
+def batchReport(results):
+    '''A short summary of runBatch results.'''
+
+    done = [r for r in results if r['status'] == 'done']
+    failed = [r for r in results if r['status'] != 'done']
+    retried = [r for r in results if r['attempts'] > 1]
+    lines = ['%d jobs: %d done, %d failed, %d retried; %.1f s in jobs' % \
+                 (len(results), len(done), len(failed), len(retried),
+                  sum([r['seconds'] for r in results]))]
+    for r in failed:
+        error = r['error'].strip().splitlines()[-1]
+        lines.append('job %d failed after %d attempts: %s' % \
+                         (r['index'], r['attempts'], error))
+    return '\n'.join(lines)
+
     
 ###############################################################
 ##############################################################
@@ -195,9 +1264,504 @@ class PipelineTestCase(unittest.TestCase):
         self.assertEqual(self.storage, "gamma".split())
 
 
+#################
+
+class CrashingPipeline(Pipeline):
+
+    def __init__(self, crashIn = None):
+        Pipeline.__init__(self)
+        self.crashIn = crashIn
+        self.visited = []
+
+    def visit(self, method):
+        self.visited.append(method)
+        if method == self.crashIn:
+            raise RuntimeError(method)
+
+    @savepoint
+    def alpha(self):
+        self.visit('alpha')
+        self['a'] = 1
+        self['tmp'] = 'scratch'
+
+    @savepoint
+    def beta(self):
+        self.visit('beta')
+        self['b'] = self['a'] + 1
+        if 'tmp' in self.storage:
+            del self.storage['tmp']
+
+    @branchingsavepoint
+    def isGamma(self):
+        self.visit('gamma')
+        return True
+
+    @savepoint
+    def delta(self):
+        self.visit('delta')
+        self['d'] = self['b'] + 1
+
+    def _run(self):
+        self.alpha()
+        self.beta()
+        if self.isGamma():
+            self.delta()
+
+    #################
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.journal = Journal('journal.log')
+
+    def tearDown(self):
+        self.journal.clear()
+
+    def testJournaled(self):
+        pipeline = CrashingPipeline()
+        pipeline.run(storage = {}, journal = self.journal)
+        self.assertEqual(['alpha', 'beta', 'delta'],
+                         [r[0] for r in self.journal.records()])
+        self.assertEqual(('beta', {'b' : 2}, ['tmp']),
+                         self.journal.records()[1])
+
+    def testResumeAfterCrash(self):
+        pipeline = CrashingPipeline(crashIn = 'delta')
+        self.assertRaises(RuntimeError,
+                          lambda: pipeline.run(storage = {},
+                                               journal = 'journal.log'))
+
+        storage = {}
+        pipeline = CrashingPipeline()
+        runPipeline(pipeline, storage = storage, method = '_run',
+                    journal = 'journal.log')
+        self.assertEqual(['gamma', 'delta'], pipeline.visited)
+        self.assertEqual({'a' : 1, 'b' : 2, 'd' : 3}, storage)
+
+    def testExplicitResume(self):
+        CrashingPipeline().run(storage = {}, journal = self.journal)
+        pipeline = CrashingPipeline()
+        pipeline.run(storage = {}, resume = 'beta', journal = self.journal)
+        self.assertEqual(['beta', 'gamma', 'delta'], pipeline.visited)
+
+    def testFinishedRun(self):
+        CrashingPipeline().run(storage = {}, journal = self.journal)
+        pipeline = CrashingPipeline()
+        pipeline.run(storage = {}, journal = self.journal)
+        self.assertEqual(['gamma'], pipeline.visited)
+        self.assertEqual(3, pipeline['d'])
+
+    def testTruncatedJournal(self):
+        pipeline = CrashingPipeline(crashIn = 'delta')
+        self.assertRaises(RuntimeError,
+                          lambda: pipeline.run(storage = {},
+                                               journal = self.journal))
+        output = file('journal.log', 'ab')
+        output.write(cPickle.dumps(('delta', {'d' : 3}, []), 2)[:-3])
+        output.close()
+
+        self.assertEqual(2, len(self.journal.records()))
+        pipeline = CrashingPipeline()
+        pipeline.run(storage = {}, journal = self.journal)
+        self.assertEqual(['gamma', 'delta'], pipeline.visited)
+
+
+#################
+
+class DAGPipeline(Pipeline):
+
+    def __init__(self, colour = True, crashIn = None, rendezvous = 0,
+                 crashWith = RuntimeError):
+        Pipeline.__init__(self)
+        self.colour = colour
+        self.crashIn = crashIn
+        self.crashWith = crashWith
+        # seconds each photometer waits for the other to start
+        self.rendezvous = rendezvous
+        self.visited = []
+        self.started = {'B' : threading.Event(), 'V' : threading.Event()}
+
+    def visit(self, method):
+        self.visited.append(method)
+        if method == self.crashIn:
+            raise self.crashWith(method)
+
+    @savepoint(after = ['photometerB', 'photometerV'])
+    def colourCut(self):
+        self.visit('colourCut')
+        self['red'] = self['V'] - self['B'] > 0
+
+    @savepoint
+    def detect(self):
+        self.visit('detect')
+        self['n'] = 3
+
+    @savepoint(after = ['detect'])
+    def photometerB(self):
+        self.visit('photometerB')
+        self.started['B'].set()
+        self.started['V'].wait(self.rendezvous)
+        self['concurrent'] = self.started['V'].isSet()
+        self['B'] = 1.
+
+    @savepoint(after = ['detect'])
+    def photometerV(self):
+        self.visit('photometerV')
+        self.started['V'].set()
+        self.started['B'].wait(self.rendezvous)
+        self['V'] = 2.
+
+    @branchingsavepoint(after = ['colourCut'])
+    def haveColours(self):
+        self.visit('haveColours')
+        return self.colour
+
+    @savepoint(after = ['haveColours'])
+    def classify(self):
+        self.visit('classify')
+        self['classified'] = True
+
+    @savepoint(after = ['detect'])
+    def summary(self):
+        self.visit('summary')
+
+    #################
+
+class DAGTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = {}
+        self.journal = Journal('dagjournal.log')
+
+    def tearDown(self):
+        self.journal.clear()
+
+    def testOrder(self):
+        self.assertEqual(['detect', 'photometerB', 'photometerV',
+                          'colourCut', 'haveColours', 'classify', 'summary'],
+                         DAGPipeline().stageOrder())
+
+    def testConcurrentRun(self):
+        pipeline = DAGPipeline(rendezvous = 5)
+        pipeline.run(storage = self.storage, workers = 4)
+        self.assertTrue(self.storage['concurrent'])
+        self.assertEqual(True, self.storage['red'])
+        self.assertTrue(self.storage['classified'])
+        self.assertEqual('detect', pipeline.visited[0])
+        self.assertTrue(pipeline.visited.index('colourCut') <
+                        pipeline.visited.index('classify'))
+        self.assertEqual(7, len(pipeline.visited))
+
+    def testSingleWorker(self):
+        pipeline = DAGPipeline(rendezvous = 0.1)
+        pipeline.run(storage = self.storage, workers = 1)
+        self.assertFalse(self.storage['concurrent'])
+        self.assertEqual(DAGPipeline().stageOrder(), pipeline.visited)
+
+    def testProcesses(self):
+        pipeline = DAGPipeline()
+        pipeline.run(storage = self.storage, workers = 4, processes = True,
+                     journal = self.journal)
+        self.assertEqual(True, self.storage['red'])
+        self.assertTrue(self.storage['classified'])
+        self.assertEqual(6, len(self.journal.stages()))
+
+    def testInterrupted(self):
+        pipeline = DAGPipeline(crashIn = 'colourCut',
+                               crashWith = KeyboardInterrupt)
+        self.assertRaises(KeyboardInterrupt,
+                          lambda: pipeline.run(storage = self.storage,
+                                               workers = 2))
+        self.assertFalse('classify' in pipeline.visited)
+
+    def testProcessDies(self):
+        # SystemExit ends the child without it sending anything back
+        pipeline = DAGPipeline(crashIn = 'colourCut', crashWith = SystemExit)
+        self.assertRaises(RuntimeError,
+                          lambda: pipeline.run(storage = self.storage,
+                                               workers = 2,
+                                               processes = True))
+        self.assertTrue(self.storage['V'] > self.storage['B'])
+        self.assertFalse('red' in self.storage)
+
+    def testProcessMemory(self):
+        class Big(Pipeline):
+            @savepoint
+            def allocate(self):
+                self['n'] = len('x' * 2**27)
+        pipeline = Big()
+        pipeline.run(storage = self.storage, processes = True)
+        self.assertEqual(2**27, self.storage['n'])
+        self.failUnless(pipeline.metrics[0]['peakRSSDelta'] > 2**26)
+
+    def testBranchPrunes(self):
+        pipeline = DAGPipeline(colour = False)
+        pipeline.run(storage = self.storage)
+        self.assertFalse('classified' in self.storage)
+        self.assertTrue('summary' in pipeline.visited)
+        self.assertFalse('classify' in pipeline.visited)
+
+    def testResume(self):
+        pipeline = DAGPipeline()
+        pipeline.run(storage = {'B' : 1., 'V' : 2.}, resume = 'colourCut')
+        self.assertEqual(['colourCut', 'haveColours', 'classify', 'summary'],
+                         pipeline.visited)
+
+    def testJournalResume(self):
+        pipeline = DAGPipeline(crashIn = 'colourCut')
+        self.assertRaises(RuntimeError,
+                          lambda: pipeline.run(storage = {},
+                                               journal = self.journal))
+        self.assertFalse('classify' in pipeline.visited)
+
+        storage = {}
+        pipeline = DAGPipeline()
+        pipeline.run(storage = storage, journal = self.journal)
+        self.assertEqual(['classify', 'colourCut', 'haveColours'],
+                         sorted(set(pipeline.visited) -
+                                set(['summary'])))
+        self.assertEqual(True, storage['red'])
+
+    def testBadDependencies(self):
+        class Broken(Pipeline):
+            @savepoint(after = ['second'])
+            def first(self):
+                pass
+            @savepoint(after = ['first'])
+            def second(self):
+                pass
+        self.assertRaises(ValueError, Broken().stageOrder)
+
+
+#################
+
+class CachedPipeline(Pipeline):
+
+    calls = []
+
+    @savepoint(inputs = ['x'])
+    def square(self):
+        CachedPipeline.calls.append('square')
+        self['x2'] = self['x']**2
+        if 'scratch' in self.storage:
+            del self.storage['scratch']
+
+    @branchingsavepoint(inputs = ['x2'])
+    def isBig(self):
+        CachedPipeline.calls.append('isBig')
+        return self['x2'] > 10
+
+    @savepoint
+    def report(self):
+        CachedPipeline.calls.append('report')
+
+    def _run(self):
+        self.square()
+        if self.isBig():
+            self.report()
+
+    #################
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = StageCache('stagecache')
+        self.journal = Journal('cachejournal.log')
+        CachedPipeline.calls = []
+
+    def tearDown(self):
+        self.journal.clear()
+        self.cache.purge()
+        os.rmdir('stagecache')
+
+    def testRestore(self):
+        runPipeline(CachedPipeline(), storage = {'x' : 4, 'scratch' : 1},
+                    cache = self.cache, method = '_run')
+        CachedPipeline.calls = []
+        storage = {'x' : 4, 'scratch' : 1}
+        runPipeline(CachedPipeline(), storage = storage,
+                    cache = self.cache, method = '_run')
+        self.assertEqual(['report'], CachedPipeline.calls)
+        self.assertEqual({'x' : 4, 'x2' : 16}, storage)
+        self.assertEqual(['isBig', 'square'],
+                         sorted([entry[1] for entry in self.cache.entries()]))
+
+    def testChangedInput(self):
+        CachedPipeline().run(storage = {'x' : 4}, cache = self.cache)
+        CachedPipeline.calls = []
+        storage = {'x' : 3}
+        CachedPipeline().run(storage = storage, cache = self.cache)
+        self.assertEqual(['square', 'isBig'], CachedPipeline.calls)
+        self.assertEqual(9, storage['x2'])
+
+    def testJournalSeesRestoredStage(self):
+        CachedPipeline().run(storage = {'x' : 4}, cache = self.cache)
+        CachedPipeline().run(storage = {'x' : 4}, cache = self.cache,
+                             journal = self.journal)
+        self.assertEqual(('square', {'x2' : 16}, []),
+                         self.journal.records()[0])
+
+    def testEviction(self):
+        for i in range(4):
+            self.cache.put('k%d' % i, 'stage', (None, {'v' : 'x'*1000}, []))
+            os.utime(self.cache._path('k%d' % i), (1000 + i, 1000 + i))
+        self.cache.get('k0')
+        removed = self.cache.evict(2500)
+        self.assertEqual(['k1', 'k2'], sorted(removed))
+        self.assertEqual(['k0', 'k3'],
+                         sorted([entry[0] for entry in self.cache.entries()]))
+
+    def testMetrics(self):
+        pipeline = CachedPipeline()
+        pipeline.pickleSizes = True
+        pipeline.run(storage = {'x' : 4}, cache = self.cache)
+        self.assertEqual(['square', 'isBig', 'report'],
+                         [m['stage'] for m in pipeline.metrics])
+        self.assertTrue(pipeline.metrics[0]['bytesWritten'] > 0)
+        self.assertEqual(0, pipeline.metrics[1]['bytesWritten'])
+        for m in pipeline.metrics:
+            self.assertTrue(m['wall'] >= 0 and m['cpu'] >= 0)
+            self.assertFalse(m['cached'])
+
+        pipeline.run(storage = {'x' : 4}, cache = self.cache)
+        self.assertEqual([True, True, False],
+                         [m['cached'] for m in pipeline.metrics])
+
+        pipeline = CachedPipeline()
+        pipeline.run(storage = {'x' : 4})
+        self.assertEqual(0, pipeline.metrics[0]['bytesWritten'])
+        self.assertEqual(4, _sizeof('four'))
+        self.assertEqual(0, _sizeof([1, 2]))
+
+        pipeline.saveMetrics('metrics.json')
+        input = file('metrics.json')
+        self.assertEqual(pipeline.metrics, json.load(input))
+        input.close()
+        os.remove('metrics.json')
+
+        pipeline.saveMetrics('metrics.csv')
+        input = file('metrics.csv')
+        rows = list(csv.DictReader(input))
+        input.close()
+        os.remove('metrics.csv')
+        self.assertEqual(['square', 'isBig', 'report'],
+                         [row['stage'] for row in rows])
+        self.assertEqual(metricsFields, sorted(rows[0].keys(),
+                                               key = metricsFields.index))
+
+    def testPurgeStage(self):
+        self.cache.put('a', 'one', (None, {}, []))
+        self.cache.put('b', 'two', (None, {}, []))
+        self.assertEqual(['a'], self.cache.purge('one'))
+        self.assertEqual(None, self.cache.get('a'))
+        self.assertEqual((None, {}, []), self.cache.get('b'))
+
+
+#################
+
+class BatchPipeline(Pipeline):
+
+    @savepoint
+    def count(self):
+        self['n'] = self['n'] + 1
+        self['counted'] = self.storage.get('counted', 0) + 1
+
+    @savepoint(after = ['count'])
+    def flaky(self):
+        # fails the first time for each marker file named in storage
+        marker = self.storage.get('failOnce')
+        if marker is not None and not os.path.exists(marker):
+            file(marker, 'w').close()
+            raise RuntimeError('first attempt at %s' % marker)
+        if self.storage.get('alwaysFail'):
+            raise RuntimeError('always fails')
+        self['flaky'] = True
+
+    #################
+
+class BatchTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        for name in os.listdir('.'):
+            if name.startswith('batchmarker'):
+                os.remove(name)
+        if os.path.isdir('batchjournals'):
+            for name in os.listdir('batchjournals'):
+                os.remove(os.path.join('batchjournals', name))
+            os.rmdir('batchjournals')
+
+    def testRun(self):
+        jobs = [({'n' : i}, {'offset' : i}) for i in range(5)]
+        results = runBatch(BatchPipeline, jobs, processes = 2)
+        self.assertEqual(['done'] * 5, [r['status'] for r in results])
+        self.assertEqual(range(1, 6), [storage['n'] for (storage, kw) in jobs])
+        self.assertEqual(3, jobs[3][0]['offset'])
+        self.assertEqual(['count', 'flaky'],
+                         [m['stage'] for m in results[0]['metrics']])
+
+    def testRetryResumes(self):
+        jobs = [({'n' : 0, 'failOnce' : 'batchmarker%d' % i}, {})
+                for i in range(3)]
+        results = runBatch(BatchPipeline, jobs, processes = 2, retries = 1,
+                           journalDir = 'batchjournals')
+        self.assertEqual([2, 2, 2], [r['attempts'] for r in results])
+        self.assertEqual(['done'] * 3, [r['status'] for r in results])
+        for (storage, kw) in jobs:
+            # count ran once; the retry resumed at flaky
+            self.assertEqual(1, storage['counted'])
+            self.assertTrue(storage['flaky'])
+        self.assertEqual([], os.listdir('batchjournals'))
+
+    def testJournalsFollowJobs(self):
+        # a batch that fails, rerun with its jobs in another order
+        jobs = [({'n' : i, 'alwaysFail' : i == 1}, {}, 'job%d' % i)
+                for i in range(3)]
+        results = runBatch(BatchPipeline, jobs, processes = 2, retries = 0,
+                           journalDir = 'batchjournals')
+        self.assertEqual(['done', 'failed', 'done'],
+                         [r['status'] for r in results])
+        self.assertEqual(['job-job1.journal'], os.listdir('batchjournals'))
+
+        rerun = [({'n' : 1, 'counted' : 0}, {}, 'job1'),
+                 ({'n' : 5}, {}, 'job0')]
+        results = runBatch(BatchPipeline, rerun, processes = 1,
+                           journalDir = 'batchjournals')
+        self.assertEqual(['done', 'done'], [r['status'] for r in results])
+        # job1 resumed from its own journal, after count
+        self.assertEqual({'n' : 2, 'counted' : 1, 'flaky' : True},
+                         rerun[0][0])
+        self.assertEqual(6, rerun[1][0]['n'])
+        self.assertEqual([], os.listdir('batchjournals'))
+
+        self.assertRaises(ValueError, lambda: runBatch(
+                BatchPipeline, [({'n' : 0}, {})] * 2,
+                journalDir = 'batchjournals'))
+
+    def testResume(self):
+        jobs = [({'n' : 0, 'counted' : 5}, {'resume' : 'flaky'})]
+        results = runBatch(BatchPipeline, jobs, processes = 1)
+        self.assertEqual('done', results[0]['status'])
+        self.assertEqual({'n' : 0, 'counted' : 5, 'flaky' : True}, jobs[0][0])
+
+    def testFailure(self):
+        jobs = [({'n' : 0}, {}), ({'n' : 0, 'alwaysFail' : True}, {})]
+        results = runBatch(BatchPipeline, jobs, processes = 2, retries = 2)
+        self.assertEqual(['done', 'failed'], [r['status'] for r in results])
+        self.assertEqual(3, results[1]['attempts'])
+        self.assertTrue('RuntimeError: always fails' in results[1]['error'])
+        report = batchReport(results)
+        self.assertTrue(report.startswith('2 jobs: 1 done, 1 failed'))
+        self.assertTrue('job 1 failed after 3 attempts' in report)
+
+
 if __name__ == '__main__':
 
-    suite = unittest.TestLoader().loadTestsFromTestCase(PipelineTestCase)
-    unittest.TextTestRunner(verbosity=2).run(suite)
+    suites = []
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(PipelineTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(JournalTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(DAGTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(CacheTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(BatchTestCase))
+    unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(suites))
         
             
@@ -23,9 +23,122 @@ below:
                         # if no such key)
         flag = d.has_key(key)   # true if the key exists; same as "key in d"
         list = d.keys() # a list of all existing keys (slow!)
+        for (key, data) in d.iteritems():   # stream the shelf in file
+            ...                             # order (also iterkeys and
+                                            # itervalues)
 
         d.close()       # close it
 
+Storage is append-only: overwriting or deleting a key appends its old row
+number to a tombstone list (/dead) rather than rewriting the file, and the
+newest live row for a key wins. Dead rows are only reclaimed once they make
+up more than garbageRatio of the shelf:
+
+        d = PytableShelf(filename, garbageRatio = 0.5)
+
+Reclaiming space is done by compaction: the live rows are copied into a
+fresh file (filename + '.compact') a few rows at a time, and the result is
+renamed over the original once it is complete. Once the garbage ratio is
+crossed, each write goes on to copy compactStepRows more rows (1000 by
+default), so that no single write pays for a whole compaction; a shelf
+opened with background = True compacts in a thread instead. Compaction can
+also be driven by hand, with a time budget per call:
+
+        reclaimed = d.compact(max_seconds = 0.5) # bytes reclaimed, or None
+                                                 # if not finished yet
+        d.startCompaction()                      # compact in a thread
+
+With nativeArrays = True, numeric numpy arrays are not pickled but stored
+as typed HDF5 datasets, one per key, chunked and compressed with the
+shelf's filters (contiguous if compression = 0). Reading such a key
+returns an ArrayProxy, which only reads what is indexed:
+
+        d = PytableShelf(filename, nativeArrays = True)
+        d['e1'] = e1                    # e1 is a float ndarray
+        part = d['e1'][1000:2000]       # reads 1000 elements from disk
+        whole = numpy.asarray(d['e1'])  # reads everything
+
+A proxy refers to the dataset that was current when it was fetched, and
+becomes unusable once its key is overwritten or deleted. It follows that
+dataset through compactions, which any write may set off.
+
+The compressor is chosen with complib (any library PyTables supports, e.g.
+'zlib', 'lzo', 'bzip2', 'blosc' or, with newer PyTables, 'blosc:lz4' and
+'blosc:zstd') and shuffle. Native arrays can be given their own filters,
+since the best settings for numeric columns rarely suit pickled objects.
+shelfbench.py measures speed and compression ratio for a set of choices:
+
+        d = PytableShelf(filename, compression = 5, complib = 'blosc',
+                         nativeArrays = True,
+                         arrayFilters = tables.Filters(complevel = 5,
+                                                       complib = 'blosc:lz4',
+                                                       shuffle = True))
+
+Many items can be read or written with one call, and writes can be
+buffered in memory and applied in a single pass:
+
+        d.setmany({'a' : 1, 'b' : 2})   # also d.update(...)
+        (a, b) = d.getmany(['a', 'b'])
+        with d.batch(maxPending = 1000):
+            for i in range(100000):     # written 1000 at a time, and
+                d[str(i)] = i           # whatever is left on exit
+
+Values read often can be kept in memory, up to a budget of cacheBytes, with
+the least recently used evicted first. Writes and deletes invalidate the
+cached entry. By default a cached read still returns a copy; with
+cacheShared = True the cached object itself is returned, and must then be
+treated as read-only (numpy arrays are flagged as such):
+
+        d = PytableShelf(filename, cacheBytes = 100 * 2**20)
+
+Several processes can share one shelf if they all open it with
+locking = True. Any number of them may open it read-only, and at most one
+for writing (a second writer gets an IOError):
+
+        r = PytableShelf(filename, mode = 'r', locking = True)
+        w = PytableShelf(filename, locking = True)
+
+Locking uses flock(2) on three files next to the shelf: filename + '.lock'
+guards the data, filename + '.intent' lets a waiting writer hold off new
+readers, and filename + '.writer' is held by the writer for as long as it
+is open. They are left behind on close. HDF5 cannot have a file open for
+writing while anyone else reads it, so:
+
+    - a reader holds a shared lock, and sees a consistent snapshot of the
+      shelf, from its open until refresh() or close();
+    - the writer keeps its writes buffered in memory (as in batch()) and
+      only opens the file to commit them, under an exclusive lock, when
+      maxPending keys are waiting or on flush() / close(). A commit waits
+      until every reader has called refresh() or close(), so long-lived
+      readers should refresh between units of work;
+    - the writer opens the file briefly to read, so its native arrays come
+      back as ndarrays rather than proxies.
+
+A ShardedShelf spreads keys over nshards PytableShelf files in a directory,
+by a stable hash of the key, and otherwise behaves like a single shelf.
+Shards are only opened when first used, and only created when first
+written: until then, readers and writers alike find them empty. Any
+keyword arguments are passed on to each shard. A shard can also be opened
+on its own, e.g. by a worker process that only handles that part of the
+data:
+
+        d = pytableshelf.ShardedShelf(dirname, nshards = 16)
+        d.shardIndex(key)                          # which shard holds key
+        s = pytableshelf.openShard(dirname, 3)     # a plain PytableShelf
+
+A SpillStorage is an in-memory dictionary with a memory budget, meant for
+Pipeline storage that would otherwise outgrow RAM. Once the values held
+exceed memoryBytes, the least recently used values of at least
+minSpillBytes (typically numpy arrays) are moved to a temporary shelf,
+and read back into memory the next time they are used:
+
+        storage = pytableshelf.SpillStorage(memoryBytes = 4 * 2**30,
+                                            directory = '/scratch')
+        runPipeline(pipeline, storage)
+        storage.close()                 # removes the temporary file
+
+Sizes are measured when a value is stored, so arrays grown in place
+afterwards are not accounted for until they are stored again.
 
 '''
 
@@ -34,31 +147,268 @@ __CVS_ID__ = "$Id: pytableshelf.py,v 1.1 2008-01-17 19:12:38 dapple Exp $"
 ####################################
 
 import UserDict
+import bisect
+import copy
+import cPickle
+import fcntl
+import os
+import sys
+import tempfile
+import threading
+import time
+import weakref
+import zlib
+import numpy
 import tables
-import tables.scripts.ptrepack as repack
+from collections import OrderedDict
+from contextlib import contextmanager
 
 #####################################
 
-def open(filename):
-    return PytableShelf(filename)
+def open(filename, mode = 'a'):
+    return PytableShelf(filename, mode = mode)
+
+######################################
+
+def _createStructure(h5file, filters):
+
+    if '/keys' not in h5file:
+        h5file.createVLArray("/", "keys", tables.VLStringAtom(),
+                             filters = filters)
+
+    if '/vals' not in h5file:
+        h5file.createVLArray("/", "vals", tables.ObjectAtom(),
+                             filters = filters)
+
+    if '/dead' not in h5file:
+        h5file.createEArray("/", "dead", tables.Int64Atom(), (0,),
+                            filters = filters)
+
+    if '/arrays' not in h5file:
+        h5file.createGroup("/", "arrays")
+
+######################################
+
+def _arrayName(row):
+    return 'r%d' % row
+
+# marks a buffered delete
+_deleted = object()
+
+######################################
+
+def _sizeof(val):
+    '''Approximate memory footprint of a value, for SpillStorage: exact
+       for arrays and strings, and shallow (sys.getsizeof) for anything
+       else, which would be too costly to measure on every store.'''
+    if isinstance(val, numpy.ndarray):
+        return val.nbytes
+    if isinstance(val, str):
+        return len(val)
+    return sys.getsizeof(val)
+
+def _readPickled(vlarray, row):
+    '''The pickle stored in row of an ObjectAtom VLArray, as it is on
+       disk, without unpickling it.'''
+
+    readArray = getattr(vlarray, '_read_array', None)
+    if readArray is None:
+        readArray = vlarray._readArray
+    array = readArray(row, row + 1, 1)[0]
+    if array.size == 0:
+        return cPickle.dumps(None, cPickle.HIGHEST_PROTOCOL)
+    return array.tostring()
+
+######################################
+
+class LRUCache(object):
+    '''Holds up to maxBytes worth of values, evicting the least recently
+       used first.'''
+
+    missing = object()
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return self.missing
+        self.entries[key] = entry
+        return entry[0]
+
+    def put(self, key, val, size):
+        self.discard(key)
+        if size > self.maxBytes:
+            return
+        self.entries[key] = (val, size)
+        self.nbytes += size
+        while self.nbytes > self.maxBytes:
+            (oldVal, oldSize) = self.entries.popitem(last = False)[1]
+            self.nbytes -= oldSize
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+######################################
+
+class ArrayProxy(object):
+    '''Lazy, read-only view of an array stored natively in a shelf.
+       Indexing reads only the selected elements from disk and returns
+       them as a new ndarray. row is the shelf row of the array, by which
+       compaction finds the proxy a new node.'''
+
+    def __init__(self, node, row = None):
+        self.node = node
+        self.row = row
+
+    shape = property(lambda self: self.node.shape)
+    dtype = property(lambda self: self.node.atom.dtype)
+    ndim = property(lambda self: len(self.node.shape))
+    size = property(lambda self: int(numpy.prod(self.node.shape)))
+
+    def __len__(self):
+        return self.node.shape[0]
+
+    def __getitem__(self, key):
+        return self.node[key]
+
+    def __array__(self, dtype = None):
+        if dtype is None:
+            return self.read()
+        return self.read().astype(dtype)
+
+    def read(self, start = None, stop = None, step = None):
+        return self.node.read(start, stop, step)
+
+    def __repr__(self):
+        return 'ArrayProxy(shape=%s, dtype=%s)' % (self.shape, self.dtype)
+
+######################################
+
+class FileLock(object):
+    '''Advisory lock on a file, taken with flock(2). Locks taken through
+       different FileLock objects conflict even within one process.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = None
+
+    def acquire(self, exclusive, blocking = True):
+        if self.fd is None:
+            self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0666)
+        flags = fcntl.LOCK_SH
+        if exclusive:
+            flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.fd, flags)
+        except IOError:
+            self.release()
+            raise IOError, "File is locked: %s" % self.filename
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
 
 ######################################
 
 class PytableShelf(UserDict.DictMixin):
 
-    def __init__(self, filename, compression = 1):
-        self.filter = tables.Filters(complevel=compression)
+    def __init__(self, filename, compression = 1, garbageRatio = 0.5,
+                 background = False, nativeArrays = False, cacheBytes = 0,
+                 cacheShared = False, mode = 'a', locking = False,
+                 maxPending = 1000, complib = 'zlib', shuffle = True,
+                 arrayFilters = None, compactStepRows = 1000):
+        self.filter = tables.Filters(complevel=compression, complib=complib,
+                                     shuffle=shuffle)
+        if arrayFilters is None:
+            arrayFilters = self.filter
+        self.arrayFilter = arrayFilters
         self.filename = filename
+        self.mode = mode
+        self.locking = locking
+        # a locking writer only has the file open while it uses it
+        self.transient = locking and mode != 'r'
+        self.nativeArrays = nativeArrays
+        self.cache = None
+        if cacheBytes > 0:
+            self.cache = LRUCache(cacheBytes)
+        self.cacheShared = cacheShared
+        self.garbageRatio = garbageRatio
+        self.background = background
+        self.compactStepRows = compactStepRows
+        self.lock = threading.RLock()
+        self.compactor = None
+        self.compactThread = None
+        self.stopCompaction = threading.Event()
+        self.closed = False
         self.file = None
         self.fileKeys = None
         self.fileVals = None
-        self.repack = False
-        try:
-            self.file = tables.openFile(filename,mode='a')
-        except IOError:
-            raise IOError, "Cannot Open File: %s" % filename
-
-        self.formatFile()
+        self.fileDead = None
+        self.fileArrays = None
+        self.fileIndex = None
+        self.index = None
+        self.indexDirty = False
+        self.indexDelta = None
+        self.indexDeltaRows = 0
+        self.pending = None
+        self.maxPending = maxPending
+        self.batchDepth = 0
+        self.generation = 0
+        # iterators in progress, which a compaction would break
+        self.iterating = 0
+        # proxies handed out, which a compaction moves to their new rows
+        self.proxies = weakref.WeakSet()
+        self.dataLock = None
+        self.intentLock = None
+        self.writerLock = None
+
+        if mode not in ('r', 'a'):
+            raise ValueError, "Unsupported mode: %s" % mode
+
+        if locking:
+            self.dataLock = FileLock(filename + '.lock')
+            self.intentLock = FileLock(filename + '.intent')
+            if mode != 'r':
+                self.writerLock = FileLock(filename + '.writer')
+                self.writerLock.acquire(exclusive = True, blocking = False)
+
+        if mode != 'r':
+            # a compaction that was interrupted by a crash is discarded
+            if os.path.exists(filename + ShelfCompactor.suffix):
+                os.remove(filename + ShelfCompactor.suffix)
+
+        if self.transient:
+            self.pending = {}
+            self._acquire(exclusive = True)
+            try:
+                self._openFile('a')
+                self.formatFile()
+                self._saveIndex()
+                self._closeFile()
+            finally:
+                self._release()
+        else:
+            if locking:
+                self._acquire(exclusive = False)
+            self._openFile(mode)
+            self.formatFile()
 
     ###############################
 
@@ -69,56 +419,194 @@ class PytableShelf(UserDict.DictMixin):
     ###############################
 
     def close(self):
+        if self.closed:
+            return
+        self.stopBackgroundCompaction()
+        with self.lock:
+            if self.compactor is not None:
+                self.compactor.abandon()
+                self.compactor = None
+            try:
+                if self.mode != 'r':
+                    self.flushPending()
+                    self.flush()
+                    if self.file is not None:
+                        self._saveIndex(whole = True)
+                if self.file is not None:
+                    self._closeFile()
+            finally:
+                self.closed = True
+                if self.cache is not None:
+                    self.cache.clear()
+                if self.locking:
+                    self._release()
+                if self.writerLock is not None:
+                    self.writerLock.release()
+
+    ###############################
+
+    def _openFile(self, mode):
+
+        try:
+            self.file = tables.openFile(self.filename, mode=mode)
+        except IOError:
+            raise IOError, "Cannot Open File: %s" % self.filename
+
+    ###############################
+
+    def _closeFile(self):
+
+        self.file.close()
+        self.file = None
+
+    ###############################
+
+    def _acquire(self, exclusive):
+
+        if exclusive:
+            self.intentLock.acquire(exclusive = True)
+            self.dataLock.acquire(exclusive = True)
+        else:
+            # blocks while a writer is waiting for, or holds, the data
+            self.intentLock.acquire(exclusive = False)
+            self.dataLock.acquire(exclusive = False)
+            self.intentLock.release()
+
+    ###############################
+
+    def _release(self):
+
+        self.dataLock.release()
+        self.intentLock.release()
+
+    ###############################
+
+    @contextmanager
+    def _access(self):
+        '''Have the file open, at least for reading, for the duration.'''
+
         if self.file is not None:
-            self.file.close()
-            self.file = None
-            if self.repack:
-                tmpfile = self.filename + ".tmp"
-                repack.copyChildren(srcfile = self.filename,
-                                    dstfile = tmpfile,
-                                    srcgroup = '/',
-                                    dstgroup = '/',
-                                    title = '',
-                                    recursive = True,
-                                    filters = self.filter,
-                                    copyuserattrs = True,
-                                    overwritefile = True,
-                                    overwrtnodes = True,
-                                    stats = {'groups': 0, 'leaves': 0,
-                                             'bytes': 0},
-                                    start = 0,
-                                    stop = None,
-                                    step = 1,
-                                    upgradeflavors = False)
-                os.rename(tmpfile, self.filename)
-            
-                                
-            
+            yield
+            return
+        if self.closed:
+            raise IOError, "Shelf is closed: %s" % self.filename
+        self._acquire(exclusive = False)
+        try:
+            self._openFile('r')
+            try:
+                self._getNodes()
+                yield
+            finally:
+                self._closeFile()
+        finally:
+            self._release()
+
+    ###############################
+
+    @contextmanager
+    def _commit(self):
+        '''Have the file open for writing for the duration; a locking
+           writer then saves the index and closes it again.'''
+
+        if self.file is not None:
+            yield
+            return
+        if self.closed:
+            raise IOError, "Shelf is closed: %s" % self.filename
+        self._acquire(exclusive = True)
+        try:
+            self._openFile('a')
+            try:
+                self._getNodes()
+                yield
+                self._saveIndex()
+            finally:
+                self._closeFile()
+        finally:
+            self._release()
+
+    ###############################
+
+    def _checkWritable(self):
+
+        if self.mode == 'r':
+            raise IOError, "Shelf is read-only: %s" % self.filename
+
+    ###############################
+
+    def refresh(self):
+        '''For a reader, let go of the current snapshot and open the
+           latest one. For a writer, the same as flush().'''
+
+        with self.lock:
+            if self.mode != 'r':
+                self.flush()
+                return
+            self._closeFile()
+            if self.locking:
+                self._release()
+                self._acquire(exclusive = False)
+            self._openFile('r')
+            self.formatFile()
+            if self.cache is not None:
+                self.cache.clear()
 
     ###############################
 
     def formatFile(self):
 
-        if '/keys' not in self.file:
-            self.file.createVLArray("/", "keys", tables.VLStringAtom(),
-                                    filters=self.filter)
+        if self.file.mode != 'r':
+            _createStructure(self.file, self.filter)
 
-        if '/vals' not in self.file:
-            self.file.createVLArray("/", "vals", tables.ObjectAtom(),
-                                    filters = self.filter)      
+        self._getNodes()
+        self.constraints()
+        self._loadIndex()
+
+    ###############################
+
+    def _getNodes(self):
 
         try:
             self.fileKeys = self.file.getNode("/","keys",classname="VLArray")
             self.fileVals = self.file.getNode("/", "vals",classname="VLArray")
+            # shelves written before tombstones and native arrays have
+            # neither node; read-only, they just have none of either
+            self.fileDead = None
+            self.fileArrays = None
+            if self.file.mode != 'r' or '/dead' in self.file:
+                self.fileDead = self.file.getNode("/", "dead",
+                                                  classname="EArray")
+            if self.file.mode != 'r' or '/arrays' in self.file:
+                self.fileArrays = self.file.getNode("/", "arrays",
+                                                    classname="Group")
         except tables.NoSuchNodeError:
             raise AttributeError("Incorrect File Structure: %s" % \
                                      self.filename)
 
         if not isinstance(self.fileKeys.atom, tables.VLStringAtom) or \
-                not isinstance(self.fileVals.atom, tables.ObjectAtom):
+                not isinstance(self.fileVals.atom, tables.ObjectAtom) or \
+                (self.fileDead is not None and \
+                     not isinstance(self.fileDead.atom, tables.Int64Atom)):
             raise AttributeError("Incorrect File Structure: %s" % \
                                      self.filename)
-        self.constraints()
+        if '/index' in self.file:
+            self.fileIndex = self.file.getNode("/", "index")
+
+    ###############################
+
+    def flush(self):
+        '''Write the key index and any HDF5 buffers out to disk. A locking
+           writer commits its buffered writes.'''
+        with self.lock:
+            if self.mode == 'r':
+                return
+            if self.transient:
+                self.flushPending()
+                return
+            if self.file is None:
+                return
+            self._saveIndex()
+            self.file.flush()
 
     ###############################
 
@@ -135,311 +623,2385 @@ class PytableShelf(UserDict.DictMixin):
 
     ###############################
 
-    _objectNotFound = -1
-    def _findIndex(self,key):
-        i=0;
-        for entry in self.fileKeys.iterrows():
-            if entry == key:
-                return i
-            i += 1
-        return self._objectNotFound
+    def _ndead(self):
+        if self.fileDead is None:
+            return 0
+        return len(self.fileDead)
 
     ###############################
 
-    def __getitem__(self,key):
-        index = self._findIndex(key)
-        if index == self._objectNotFound:
-            raise KeyError
-        return self.fileVals[index]
-        
-    ################################
+    # The key->row index lives in /index as a pickled dict, followed by
+    # one pickled dict per save since of the keys that changed (with None
+    # for a deleted key), so that a save costs what changed rather than
+    # the whole index. Once those changes add up to more entries than the
+    # index, and on closing a shelf that keeps its file open, the index is
+    # written out whole again. Its
+    # 'nrows' and 'ndead' attributes record the lengths of /keys and /dead
+    # when the index was written; any mismatch means the index is stale
+    # and must be rebuilt.
+    # The attribute is set to -1 as soon as the in-memory index diverges
+    # from the copy on disk, so a crash before the next flush() leaves an
+    # index that will be recognised as stale.
+
+    _staleIndex = -1
+
+    def _loadIndex(self):
+
+        self.index = None
+        self.fileIndex = None
+        if '/index' in self.file:
+            self.fileIndex = self.file.getNode("/", "index")
+            if isinstance(self.fileIndex, tables.VLArray) and \
+                    isinstance(self.fileIndex.atom, tables.ObjectAtom) and \
+                    len(self.fileIndex) >= 1 and \
+                    getattr(self.fileIndex.attrs, 'nrows', self._staleIndex) \
+                    == len(self.fileKeys) and \
+                    getattr(self.fileIndex.attrs, 'ndead', self._staleIndex) \
+                    == self._ndead():
+                self.index = self.fileIndex[0]
+                self.indexDeltaRows = 0
+                for delta in self.fileIndex.iterrows(1):
+                    self._applyDelta(delta)
+                    self.indexDeltaRows += len(delta)
+                self.indexDelta = {}
+                self.indexDirty = False
+
+        if self.index is None:
+            self._rebuildIndex()
 
-    def _removeStaleKeyVal(self, index):
+    ###############################
 
-        self.repack = True
-        
-        keys = self.fileKeys.read()
-        vals = self.fileVals.read()
-
-        self.file.removeNode("/keys")
-        self.file.removeNode("/vals")
-
-        self.file.flush()
-
-        self.file.createVLArray("/", "keys", tables.VLStringAtom(),
-                                filters = self.filter)
-        self.file.createVLArray("/", "vals", tables.ObjectAtom(),
-                                filters = self.filter)
-        self.fileKeys = self.file.root.keys
-        self.fileVals = self.file.root.vals
-        for (curKey, curVal) in zip(keys[0:index],
-                                    vals[0:index]):
-            self.fileKeys.append(curKey)
-            self.fileVals.append(curVal)
-        for (curKey, curVal) in zip(keys[index+1:],
-                                    vals[index+1:]):
-            self.fileKeys.append(curKey)
-            self.fileVals.append(curVal)
+    def _rebuildIndex(self):
+
+        self.index = {}
+        self.indexDirty = True
+        # nothing on disk to add changes to
+        self.indexDelta = None
+        dead = set()
+        if self.fileDead is not None:
+            dead = set(self.fileDead.read().tolist())
+        orphans = []
+        i = 0
+        for entry in self.fileKeys.iterrows():
+            if i not in dead:
+                # an older live row can only survive a crash between the
+                # append of its replacement and its tombstone
+                if entry in self.index:
+                    orphans.append(self.index[entry])
+                self.index[entry] = i
+            i += 1
+        if orphans and self.file.mode != 'r':
+            self.fileDead.append(orphans)
 
-    #################################
-    
-    def __setitem__(self, key, val):
+    ###############################
 
-        if not type(key) == type(''):
-            raise TypeError, "keys and values must be strings"
-        index = self._findIndex(key)
-        if index != self._objectNotFound:
-            self._removeStaleKeyVal(index)
-                        
-        self.fileKeys.append(key)
-        self.fileVals.append(val)
+    def _touchIndex(self):
 
-    #################################
+        if self.indexDirty:
+            return
+        self.indexDirty = True
+        if self.fileIndex is not None:
+            self.fileIndex.attrs.nrows = self._staleIndex
 
-    def __delitem__(self, key):
+    ###############################
 
-        index = self._findIndex(key)
-        if index == self._objectNotFound:
-            raise KeyError
-        self._removeStaleKeyVal(index)
+    def _applyDelta(self, delta):
 
-    ##################################
+        for (key, row) in delta.iteritems():
+            if row is None:
+                self.index.pop(key, None)
+            else:
+                self.index[key] = row
 
-    def keys(self):
-        return self.fileKeys.read()
+    ###############################
 
-    
+    def _setRow(self, key, row):
+        '''Point key at row of the file, or remove it if row is None.'''
 
-#############################################
-#TESTING
-#############################################
+        if row is None:
+            del self.index[key]
+        else:
+            self.index[key] = row
+        if self.indexDelta is not None:
+            self.indexDelta[key] = row
 
+    ###############################
 
-import unittest
-import os
+    def _saveIndex(self, whole = False):
+        '''Write out the changes to the index since it was last saved, or
+           the whole index if whole is true or the changes have piled up.'''
+
+        if self.indexDirty and not whole and self.indexDelta is not None \
+                and self.fileIndex is not None and \
+                self.indexDeltaRows + len(self.indexDelta) <= len(self.index):
+            self.fileIndex.append(self.indexDelta)
+            self.indexDeltaRows += len(self.indexDelta)
+        elif self.indexDirty or (whole and self.indexDeltaRows > 0):
+            if '/index' in self.file:
+                self.file.removeNode("/index")
+            self.fileIndex = self.file.createVLArray("/", "index",
+                                                     tables.ObjectAtom(),
+                                                     filters = self.filter)
+            self.fileIndex.append(self.index)
+            self.indexDeltaRows = 0
+        else:
+            return
+        self.fileIndex.attrs.nrows = len(self.fileKeys)
+        self.fileIndex.attrs.ndead = self._ndead()
+        self.indexDelta = {}
+        self.indexDirty = False
 
-    
-class FileStructTestCase(unittest.TestCase):
+    ###############################
 
-    def testNoFile(self):
-        
-        mydict = PytableShelf("testNoFile.h5")
-        self.failUnless(os.path.exists('testNoFile.h5'))
-        mydict.close()
-        os.remove('testNoFile.h5')
+    _objectNotFound = -1
+    def _findIndex(self,key):
+        return self.index.get(key, self._objectNotFound)
 
     ###############################
 
-    def testPartialFile(self):
-        
-        h5file = tables.openFile("incorrectFile.h5", mode="w")
-        h5file.createVLArray("/", "vals", tables.ObjectAtom(),
-                             filters = tables.Filters(complevel=1))
-        arr = h5file.root.vals
-        arr.append([5,6,"7"])
-        arr.append("1,2,3")
-        h5file.close()
-        
-        self.expectException("incorrectFile.h5")
-    ###################################
+    def __getitem__(self,key):
+        with self.lock:
+            if self.pending is not None and key in self.pending:
+                val = self.pending[key]
+                if val is _deleted:
+                    raise KeyError
+                return copy.deepcopy(val)
+            index = self._findIndex(key)
+            if index == self._objectNotFound:
+                raise KeyError
+            with self._access():
+                return self._read(key, index)
 
-    def testWrongDims(self):
+    ################################
 
-        h5file = tables.openFile("wrongDims.h5", mode="w")
-        
-        h5file.createVLArray("/", "keys", tables.VLStringAtom(),
-                             filters = tables.Filters(complevel=1))
-        keys = h5file.root.keys
-        keys.append("key1")
-        keys.append("key2")
+    def _read(self, key, index):
+
+        node = self._arrayNode(index)
+        if node is not None:
+            return self._wrapArray(node, index)
+
+        if self.cache is None:
+            return self.fileVals[index]
+
+        # unshared, the cache holds the pickle as stored, which is both
+        # the value's size and a cheaper copy of it than deepcopy
+        val = self.cache.get(key)
+        if val is LRUCache.missing:
+            pickled = _readPickled(self.fileVals, index)
+            if self.cacheShared:
+                val = cPickle.loads(pickled)
+                if isinstance(val, numpy.ndarray):
+                    val.flags.writeable = False
+            else:
+                val = pickled
+            self.cache.put(key, val, len(pickled))
+        if self.cacheShared:
+            return val
+        return cPickle.loads(val)
         
-        h5file.createVLArray("/", "vals", tables.ObjectAtom(),
-                             filters = tables.Filters(complevel=1))
-        vals = h5file.root.vals
-        vals.append([1,2,3])
+    ################################
 
-        h5file.close()
-        
-        self.expectException("wrongDims.h5")
+    def _wrapArray(self, node, row):
 
-    ########################################
+        # a locking writer closes the file again straight after the read
+        if self.transient:
+            return node.read()
+        proxy = ArrayProxy(node, row)
+        self.proxies.add(proxy)
+        return proxy
 
-    def testWrongTypes1(self):
+    ################################
 
-        h5file = tables.openFile("wrongTypes1.h5", mode="w")
+    def _isNativeArray(self, val):
 
-        h5file.createTable("/","keys", {"key" : tables.StringCol(itemsize=16)})
-        row = h5file.root.keys.row
-        row['key'] = 'key1'
-        row.append()
-        h5file.root.keys.flush()
+        return self.nativeArrays and isinstance(val, numpy.ndarray) and \
+            val.dtype.kind in 'biufc' and val.ndim > 0 and val.size > 0
 
-        h5file.createVLArray("/", "vals", tables.ObjectAtom(),
-                             filters=tables.Filters(complevel=1))
-        vals = h5file.root.vals
-        vals.append([1,2,3])
+    ################################
 
-        h5file.close()
-        
-        self.expectException("wrongTypes1.h5")
+    def _arrayNode(self, index):
 
-    ###########################################
+        if self.fileArrays is None:
+            return None
+        try:
+            return self.file.getNode(self.fileArrays, _arrayName(index))
+        except tables.NoSuchNodeError:
+            return None
 
-    def testWrongTypes2(self):
-        
-        h5file = tables.openFile("wrongTypes2.h5", mode="w")
-        
-        h5file.createVLArray("/", "keys", tables.VLStringAtom(),
-                             filters=tables.Filters(complevel=1))
-        keys = h5file.root.keys
-        keys.append("key1")
-        keys.append("key2")
-        
-        h5file.createVLArray("/", "vals", tables.VLStringAtom(),
-                             filters=tables.Filters(complevel=1))
-        vals = h5file.root.vals
-        vals.append("5555")
-        vals.append("aaaaaa")
+    ################################
 
-        h5file.close()
-        
-        self.expectException("wrongTypes2.h5")
-    #############################################
+    def _storeArray(self, index, val):
 
-    def expectException(self,filename):
-        mydict = None
-        def testStmt():
-            mydict = PytableShelf(filename)
-        try:
-            self.assertRaises(AttributeError, testStmt)
-        finally:
-            if mydict is not None:
-                mydict.close()
-            os.remove(filename)
+        if self.arrayFilter.complevel == 0:
+            self.file.createArray(self.fileArrays, _arrayName(index), val)
+        else:
+            node = self.file.createCArray(self.fileArrays, _arrayName(index),
+                                          tables.Atom.from_dtype(val.dtype),
+                                          val.shape,
+                                          filters = self.arrayFilter)
+            node[:] = val
 
-###################################################
+    ################################
 
-class MyObj(object):
+    def _removeArray(self, index):
 
-    def __init__(self, str):
-        self.str = str
+        node = self._arrayNode(index)
+        if node is not None:
+            node.remove()
 
-    def __eq__(self,other):
-        return self.str == other.str
+    ################################
 
-class DictOpsTestCase(unittest.TestCase):
+    def _markDead(self, indices):
 
-    def setUp(self):
+        self._touchIndex()
+        self.fileDead.append(indices)
+        for index in indices:
+            self._removeArray(index)
 
-        h5file = tables.openFile("test.h5", "w")
+    ################################
 
-        h5file.createVLArray("/", "keys", tables.VLStringAtom(),
-                             filters=tables.Filters(complevel=1))
-        keys = h5file.root.keys
+    def garbage(self):
+        '''Fraction of the rows in the file that are dead.'''
+        nrows = len(self.fileKeys)
+        if nrows == 0:
+            return 0.
+        return float(self._ndead()) / nrows
 
-        h5file.createVLArray("/", "vals", tables.ObjectAtom(),
-                             filters=tables.Filters(complevel=1))
-        vals = h5file.root.vals
-        
-        keys.append('1')
-        vals.append(MyObj('1'))
+    ################################
 
-        keys.append('2')
-        vals.append(MyObj('2'))
+    def _maybeCollectGarbage(self):
+        '''Once the garbage ratio is crossed, start or continue compacting:
+           in the background thread, or by one step of compactStepRows
+           rows per call.'''
 
-        keys.append('list')
-        vals.append([1,2,3])
+        if self.iterating or self.garbage() <= self.garbageRatio:
+            return
+        if self.background:
+            self.startCompaction()
+        else:
+            self.compact(max_seconds = 0, stepRows = self.compactStepRows)
 
-        h5file.close()
+    ################################
 
-        self.shelf = PytableShelf('test.h5')
+    def compact(self, max_seconds = None, stepRows = 1000):
+        '''Copy live rows into a fresh file, stepRows at a time, until
+           done or until max_seconds have passed. Returns the number of
+           bytes reclaimed once the new file has replaced the old one, or
+           None if the compaction is still in progress.'''
+
+        self._checkWritable()
+        start = time.time()
+        while True:
+            with self.lock:
+                with self._access():
+                    if self.compactor is None:
+                        self.compactor = ShelfCompactor(self)
+                    done = self.compactor.step(stepRows)
+                if done:
+                    with self._commit():
+                        reclaimed = self.compactor.finish()
+                    self.compactor = None
+                    return reclaimed
+            if max_seconds is not None and \
+                    time.time() - start >= max_seconds:
+                return None
 
-    ########################
+    ################################
 
-    def tearDown(self):
+    def startCompaction(self, stepRows = 1000):
+        '''Compact in a daemon thread, taking the shelf lock for one step
+           of stepRows rows at a time, and pausing while the shelf is being
+           iterated over.'''
+
+        self._checkWritable()
+        if self.compactThread is not None and self.compactThread.isAlive():
+            return
+        self.stopCompaction.clear()
+
+        def run():
+            while not self.stopCompaction.isSet():
+                with self.lock:
+                    if not self.iterating and \
+                            self.compact(max_seconds = 0,
+                                         stepRows = stepRows) is not None:
+                        return
+                time.sleep(0)
+
+        self.compactThread = threading.Thread(target = run)
+        self.compactThread.setDaemon(True)
+        self.compactThread.start()
 
-        self.shelf.close()
-        os.remove('test.h5')
+    ################################
 
-    #######################
+    def stopBackgroundCompaction(self):
 
-    def testGetItem(self):
-        self.assertEqual([1,2,3], self.shelf['list'])
-        self.assertEqual(MyObj('2'), self.shelf['2'])
+        if self.compactThread is not None:
+            self.stopCompaction.set()
+            self.compactThread.join()
+            self.compactThread = None
 
+    #################################
+    
+    def _checkKey(self, key):
 
-    #####################
+        if not type(key) == type(''):
+            raise TypeError, "keys and values must be strings"
 
-    def testGetNonexistItem(self):
-        self.assertRaises(KeyError, lambda: self.shelf['fake'])
+    #################################
+
+    def _writeMany(self, items):
+        '''Apply (key, val) pairs in order; val may be _deleted.'''
+
+        with self.lock, self._commit():
+            self._touchIndex()
+            dead = []
+            for (key, val) in items:
+                if self.cache is not None:
+                    self.cache.discard(key)
+                index = self._findIndex(key)
+                if val is _deleted:
+                    if index != self._objectNotFound:
+                        dead.append(index)
+                        self._setRow(key, None)
+                    continue
+
+                # the array is written before its row, so a leftover node
+                # from an interrupted write may occupy the new row number
+                newIndex = len(self.fileKeys)
+                self._removeArray(newIndex)
+                if self._isNativeArray(val):
+                    self._storeArray(newIndex, val)
+                    val = None
+
+                self.fileKeys.append(key)
+                self.fileVals.append(val)
+
+                if index != self._objectNotFound:
+                    dead.append(index)
+                self._setRow(key, newIndex)
+
+            if dead:
+                self._markDead(dead)
+            self._maybeCollectGarbage()
+
+    #################################
+    
+    def __setitem__(self, key, val):
+
+        self._checkKey(key)
+        self._checkWritable()
+        with self.lock:
+            if self.pending is not None:
+                self.pending[key] = val
+                if len(self.pending) >= self.maxPending:
+                    self.flushPending()
+            else:
+                self._writeMany([(key, val)])
+
+    #################################
+
+    def __delitem__(self, key):
+
+        self._checkWritable()
+        with self.lock:
+            if key not in self:
+                raise KeyError
+            if self.pending is not None:
+                self.pending[key] = _deleted
+                if len(self.pending) >= self.maxPending:
+                    self.flushPending()
+            else:
+                self._writeMany([(key, _deleted)])
+
+    #################################
+
+    def setmany(self, items):
+        '''Store every (key, val) pair of a dict or sequence in one pass.'''
+
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        items = list(items)
+        for (key, val) in items:
+            self._checkKey(key)
+        self._checkWritable()
+
+        with self.lock:
+            if self.pending is not None:
+                self.pending.update(items)
+                if len(self.pending) >= self.maxPending:
+                    self.flushPending()
+            else:
+                self._writeMany(items)
+
+    #################################
+
+    def update(self, other = None, **kwargs):
+        if other is not None:
+            self.setmany(other)
+        if kwargs:
+            self.setmany(kwargs)
+
+    #################################
+
+    def getmany(self, keys):
+        '''Retrieve a list of values, reading the file in row order.'''
+
+        keys = list(keys)
+        with self.lock:
+            self.flushPending()
+            indices = []
+            for key in keys:
+                index = self._findIndex(key)
+                if index == self._objectNotFound:
+                    raise KeyError(key)
+                indices.append(index)
+
+            vals = [None] * len(indices)
+            order = sorted(range(len(indices)), key = indices.__getitem__)
+            with self._access():
+                for i in order:
+                    vals[i] = self._read(keys[i], indices[i])
+            return vals
+
+    #################################
+
+    @contextmanager
+    def batch(self, maxPending = 1000):
+        '''Buffer writes and deletes in memory, applying them in one
+           pass whenever maxPending keys are waiting and on exit.'''
+
+        with self.lock:
+            if self.pending is None:
+                self.pending = {}
+                self.maxPending = maxPending
+            self.batchDepth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batchDepth -= 1
+                if self.batchDepth == 0:
+                    self.flushPending()
+                    if not self.transient:
+                        self.pending = None
+
+    #################################
+
+    def flushPending(self):
+        '''Write out any buffered writes and deletes.'''
+
+        with self.lock:
+            if not self.pending:
+                return
+            items = self.pending.items()
+            self.pending.clear()
+            self._writeMany(items)
+
+    ##################################
+
+    def has_key(self, key):
+        if self.pending is not None and key in self.pending:
+            return self.pending[key] is not _deleted
+        return key in self.index
+
+    __contains__ = has_key
+
+    ##################################
+
+    def __len__(self):
+        with self.lock:
+            n = len(self.index)
+            if self.pending:
+                for (key, val) in self.pending.iteritems():
+                    if val is _deleted:
+                        if key in self.index:
+                            n -= 1
+                    elif key not in self.index:
+                        n += 1
+            return n
+
+    ##################################
+
+    def keys(self):
+        with self.lock:
+            live = sorted([(index, key) for (key, index) in \
+                               self.index.iteritems()])
+            keys = [key for (index, key) in live]
+            if self.pending:
+                # buffered keys will be appended when they are written
+                keys = [key for key in keys if key not in self.pending]
+                keys.extend([key for (key, val) in self.pending.iteritems() \
+                                 if val is not _deleted])
+        return keys
+
+    ##################################
+
+    def _iterrows(self, values, chunkRows):
+        '''Yield the (key, val) pairs of live rows in file order, reading
+           chunkRows rows of /keys (and of /vals if values is true) at a
+           time, then those of buffered writes, in the order of keys().
+           Rows written after the iteration starts are not seen, and
+           writes do not start compaction steps until it has finished.'''
+
+        with self.lock:
+            self.iterating += 1
+            pending = {}
+            if self.pending:
+                pending = self.pending.copy()
+            generation = self.generation
+        try:
+            start = 0
+            stop = None
+            while True:
+                with self.lock:
+                    if self.generation != generation:
+                        raise RuntimeError, "Shelf compacted during " \
+                            "iteration: %s" % self.filename
+                    with self._access():
+                        if stop is None:
+                            stop = len(self.fileKeys)
+                        if start >= stop:
+                            break
+                        end = min(start + chunkRows, stop)
+                        keys = self.fileKeys.read(start, end)
+                        live = [i for i in range(len(keys)) \
+                                    if self.index.get(keys[i]) == start + i \
+                                    and keys[i] not in pending]
+                        chunk = []
+                        if values and live:
+                            vals = self.fileVals.read(start, end)
+                            for i in live:
+                                node = self._arrayNode(start + i)
+                                if node is not None:
+                                    vals[i] = self._wrapArray(node,
+                                                              start + i)
+                                chunk.append((keys[i], vals[i]))
+                        else:
+                            chunk = [(keys[i], None) for i in live]
+                for item in chunk:
+                    yield item
+                start = end
+
+            for (key, val) in pending.iteritems():
+                if val is _deleted:
+                    continue
+                if values:
+                    val = copy.deepcopy(val)
+                else:
+                    val = None
+                yield (key, val)
+        finally:
+            with self.lock:
+                self.iterating -= 1
+
+    ##################################
+
+    def iterkeys(self, chunkRows = 1000):
+        for (key, val) in self._iterrows(False, chunkRows):
+            yield key
+
+    __iter__ = iterkeys
+
+    def itervalues(self, chunkRows = 1000):
+        for (key, val) in self._iterrows(True, chunkRows):
+            yield val
+
+    def iteritems(self, chunkRows = 1000):
+        return self._iterrows(True, chunkRows)
+
+######################################
+
+class ShelfCompactor(object):
+    '''Incrementally copies the live rows of a PytableShelf into
+       filename + suffix. Rows appended to the shelf while the copy is in
+       progress are picked up by finish(), which then renames the new file
+       over the old one.'''
+
+    suffix = '.compact'
+
+    def __init__(self, shelf):
+        self.shelf = shelf
+        self.tmpname = shelf.filename + self.suffix
+        self.dst = tables.openFile(self.tmpname, mode='w')
+        _createStructure(self.dst, shelf.filter)
+        self.rows = sorted(shelf.index.itervalues())
+        self.stop = len(shelf.fileKeys)
+        self.next = 0
+
+    ###############################
+
+    def step(self, nrows):
+        '''Copy up to nrows more rows; returns True once all rows live at
+           the start of the compaction have been copied.'''
+        for row in self.rows[self.next:self.next + nrows]:
+            self._copyRow(row)
+        self.next = min(self.next + nrows, len(self.rows))
+        return self.next == len(self.rows)
+
+    ###############################
+
+    def _copyRow(self, row):
+
+        newRow = len(self.dst.root.keys)
+        node = self.shelf._arrayNode(row)
+        if isinstance(node, tables.CArray):
+            # recompress with the shelf's current settings
+            node.copy(self.dst.root.arrays, _arrayName(newRow),
+                      filters = self.shelf.arrayFilter)
+        elif node is not None:
+            node.copy(self.dst.root.arrays, _arrayName(newRow))
+        self.dst.root.keys.append(self.shelf.fileKeys[row])
+        self.dst.root.vals.append(self.shelf.fileVals[row])
+        return newRow
+
+    ###############################
+
+    def finish(self):
+        '''Copy the rows written since the compaction started, swap the new
+           file into place and return the number of bytes reclaimed.'''
+
+        shelf = self.shelf
+        dstKeys = self.dst.root.keys
+
+        index = {}
+        copied = set()
+        tail = []
+        # old row -> new row of every live row
+        moved = {}
+        for (key, row) in shelf.index.iteritems():
+            if row < self.stop:
+                newRow = bisect.bisect_left(self.rows, row)
+                index[key] = newRow
+                copied.add(newRow)
+                moved[row] = newRow
+            else:
+                tail.append((row, key))
+        tail.sort()
+        for (row, key) in tail:
+            index[key] = moved[row] = self._copyRow(row)
+
+        dead = [newRow for newRow in xrange(len(self.rows)) \
+                    if newRow not in copied]
+        if dead:
+            self.dst.root.dead.append(dead)
+        for newRow in dead:
+            if _arrayName(newRow) in self.dst.root.arrays:
+                self.dst.removeNode(self.dst.root.arrays, _arrayName(newRow))
+
+        self.dst.createVLArray("/", "index", tables.ObjectAtom(),
+                               filters = shelf.filter)
+        self.dst.root.index.append(index)
+        self.dst.root.index.attrs.nrows = len(dstKeys)
+        self.dst.root.index.attrs.ndead = len(dead)
+        self.dst.close()
+        self.dst = None
+
+        fd = os.open(self.tmpname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        # proxies of overwritten or deleted keys lost their nodes already
+        proxies = [proxy for proxy in shelf.proxies \
+                       if proxy.node._v_isopen and proxy.row in moved]
+        shelf.file.close()
+        before = os.path.getsize(shelf.filename)
+        after = os.path.getsize(self.tmpname)
+        os.rename(self.tmpname, shelf.filename)
+
+        shelf._openFile('a')
+        shelf.formatFile()
+        shelf.generation += 1
+        for proxy in proxies:
+            proxy.row = moved[proxy.row]
+            proxy.node = shelf._arrayNode(proxy.row)
+
+        return before - after
+
+    ###############################
+
+    def abandon(self):
+
+        if self.dst is not None:
+            self.dst.close()
+            self.dst = None
+        if os.path.exists(self.tmpname):
+            os.remove(self.tmpname)
+
+    
+
+######################################
+
+def _shardFilename(dirname, i):
+    return os.path.join(dirname, 'shard%03d.h5' % i)
+
+######################################
+
+def openShard(dirname, i, **keywords):
+    '''Open shard i of a ShardedShelf as a PytableShelf.'''
+    return PytableShelf(_shardFilename(dirname, i), **keywords)
+
+######################################
+
+class _MissingShard(object):
+    '''Stands in, read-only and empty, for a shard whose file has not
+       been written yet.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def close(self):
+        pass
+
+    flush = close
+
+    def __len__(self):
+        return 0
+
+    def keys(self):
+        return []
+
+    def has_key(self, key):
+        return False
+
+    __contains__ = has_key
+
+    def __getitem__(self, key):
+        raise KeyError(key)
+
+    def getmany(self, keys):
+        for key in keys:
+            raise KeyError(key)
+        return []
+
+    def iterkeys(self, chunkRows = 1000):
+        return iter([])
+
+    itervalues = iteritems = iterkeys
+
+    def _readOnly(self, *args):
+        raise IOError, "Shelf is read-only: %s" % self.filename
+
+    __setitem__ = __delitem__ = setmany = _readOnly
+
+######################################
+
+class ShardedShelf(UserDict.DictMixin):
+    '''Partitions keys over several PytableShelf files in one directory.
+       The number of shards is recorded in dirname/SHARDS when the
+       directory is created, and must not change afterwards.'''
+
+    def __init__(self, dirname, nshards = None, **keywords):
+        self.dirname = dirname
+        self.keywords = keywords
+        self.shards = []
+
+        countfile = os.path.join(dirname, 'SHARDS')
+        if os.path.exists(countfile):
+            input = file(countfile)
+            try:
+                stored = int(input.read())
+            finally:
+                input.close()
+            if nshards is not None and nshards != stored:
+                raise ValueError, "%s has %d shards, not %d" % \
+                    (dirname, stored, nshards)
+            nshards = stored
+        else:
+            if nshards is None or nshards < 1:
+                raise ValueError, "Number of shards needed for %s" % dirname
+            if keywords.get('mode', 'a') == 'r':
+                raise IOError, "Cannot Open Directory: %s" % dirname
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            output = file(countfile, 'w')
+            try:
+                output.write('%d\n' % nshards)
+            finally:
+                output.close()
+
+        self.nshards = nshards
+        self.shards = [None] * nshards
+
+    ###############################
+
+    def __del__(self):
+
+        self.close()
+
+    ###############################
+
+    def close(self):
+        for i in range(len(self.shards)):
+            if self.shards[i] is not None:
+                self.shards[i].close()
+                self.shards[i] = None
+
+    ###############################
+
+    def flush(self):
+        for shard in self.shards:
+            if shard is not None:
+                shard.flush()
+
+    ###############################
+
+    def shardIndex(self, key):
+        '''Number of the shard that holds key; stable across processes.'''
+        return (zlib.crc32(key) & 0xffffffff) % self.nshards
+
+    ###############################
+
+    def shard(self, i, write = False):
+        '''Shard i, created if write is true and the shelf is writable;
+           a shard that has never been written is otherwise stood in for
+           by an empty placeholder.'''
+
+        if self.shards[i] is None:
+            filename = _shardFilename(self.dirname, i)
+            if (not write or self.keywords.get('mode', 'a') == 'r') and \
+                    not os.path.exists(filename):
+                return _MissingShard(filename)
+            self.shards[i] = openShard(self.dirname, i, **self.keywords)
+        return self.shards[i]
+
+    ###############################
+
+    def _shardFor(self, key, write = False):
+        if not type(key) == type(''):
+            raise TypeError, "keys and values must be strings"
+        return self.shard(self.shardIndex(key), write)
+
+    ###############################
+
+    def __getitem__(self, key):
+        return self._shardFor(key)[key]
+
+    def __setitem__(self, key, val):
+        self._shardFor(key, True)[key] = val
+
+    def __delitem__(self, key):
+        # a missing key need not create its shard
+        if self.keywords.get('mode', 'a') != 'r' and \
+                not self._shardFor(key).has_key(key):
+            raise KeyError(key)
+        del self._shardFor(key, True)[key]
+
+    def has_key(self, key):
+        return self._shardFor(key).has_key(key)
+
+    __contains__ = has_key
+
+    ###############################
+
+    def _partition(self, keys):
+
+        parts = {}
+        for (i, key) in enumerate(keys):
+            if not type(key) == type(''):
+                raise TypeError, "keys and values must be strings"
+            parts.setdefault(self.shardIndex(key), []).append(i)
+        return parts
+
+    ###############################
+
+    def setmany(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        items = list(items)
+        parts = self._partition([key for (key, val) in items])
+        for (i, positions) in parts.iteritems():
+            self.shard(i, True).setmany([items[j] for j in positions])
+
+    def update(self, other = None, **kwargs):
+        if other is not None:
+            self.setmany(other)
+        if kwargs:
+            self.setmany(kwargs)
+
+    def getmany(self, keys):
+        keys = list(keys)
+        vals = [None] * len(keys)
+        for (i, positions) in self._partition(keys).iteritems():
+            shardVals = self.shard(i).getmany([keys[j] for j in positions])
+            for (j, val) in zip(positions, shardVals):
+                vals[j] = val
+        return vals
+
+    ###############################
+
+    def __len__(self):
+        return sum([len(self.shard(i)) for i in range(self.nshards)])
+
+    def keys(self):
+        keys = []
+        for i in range(self.nshards):
+            keys.extend(self.shard(i).keys())
+        return keys
+
+    def iterkeys(self, chunkRows = 1000):
+        for i in range(self.nshards):
+            for key in self.shard(i).iterkeys(chunkRows):
+                yield key
+
+    __iter__ = iterkeys
+
+    def itervalues(self, chunkRows = 1000):
+        for i in range(self.nshards):
+            for val in self.shard(i).itervalues(chunkRows):
+                yield val
+
+    def iteritems(self, chunkRows = 1000):
+        for i in range(self.nshards):
+            for item in self.shard(i).iteritems(chunkRows):
+                yield item
+
+######################################
+
+def _spillKey(key):
+    '''The shelf key of a SpillStorage key. A unicode key equal to a str
+       (that is, an ASCII one) gets the same shelf key as that str.'''
+
+    if isinstance(key, unicode):
+        try:
+            return 's' + key.encode('ascii')
+        except UnicodeError:
+            return 'u' + key.encode('utf-8')
+    return 's' + key
+
+class SpillStorage(UserDict.DictMixin):
+    '''Dictionary that keeps at most memoryBytes of values in memory,
+       moving the least recently used large ones to a temporary shelf.
+       Keys must be strings.'''
+
+    def __init__(self, memoryBytes = 2**30, minSpillBytes = 2**16,
+                 directory = None, compression = 0):
+        self.memoryBytes = memoryBytes
+        self.minSpillBytes = minSpillBytes
+        self.directory = directory
+        self.compression = compression
+
+        self.memory = OrderedDict()     # key -> (value, size), LRU first
+        # keys in memory of at least minSpillBytes, LRU first
+        self.spillable = OrderedDict()
+        self.nbytes = 0
+        self.spilled = set()
+        self.shelf = None
+        self.filename = None
+        self.lock = threading.RLock()
+
+    ###############################
+
+    def __del__(self):
+
+        self.close()
+
+    ###############################
+
+    def close(self):
+        '''Forget the spilled values and remove the temporary file.'''
+
+        if self.shelf is not None:
+            self.shelf.close()
+            self.shelf = None
+            os.remove(self.filename)
+        self.spilled = set()
+
+    ###############################
+
+    def _shelf(self):
+
+        if self.shelf is None:
+            (fd, self.filename) = tempfile.mkstemp(suffix = '.h5',
+                                                   prefix = 'spill',
+                                                   dir = self.directory)
+            os.close(fd)
+            os.remove(self.filename)
+            self.shelf = PytableShelf(self.filename,
+                                      compression = self.compression,
+                                      nativeArrays = True)
+        return self.shelf
+
+    ###############################
+
+    def _spill(self):
+        '''Move values out of memory, oldest first, until the rest fit the
+           budget. The most recently used value always stays.'''
+
+        if self.nbytes <= self.memoryBytes:
+            return
+
+        newest = next(reversed(self.memory))
+        while self.spillable and self.nbytes > self.memoryBytes:
+            key = next(iter(self.spillable))
+            if key == newest:
+                break
+            del self.spillable[key]
+            (val, size) = self.memory.pop(key)
+            self._shelf()[_spillKey(key)] = val
+            self.spilled.add(key)
+            self.nbytes -= size
+
+    ###############################
+
+    def _keep(self, key, val):
+
+        size = _sizeof(val)
+        self.memory[key] = (val, size)
+        if size >= self.minSpillBytes:
+            self.spillable[key] = None
+        self.nbytes += size
+        self._spill()
+
+    ###############################
+
+    def _discard(self, key):
+
+        entry = self.memory.pop(key, None)
+        if entry is not None:
+            self.spillable.pop(key, None)
+            self.nbytes -= entry[1]
+            return True
+        if key in self.spilled:
+            del self.shelf[_spillKey(key)]
+            self.spilled.discard(key)
+            return True
+        return False
+
+    ###############################
+
+    def __getitem__(self, key):
+
+        with self.lock:
+            entry = self.memory.pop(key, None)
+            if entry is not None:
+                self.memory[key] = entry
+                if key in self.spillable:
+                    del self.spillable[key]
+                    self.spillable[key] = None
+                return entry[0]
+            if key not in self.spilled:
+                raise KeyError, key
+
+            val = self.shelf[_spillKey(key)]
+            if isinstance(val, ArrayProxy):
+                val = val.read()
+            del self.shelf[_spillKey(key)]
+            self.spilled.discard(key)
+            self._keep(key, val)
+            return val
+
+    def __setitem__(self, key, val):
+
+        if not isinstance(key, basestring):
+            raise TypeError, "SpillStorage keys must be strings"
+        with self.lock:
+            self._discard(key)
+            self._keep(key, val)
+
+    def __delitem__(self, key):
+
+        with self.lock:
+            if not self._discard(key):
+                raise KeyError, key
+
+    def has_key(self, key):
+        with self.lock:
+            return key in self.memory or key in self.spilled
+
+    __contains__ = has_key
+
+    ###############################
+
+    def __len__(self):
+        with self.lock:
+            return len(self.memory) + len(self.spilled)
+
+    def keys(self):
+        with self.lock:
+            return self.memory.keys() + list(self.spilled)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    ###############################
+
+    def isSpilled(self, key):
+        '''True if key is only held on disk at the moment.'''
+        return key in self.spilled
+
+    
+
+#############################################
+#TESTING
+#############################################
+
+
+import unittest
+import os
+
+    
+class FileStructTestCase(unittest.TestCase):
+
+    def testNoFile(self):
+        
+        mydict = PytableShelf("testNoFile.h5")
+        self.failUnless(os.path.exists('testNoFile.h5'))
+        mydict.close()
+        os.remove('testNoFile.h5')
+
+    ###############################
+
+    def testPartialFile(self):
+        
+        h5file = tables.openFile("incorrectFile.h5", mode="w")
+        h5file.createVLArray("/", "vals", tables.ObjectAtom(),
+                             filters = tables.Filters(complevel=1))
+        arr = h5file.root.vals
+        arr.append([5,6,"7"])
+        arr.append("1,2,3")
+        h5file.close()
+        
+        self.expectException("incorrectFile.h5")
+    ###################################
+
+    def testWrongDims(self):
+
+        h5file = tables.openFile("wrongDims.h5", mode="w")
+        
+        h5file.createVLArray("/", "keys", tables.VLStringAtom(),
+                             filters = tables.Filters(complevel=1))
+        keys = h5file.root.keys
+        keys.append("key1")
+        keys.append("key2")
+        
+        h5file.createVLArray("/", "vals", tables.ObjectAtom(),
+                             filters = tables.Filters(complevel=1))
+        vals = h5file.root.vals
+        vals.append([1,2,3])
+
+        h5file.close()
+        
+        self.expectException("wrongDims.h5")
+
+    ########################################
+
+    def testWrongTypes1(self):
+
+        h5file = tables.openFile("wrongTypes1.h5", mode="w")
+
+        h5file.createTable("/","keys", {"key" : tables.StringCol(itemsize=16)})
+        row = h5file.root.keys.row
+        row['key'] = 'key1'
+        row.append()
+        h5file.root.keys.flush()
+
+        h5file.createVLArray("/", "vals", tables.ObjectAtom(),
+                             filters=tables.Filters(complevel=1))
+        vals = h5file.root.vals
+        vals.append([1,2,3])
+
+        h5file.close()
+        
+        self.expectException("wrongTypes1.h5")
+
+    ###########################################
+
+    def testWrongTypes2(self):
+        
+        h5file = tables.openFile("wrongTypes2.h5", mode="w")
+        
+        h5file.createVLArray("/", "keys", tables.VLStringAtom(),
+                             filters=tables.Filters(complevel=1))
+        keys = h5file.root.keys
+        keys.append("key1")
+        keys.append("key2")
+        
+        h5file.createVLArray("/", "vals", tables.VLStringAtom(),
+                             filters=tables.Filters(complevel=1))
+        vals = h5file.root.vals
+        vals.append("5555")
+        vals.append("aaaaaa")
+
+        h5file.close()
+        
+        self.expectException("wrongTypes2.h5")
+    #############################################
+
+    def testOldFormatReadOnly(self):
+
+        # as written before tombstones, native arrays and the index
+        h5file = tables.openFile("oldFormat.h5", mode="w")
+        h5file.createVLArray("/", "keys", tables.VLStringAtom(),
+                             filters=tables.Filters(complevel=1))
+        h5file.createVLArray("/", "vals", tables.ObjectAtom(),
+                             filters=tables.Filters(complevel=1))
+        h5file.root.keys.append('a')
+        h5file.root.vals.append([1, 2])
+        h5file.root.keys.append('b')
+        h5file.root.vals.append('bee')
+        h5file.close()
+
+        try:
+            for locking in (False, True):
+                mydict = PytableShelf("oldFormat.h5", mode = 'r',
+                                      locking = locking)
+                self.assertEqual(['a', 'b'], mydict.keys())
+                self.assertEqual([1, 2], mydict['a'])
+                self.assertEqual([('a', [1, 2]), ('b', 'bee')],
+                                 list(mydict.iteritems()))
+                self.assertEqual(0., mydict.garbage())
+                mydict.close()
+            mydict = open("oldFormat.h5", 'r')
+            self.assertEqual('bee', mydict['b'])
+            mydict.close()
+            h5file = tables.openFile("oldFormat.h5", mode="r")
+            self.failIf('/dead' in h5file)
+            h5file.close()
+        finally:
+            for suffix in ('', '.lock', '.intent'):
+                if os.path.exists("oldFormat.h5" + suffix):
+                    os.remove("oldFormat.h5" + suffix)
+
+    #############################################
+
+    def expectException(self,filename):
+        mydict = None
+        def testStmt():
+            mydict = PytableShelf(filename)
+        try:
+            self.assertRaises(AttributeError, testStmt)
+        finally:
+            if mydict is not None:
+                mydict.close()
+            os.remove(filename)
+
+###################################################
+
+class MyObj(object):
+
+    def __init__(self, str):
+        self.str = str
+
+    def __eq__(self,other):
+        return self.str == other.str
+
+class DictOpsTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        h5file = tables.openFile("test.h5", "w")
+
+        h5file.createVLArray("/", "keys", tables.VLStringAtom(),
+                             filters=tables.Filters(complevel=1))
+        keys = h5file.root.keys
+
+        h5file.createVLArray("/", "vals", tables.ObjectAtom(),
+                             filters=tables.Filters(complevel=1))
+        vals = h5file.root.vals
+        
+        keys.append('1')
+        vals.append(MyObj('1'))
+
+        keys.append('2')
+        vals.append(MyObj('2'))
+
+        keys.append('list')
+        vals.append([1,2,3])
+
+        h5file.close()
+
+        self.shelf = PytableShelf('test.h5')
+
+    ########################
+
+    def tearDown(self):
+
+        self.shelf.close()
+        os.remove('test.h5')
+
+    #######################
+
+    def testGetItem(self):
+        self.assertEqual([1,2,3], self.shelf['list'])
+        self.assertEqual(MyObj('2'), self.shelf['2'])
+
+
+    #####################
+
+    def testGetNonexistItem(self):
+        self.assertRaises(KeyError, lambda: self.shelf['fake'])
+
+    ######################
+
+    def testGetItemisCopy(self):
+        l = self.shelf['list']
+        l[1] = 4
+        self.assertEqual([1,2,3], self.shelf['list'])
 
     ######################
 
-    def testGetItemisCopy(self):
+    def testSetItem(self):
+        item = [1,2,['gh','bc']]
+        self.shelf['newitem'] = [1,2,['gh','bc']]
+        self.assertEqual(item, self.shelf['newitem'])
+
+    #######################
+
+    def testResetItem(self):
+        item = [1,2,['gh','bc']]
+        self.shelf['list'] = [1,2,['gh','bc']]
+        self.assertEqual(item, self.shelf['list'])
+
+    #####################
+
+    def testBadKey(self):
+        def stmt():
+            self.shelf[5] = "a"
+        self.assertRaises(TypeError, stmt)
+
+    #######################
+
+    def testDelKey(self):
+        del self.shelf['2']
+        self.assertRaises(KeyError, lambda: self.shelf['2'])
+
+    #######################
+
+    def testDelNonexistantKey(self):
+        def stmt():
+            del self.shelf['10']
+        self.assertRaises(KeyError, stmt)
+
+    ########################
+
+    def testKeys(self):
+        self.assertEqual(['1','2','list'], self.shelf.keys())
+    
+    ########################
+
+    def testHasKey(self):
+        self.failUnless(self.shelf.has_key('2'))
+        self.failIf(self.shelf.has_key('fake'))
+
+    ########################
+
+    def testWriteOut(self):
+        self.shelf['add'] = MyObj('add')
+        self.shelf['2'] = MyObj('~2')
+        del self.shelf['1']
+        self.shelf.close()
+        self.shelf = PytableShelf('test.h5')
+        
+        self.assertEqual(MyObj('add'), self.shelf['add'])
+        self.assertEqual(MyObj('~2'), self.shelf['2'])
+        self.assertRaises(KeyError, lambda: self.shelf['1'])
+        self.assertEqual([1,2,3], self.shelf['list'])
+        
+    ########################
+
+    def testLen(self):
+        self.assertEqual(3, len(self.shelf))
+        del self.shelf['1']
+        self.assertEqual(2, len(self.shelf))
+
+###################################################
+
+class IndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.shelf = PytableShelf('index.h5')
+        self.shelf['a'] = 1
+        self.shelf['b'] = 2
+        self.shelf['c'] = 3
+        self.shelf.close()
+
+    ########################
+
+    def tearDown(self):
+
+        self.shelf.close()
+        os.remove('index.h5')
+
+    ########################
+
+    def testIndexWritten(self):
+        h5file = tables.openFile('index.h5', 'r')
+        try:
+            self.assertEqual({'a' : 0, 'b' : 1, 'c' : 2},
+                             h5file.root.index[0])
+            self.assertEqual(3, h5file.root.index.attrs.nrows)
+        finally:
+            h5file.close()
+
+    ########################
+
+    def testMissingIndex(self):
+        h5file = tables.openFile('index.h5', 'a')
+        h5file.removeNode('/index')
+        h5file.close()
+
+        self.shelf = PytableShelf('index.h5')
+        self.assertEqual(2, self.shelf['b'])
+        self.assertEqual(3, len(self.shelf))
+
+    ########################
+
+    def testStaleIndex(self):
+        h5file = tables.openFile('index.h5', 'a')
+        h5file.root.keys.append('d')
+        h5file.root.vals.append(4)
+        h5file.close()
+
+        self.shelf = PytableShelf('index.h5')
+        self.assertEqual(4, self.shelf['d'])
+        self.assertEqual(1, self.shelf['a'])
+
+    ########################
+
+    def testIndexInvalidatedBeforeFlush(self):
+        self.shelf = PytableShelf('index.h5')
+        del self.shelf['a']
+        self.assertEqual(PytableShelf._staleIndex,
+                         self.shelf.fileIndex.attrs.nrows)
+        self.shelf.flush()
+        # the change is added to the index, which is rewritten on close
+        self.assertEqual([{'a' : 0, 'b' : 1, 'c' : 2}, {'a' : None}],
+                         self.shelf.fileIndex.read())
+        self.assertEqual(3, self.shelf.fileIndex.attrs.nrows)
+        self.shelf._loadIndex()
+        self.assertEqual({'b' : 1, 'c' : 2}, self.shelf.index)
+        self.failIf(self.shelf.indexDirty)
+        self.shelf.close()
+
+        self.shelf = PytableShelf('index.h5')
+        self.assertEqual([{'b' : 1, 'c' : 2}], self.shelf.fileIndex.read())
+
+    ########################
+
+    def testIndexChangesPileUp(self):
+        self.shelf = PytableShelf('index.h5', garbageRatio = 100.)
+        for i in range(3):
+            self.shelf['a'] = i
+            self.shelf.flush()
+        self.assertEqual(4, len(self.shelf.fileIndex))
+        # a fourth change would outnumber the three keys
+        self.shelf['b'] = 5
+        self.shelf.flush()
+        self.assertEqual([{'a' : 5, 'b' : 6, 'c' : 2}],
+                         self.shelf.fileIndex.read())
+
+
+###################################################
+
+class LogStructureTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.shelf = PytableShelf('log.h5', garbageRatio = 1.)
+        self.shelf['a'] = 1
+        self.shelf['b'] = 2
+
+    ########################
+
+    def tearDown(self):
+
+        self.shelf.close()
+        os.remove('log.h5')
+
+    ########################
+
+    def testOverwriteAppends(self):
+        self.shelf['a'] = 10
+        self.assertEqual(3, len(self.shelf.fileKeys))
+        self.assertEqual([0], self.shelf.fileDead.read().tolist())
+        self.assertEqual(10, self.shelf['a'])
+        self.assertEqual(['b', 'a'], self.shelf.keys())
+
+    ########################
+
+    def testDeleteTombstones(self):
+        del self.shelf['a']
+        self.assertEqual(2, len(self.shelf.fileKeys))
+        self.assertEqual([0], self.shelf.fileDead.read().tolist())
+        self.assertRaises(KeyError, lambda: self.shelf['a'])
+        self.shelf['a'] = 5
+        self.assertEqual(5, self.shelf['a'])
+
+    ########################
+
+    def testNewestWinsAfterReopen(self):
+        self.shelf['a'] = 10
+        del self.shelf['b']
+        self.shelf.close()
+        h5file = tables.openFile('log.h5', 'a')
+        h5file.removeNode('/index')
+        h5file.close()
+
+        self.shelf = PytableShelf('log.h5', garbageRatio = 1.)
+        self.assertEqual(10, self.shelf['a'])
+        self.failIf(self.shelf.has_key('b'))
+
+    ########################
+
+    def testMissingTombstone(self):
+        self.shelf.close()
+        h5file = tables.openFile('log.h5', 'a')
+        h5file.root.keys.append('a')
+        h5file.root.vals.append(10)
+        h5file.close()
+
+        self.shelf = PytableShelf('log.h5', garbageRatio = 1.)
+        self.assertEqual(10, self.shelf['a'])
+        self.assertEqual([0], self.shelf.fileDead.read().tolist())
+
+    ########################
+
+    def testCollectGarbage(self):
+        self.shelf.garbageRatio = 0.4
+        self.shelf['a'] = 10
+        self.assertEqual(3, len(self.shelf.fileKeys))
+        self.shelf['a'] = 100
+        self.assertEqual(2, len(self.shelf.fileKeys))
+        self.assertEqual(0, len(self.shelf.fileDead))
+        self.assertEqual(0., self.shelf.garbage())
+        self.assertEqual(100, self.shelf['a'])
+        self.assertEqual(2, self.shelf['b'])
+        self.assertEqual(['b', 'a'], self.shelf.keys())
+
+
+###################################################
+
+class CompactionTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.shelf = PytableShelf('compact.h5', garbageRatio = 1.)
+        for i in range(10):
+            self.shelf[str(i)] = range(1000)
+        for i in range(5):
+            del self.shelf[str(i)]
+
+    ########################
+
+    def tearDown(self):
+
+        self.shelf.close()
+        os.remove('compact.h5')
+
+    ########################
+
+    def testCompact(self):
+        self.shelf.flush()
+        reclaimed = self.shelf.compact()
+        self.failUnless(reclaimed > 0)
+        self.assertEqual(5, len(self.shelf.fileKeys))
+        self.assertEqual(0, len(self.shelf.fileDead))
+        self.assertEqual(['5', '6', '7', '8', '9'], self.shelf.keys())
+        self.assertEqual(range(1000), self.shelf['7'])
+        self.failIf(os.path.exists('compact.h5' + ShelfCompactor.suffix))
+
+    ########################
+
+    def testIncremental(self):
+        self.assertEqual(None, self.shelf.compact(max_seconds = 0,
+                                                  stepRows = 1))
+        self.failUnless(os.path.exists('compact.h5' + ShelfCompactor.suffix))
+
+        self.shelf['5'] = 'new'
+        del self.shelf['6']
+        self.shelf['10'] = 'added'
+
+        self.failIf(self.shelf.compact(stepRows = 1) is None)
+        self.assertEqual(['7', '8', '9', '5', '10'], self.shelf.keys())
+        self.assertEqual('new', self.shelf['5'])
+        self.assertEqual('added', self.shelf['10'])
+        self.failIf(self.shelf.has_key('6'))
+        self.assertEqual(2, len(self.shelf.fileDead))
+
+        self.shelf.close()
+        self.shelf = PytableShelf('compact.h5', garbageRatio = 1.)
+        self.assertEqual(['7', '8', '9', '5', '10'], self.shelf.keys())
+
+    ########################
+
+    def testStepPerWrite(self):
+        self.shelf.garbageRatio = 0.3
+        self.shelf.compactStepRows = 2
+        # six live rows to copy, two per write
+        self.shelf['10'] = 'a'
+        self.failIf(self.shelf.compactor is None)
+        self.assertEqual(11, len(self.shelf.fileKeys))
+        self.shelf['11'] = 'b'
+        self.assertEqual('a', self.shelf['10'])
+        self.assertEqual(range(1000), self.shelf['5'])
+        self.shelf['12'] = 'c'
+        self.assertEqual(None, self.shelf.compactor)
+        self.assertEqual(8, len(self.shelf.fileKeys))
+        self.assertEqual(0, len(self.shelf.fileDead))
+        self.assertEqual(['5', '6', '7', '8', '9', '10', '11', '12'],
+                         self.shelf.keys())
+
+    ########################
+
+    def testBackground(self):
+        self.shelf.startCompaction(stepRows = 1)
+        self.shelf.compactThread.join()
+        self.assertEqual(5, len(self.shelf.fileKeys))
+        self.assertEqual(range(1000), self.shelf['9'])
+
+    ########################
+
+    def testAbandonOnClose(self):
+        self.shelf.compact(max_seconds = 0, stepRows = 1)
+        self.shelf.close()
+        self.failIf(os.path.exists('compact.h5' + ShelfCompactor.suffix))
+        self.shelf = PytableShelf('compact.h5', garbageRatio = 1.)
+        self.assertEqual(10, len(self.shelf.fileKeys))
+        self.assertEqual(range(1000), self.shelf['9'])
+
+    ########################
+
+    def testCrashLeftover(self):
+        file('compact.h5' + ShelfCompactor.suffix, 'w').close()
+        self.shelf.close()
+        self.shelf = PytableShelf('compact.h5', garbageRatio = 1.)
+        self.failIf(os.path.exists('compact.h5' + ShelfCompactor.suffix))
+
+
+###################################################
+
+class NativeArrayTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.shelf = PytableShelf('arrays.h5', garbageRatio = 1.,
+                                  nativeArrays = True)
+        self.e1 = numpy.arange(5000, dtype=numpy.float64)
+        self.shelf['e1'] = self.e1
+        self.shelf['list'] = [1,2,3]
+
+    ########################
+
+    def tearDown(self):
+
+        self.shelf.close()
+        os.remove('arrays.h5')
+
+    ########################
+
+    def testStoredNatively(self):
+        node = self.shelf.file.root.arrays.r0
+        self.assertEqual(numpy.float64, node.atom.dtype)
+        self.failUnless(node.chunkshape is not None)
+        self.assertEqual(None, self.shelf.fileVals[0])
+
+    ########################
+
+    def testProxyFollowsCompaction(self):
+        proxy = self.shelf['e1']
+        self.shelf['e2'] = numpy.ones(3)
+        gone = self.shelf['e2']
+        self.shelf.garbageRatio = 0.5
+        for i in range(4):
+            self.shelf['list'] = [i]
+        self.assertEqual(1, self.shelf.generation)
+        self.failUnless(numpy.all(self.e1[0:3] == proxy[0:3]))
+        self.failUnless(numpy.all(self.e1 == numpy.asarray(proxy)))
+        self.assertEqual(0, proxy.row)
+        self.shelf.compact()
+        self.assertEqual(2, self.shelf.generation)
+        self.failUnless(numpy.all(self.e1[0:3] == proxy[0:3]))
+
+        self.shelf['e2'] = numpy.zeros(3)
+        self.assertRaises(tables.ClosedNodeError, lambda: gone[0:3])
+
+    ########################
+
+    def testProxy(self):
+        proxy = self.shelf['e1']
+        self.failUnless(isinstance(proxy, ArrayProxy))
+        self.assertEqual((5000,), proxy.shape)
+        self.assertEqual(5000, len(proxy))
+        self.failUnless(numpy.all(self.e1[1000:2000] == proxy[1000:2000]))
+        self.failUnless(numpy.all(self.e1 == numpy.asarray(proxy)))
+        self.assertEqual([1,2,3], self.shelf['list'])
+
+    ########################
+
+    def testOverwriteAndDelete(self):
+        self.shelf['e1'] = numpy.ones((3, 4), dtype=numpy.int32)
+        self.failIf('r0' in self.shelf.file.root.arrays)
+        self.assertEqual((3, 4), self.shelf['e1'].shape)
+        self.assertEqual(4, self.shelf['e1'][1].sum())
+        del self.shelf['e1']
+        self.assertEqual(0, len(self.shelf.file.root.arrays._v_children))
+
+    ########################
+
+    def testObjectArraysPickled(self):
+        self.shelf['objs'] = numpy.array(['a', None], dtype=object)
+        self.failIf(isinstance(self.shelf['objs'], ArrayProxy))
+
+    ########################
+
+    def testScalarArraysPickled(self):
+        self.shelf['scalar'] = numpy.array(3.0)
+        val = self.shelf['scalar']
+        self.failIf(isinstance(val, ArrayProxy))
+        self.assertEqual(0, val.ndim)
+        self.assertEqual(3.0, val)
+
+    ########################
+
+    def testUncompressed(self):
+        self.shelf.close()
+        self.shelf = PytableShelf('arrays.h5', compression = 0,
+                                  nativeArrays = True)
+        self.shelf['e2'] = self.e1
+        node = self.shelf._arrayNode(self.shelf._findIndex('e2'))
+        self.failUnless(isinstance(node, tables.Array))
+        self.failIf(isinstance(node, tables.CArray))
+        self.failUnless(numpy.all(self.e1[10:20] == self.shelf['e2'][10:20]))
+
+    ########################
+
+    def testCompaction(self):
+        self.shelf['e1'] = self.e1 * 2
+        self.failIf(self.shelf.compact() is None)
+        self.assertEqual(['r1'], self.shelf.file.root.arrays._v_children.keys())
+        self.failUnless(numpy.all(2 * self.e1 == self.shelf['e1'][:]))
+
+
+###################################################
+
+class BulkOpsTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.shelf = PytableShelf('bulk.h5', garbageRatio = 1.)
+        self.shelf.setmany({'a' : 1, 'b' : [2], 'c' : 'three'})
+
+    ########################
+
+    def tearDown(self):
+
+        self.shelf.close()
+        os.remove('bulk.h5')
+
+    ########################
+
+    def testSetMany(self):
+        self.assertEqual(3, len(self.shelf.fileKeys))
+        self.shelf.setmany([('a', 10), ('d', 4)])
+        self.assertEqual(10, self.shelf['a'])
+        self.assertEqual(4, self.shelf['d'])
+        self.assertEqual([0], self.shelf.fileDead.read().tolist())
+
+    ########################
+
+    def testBadKeyWritesNothing(self):
+        self.assertRaises(TypeError,
+                          lambda: self.shelf.setmany([('e', 5), (6, 6)]))
+        self.failIf(self.shelf.has_key('e'))
+
+    ########################
+
+    def testUpdate(self):
+        self.shelf.update({'a' : 10}, d = 4)
+        self.assertEqual(10, self.shelf['a'])
+        self.assertEqual(4, self.shelf['d'])
+
+    ########################
+
+    def testGetMany(self):
+        vals = self.shelf.getmany(['c', 'a', 'c'])
+        self.assertEqual(['three', 1, 'three'], vals)
+        self.assertRaises(KeyError, lambda: self.shelf.getmany(['a', 'z']))
+
+    ########################
+
+    def testBatch(self):
+        with self.shelf.batch():
+            self.shelf['d'] = [4]
+            self.shelf['a'] = 10
+            del self.shelf['b']
+            self.assertEqual(3, len(self.shelf.fileKeys))
+            self.assertEqual([4], self.shelf['d'])
+            self.failIf(self.shelf.has_key('b'))
+            self.failUnless(self.shelf.has_key('d'))
+            self.assertRaises(KeyError, lambda: self.shelf['b'])
+        self.assertEqual(None, self.shelf.pending)
+        self.assertEqual(5, len(self.shelf.fileKeys))
+        self.assertEqual(['a', 'c', 'd'], sorted(self.shelf.keys()))
+        self.assertEqual(10, self.shelf['a'])
+
+    ########################
+
+    def testBatchThreshold(self):
+        with self.shelf.batch(maxPending = 2):
+            self.shelf['d'] = 4
+            self.assertEqual(3, len(self.shelf.fileKeys))
+            self.shelf['e'] = 5
+            self.assertEqual(5, len(self.shelf.fileKeys))
+
+    ########################
+
+    def testBatchCopies(self):
+        with self.shelf.batch():
+            item = [1, 2]
+            self.shelf['d'] = item
+            self.shelf['d'].append(3)
+            self.assertEqual([1, 2], self.shelf['d'])
+
+    ########################
+
+    def testBatchFlushedOnClose(self):
+        with self.shelf.batch():
+            self.shelf['d'] = 4
+            self.shelf.close()
+        self.shelf = PytableShelf('bulk.h5')
+        self.assertEqual(4, self.shelf['d'])
+
+
+###################################################
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.shelf = PytableShelf('cache.h5', cacheBytes = 10000)
+        self.shelf['list'] = [1,2,3]
+        self.shelf['big'] = range(5000)
+        self.shelf['arr'] = numpy.arange(10)
+
+    ########################
+
+    def tearDown(self):
+
+        self.shelf.close()
+        os.remove('cache.h5')
+
+    ########################
+
+    def testCachedCopy(self):
         l = self.shelf['list']
+        self.assertEqual(1, len(self.shelf.cache))
         l[1] = 4
         self.assertEqual([1,2,3], self.shelf['list'])
 
-    ######################
+    ########################
 
-    def testSetItem(self):
-        item = [1,2,['gh','bc']]
-        self.shelf['newitem'] = [1,2,['gh','bc']]
-        self.assertEqual(item, self.shelf['newitem'])
+    def testTooBigForCache(self):
+        self.assertEqual(range(5000), self.shelf['big'])
+        self.assertEqual(0, len(self.shelf.cache))
 
-    #######################
+    ########################
 
-    def testResetItem(self):
-        item = [1,2,['gh','bc']]
-        self.shelf['list'] = [1,2,['gh','bc']]
-        self.assertEqual(item, self.shelf['list'])
+    def testInvalidate(self):
+        self.shelf['list']
+        self.shelf['list'] = [4]
+        self.assertEqual(0, len(self.shelf.cache))
+        self.assertEqual([4], self.shelf['list'])
+        del self.shelf['list']
+        self.assertRaises(KeyError, lambda: self.shelf['list'])
 
-    #####################
+    ########################
 
-    def testBadKey(self):
+    def testEviction(self):
+        self.shelf.cache = LRUCache(2 * len(cPickle.dumps(
+                    [1,2,3], cPickle.HIGHEST_PROTOCOL)))
+        self.shelf['list2'] = [4,5,6]
+        self.shelf['list3'] = [7,8,9]
+        self.shelf['list']
+        self.shelf['list2']
+        self.shelf['list']
+        self.shelf['list3']
+        self.assertEqual(['list', 'list3'], self.shelf.cache.entries.keys())
+
+    ########################
+
+    def testHitFasterThanRead(self):
+        # cheap to unpickle, so what a hit saves is the read itself
+        rows = numpy.random.RandomState(5).bytes(4 * 10**6)
+        self.shelf.cache = LRUCache(10**8)
+        self.shelf['rows'] = rows
+        self.assertEqual(rows, self.shelf['rows'])
+        def best(read):
+            times = []
+            for i in range(5):
+                start = time.time()
+                read()
+                times.append(time.time() - start)
+            return min(times)
+        index = self.shelf.index['rows']
+        hit = best(lambda: self.shelf['rows'])
+        miss = best(lambda: self.shelf.fileVals[index])
+        self.failUnless(hit < miss, (hit, miss))
+        self.assertEqual(rows, self.shelf['rows'])
+
+    ########################
+
+    def testShared(self):
+        self.shelf.close()
+        self.shelf = PytableShelf('cache.h5', cacheBytes = 10000,
+                                  cacheShared = True)
+        self.failUnless(self.shelf['list'] is self.shelf['list'])
+        arr = self.shelf['arr']
+        self.failIf(arr.flags.writeable)
+
+
+###################################################
+
+class LockingTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.shelves = []
+        self.writer = self.open()
+        self.writer['a'] = 1
+        self.writer.flush()
+
+    ########################
+
+    def tearDown(self):
+
+        for shelf in self.shelves:
+            shelf.close()
+        for suffix in ('', '.lock', '.intent', '.writer'):
+            os.remove('locking.h5' + suffix)
+
+    ########################
+
+    def open(self, mode = 'a'):
+        shelf = PytableShelf('locking.h5', mode = mode, locking = True)
+        self.shelves.append(shelf)
+        return shelf
+
+    ########################
+
+    def testManyReaders(self):
+        r1 = self.open('r')
+        r2 = self.open('r')
+        self.assertEqual(1, r1['a'])
+        self.assertEqual(1, r2['a'])
+        self.assertEqual(None, self.writer.file)
+
+    ########################
+
+    def testSingleWriter(self):
+        self.assertRaises(IOError, lambda: PytableShelf('locking.h5',
+                                                        locking = True))
+        self.writer.close()
+        self.open()
+
+    ########################
+
+    def testReadOnly(self):
+        r = self.open('r')
         def stmt():
-            self.shelf[5] = "a"
-        self.assertRaises(TypeError, stmt)
+            r['b'] = 2
+        self.assertRaises(IOError, stmt)
+        self.assertRaises(IOError, r.compact)
 
-    #######################
+    ########################
 
-    def testDelKey(self):
-        del self.shelf['2']
-        self.assertRaises(KeyError, lambda: self.shelf['2'])
+    def testSnapshot(self):
+        r = self.open('r')
+        self.writer['b'] = 2
+        del self.writer['a']
+        self.assertEqual(2, self.writer['b'])
+        self.failIf(self.writer.has_key('a'))
+        self.assertEqual(['b'], self.writer.keys())
+        self.assertEqual(1, r['a'])
+        self.failIf(r.has_key('b'))
+
+        # the commit waits for the reader to move to a new snapshot
+        committer = threading.Thread(target = self.writer.flush)
+        committer.start()
+        time.sleep(0.1)
+        self.failUnless(committer.isAlive())
+        r.refresh()
+        committer.join()
+        self.assertEqual(2, r['b'])
+        self.failIf(r.has_key('a'))
 
-    #######################
+    ########################
 
-    def testDelNonexistantKey(self):
+    def testCommitThreshold(self):
+        self.writer.maxPending = 2
+        self.writer['b'] = 2
+        self.assertEqual(1, len(self.writer.pending))
+        self.writer['c'] = 3
+        self.assertEqual(0, len(self.writer.pending))
+        r = self.open('r')
+        self.assertEqual(3, r['c'])
+        self.assertEqual(3, len(r))
+
+
+###################################################
+
+class IterationTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.shelf = PytableShelf('iter.h5', garbageRatio = 1.,
+                                  nativeArrays = True)
+        for i in range(7):
+            self.shelf[str(i)] = [i]
+        self.shelf['3'] = 'three'
+        del self.shelf['5']
+        self.shelf['arr'] = numpy.arange(4)
+
+    ########################
+
+    def tearDown(self):
+
+        self.shelf.close()
+        os.remove('iter.h5')
+
+    ########################
+
+    def testIterKeys(self):
+        expected = ['0', '1', '2', '4', '6', '3', 'arr']
+        self.assertEqual(expected, list(self.shelf.iterkeys(chunkRows = 2)))
+        self.assertEqual(expected, list(self.shelf))
+        self.assertEqual(expected, self.shelf.keys())
+
+    ########################
+
+    def testIterItems(self):
+        items = list(self.shelf.iteritems(chunkRows = 3))
+        self.assertEqual(('1', [1]), items[1])
+        self.assertEqual(('3', 'three'), items[5])
+        self.assertEqual('arr', items[6][0])
+        self.failUnless(numpy.all(numpy.arange(4) == items[6][1][:]))
+        self.assertEqual([[0], [1], [2], [4], [6], 'three'],
+                         list(self.shelf.itervalues())[:-1])
+
+    ########################
+
+    def testWritesDuringIteration(self):
+        keys = []
+        for key in self.shelf.iterkeys(chunkRows = 2):
+            keys.append(key)
+            self.shelf[key] = 'new'
+        self.assertEqual(self.shelf.keys(), keys)
+
+    ########################
+
+    def testBufferedWrites(self):
+        with self.shelf.batch():
+            self.shelf['1'] = 'one'
+            del self.shelf['2']
+            self.shelf['new'] = [7]
+            nrows = len(self.shelf.fileKeys)
+            self.assertEqual(self.shelf.keys(), list(self.shelf))
+            items = dict(self.shelf.iteritems(chunkRows = 2))
+            self.assertEqual(3, len(self.shelf.pending))
+            self.assertEqual(nrows, len(self.shelf.fileKeys))
+        self.assertEqual('one', items['1'])
+        self.assertEqual([7], items['new'])
+        self.failIf('2' in items)
+        self.assertEqual(sorted(self.shelf.keys()), sorted(items.keys()))
+
+    ########################
+
+    def testGarbageDuringIteration(self):
+        self.shelf.close()
+        os.remove('iter.h5')
+        self.shelf = PytableShelf('iter.h5', garbageRatio = 0.5)
+        self.shelf.update([(str(i), i) for i in range(200)])
+        seen = 0
+        for (key, val) in self.shelf.iteritems(chunkRows = 10):
+            self.shelf[key] = val + 1
+            self.shelf[key] = val + 2
+            seen += 1
+        self.assertEqual(200, seen)
+        self.failUnless(self.shelf.garbage() > 0.5)
+        self.assertEqual(0, self.shelf.iterating)
+        # the next write compacts
+        self.shelf['0'] = 0
+        self.assertEqual(0., self.shelf.garbage())
+        self.assertEqual(range(1, 200), [self.shelf[str(i)] - 2
+                                         for i in range(1, 200)])
+
+    ########################
+
+    def testCompactionDuringIteration(self):
         def stmt():
-            del self.shelf['10']
-        self.assertRaises(KeyError, stmt)
+            for key in self.shelf.iterkeys(chunkRows = 2):
+                self.shelf.compact()
+        self.assertRaises(RuntimeError, stmt)
+
+
+###################################################
+
+class FiltersTestCase(unittest.TestCase):
+
+    def tearDown(self):
+
+        self.shelf.close()
+        os.remove('filters.h5')
 
     ########################
 
-    def testKeys(self):
-        self.assertEqual(['1','2','list'], self.shelf.keys())
-    
+    def testComplib(self):
+        self.shelf = PytableShelf('filters.h5', compression = 3,
+                                  complib = 'bzip2', shuffle = False)
+        self.shelf['list'] = range(100)
+        self.assertEqual('bzip2', self.shelf.fileVals.filters.complib)
+        self.assertEqual(3, self.shelf.fileVals.filters.complevel)
+        self.failIf(self.shelf.fileVals.filters.shuffle)
+        self.assertEqual(range(100), self.shelf['list'])
+
     ########################
 
-    def testHasKey(self):
-        self.failUnless(self.shelf.has_key('2'))
-        self.failIf(self.shelf.has_key('fake'))
+    def testArrayFilters(self):
+        self.shelf = PytableShelf('filters.h5', nativeArrays = True,
+                                  arrayFilters = tables.Filters(complevel = 9,
+                                                                complib = 'bzip2'))
+        self.shelf['arr'] = numpy.arange(1000.)
+        node = self.shelf._arrayNode(0)
+        self.assertEqual('bzip2', node.filters.complib)
+        self.assertEqual('zlib', self.shelf.fileVals.filters.complib)
+
+        self.shelf.arrayFilter = tables.Filters(complevel = 1)
+        self.shelf['other'] = 1
+        del self.shelf['other']
+        self.failIf(self.shelf.compact() is None)
+        node = self.shelf._arrayNode(0)
+        self.assertEqual('zlib', node.filters.complib)
+        self.assertEqual(1, node.filters.complevel)
+        self.failUnless(numpy.all(numpy.arange(1000.) == self.shelf['arr'][:]))
+
+
+###################################################
+
+class ShardedShelfTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.shelf = ShardedShelf('sharded', nshards = 4)
+        self.items = dict([(str(i), [i]) for i in range(40)])
+        self.shelf.setmany(self.items)
 
     ########################
 
-    def testWriteOut(self):
-        self.shelf['add'] = MyObj('add')
-        self.shelf['2'] = MyObj('~2')
-        del self.shelf['1']
+    def tearDown(self):
+
         self.shelf.close()
-        self.shelf = PytableShelf('test.h5')
-        
-        self.assertEqual(MyObj('add'), self.shelf['add'])
-        self.assertEqual(MyObj('~2'), self.shelf['2'])
-        self.assertRaises(KeyError, lambda: self.shelf['1'])
-        self.assertEqual([1,2,3], self.shelf['list'])
-        
-        
+        for name in os.listdir('sharded'):
+            os.remove(os.path.join('sharded', name))
+        os.rmdir('sharded')
+
+    ########################
+
+    def testDictOps(self):
+        self.assertEqual([7], self.shelf['7'])
+        self.shelf['7'] = 'seven'
+        self.assertEqual('seven', self.shelf['7'])
+        del self.shelf['8']
+        self.failIf(self.shelf.has_key('8'))
+        self.assertRaises(KeyError, lambda: self.shelf['8'])
+        self.assertEqual(39, len(self.shelf))
+        self.assertEqual([[1], 'seven'], self.shelf.getmany(['1', '7']))
+
+    ########################
+
+    def testPartitioned(self):
+        self.assertEqual(sorted(self.items.keys()), sorted(self.shelf.keys()))
+        for i in range(4):
+            for key in self.shelf.shard(i).keys():
+                self.assertEqual(i, self.shelf.shardIndex(key))
+            self.failUnless(0 < len(self.shelf.shard(i)) < 40)
+
+    ########################
+
+    def testIterItems(self):
+        self.assertEqual(sorted(self.items.items()),
+                         sorted(self.shelf.iteritems(chunkRows = 3)))
+        self.assertEqual(sorted(self.items.keys()), sorted(self.shelf))
+
+    ########################
+
+    def testReopen(self):
+        self.shelf.close()
+        self.assertRaises(ValueError, lambda: ShardedShelf('sharded', 5))
+        self.shelf = ShardedShelf('sharded')
+        self.assertEqual(4, self.shelf.nshards)
+        self.assertEqual(40, len(self.shelf))
+
+    ########################
+
+    def testReadOnlySparse(self):
+        self.shelf.close()
+        self.shelf = ShardedShelf('sharded', nshards = 4, mode = 'r')
+        self.assertEqual(40, len(self.shelf))
+
+        # a directory where only some shards were ever written
+        sparse = ShardedShelf('sparse', nshards = 8)
+        try:
+            sparse['3'] = 3
+            sparse.close()
+            missing = [i for i in range(8)
+                       if not os.path.exists(_shardFilename('sparse', i))]
+            self.assertEqual(7, len(missing))
+
+            reader = ShardedShelf('sparse', mode = 'r')
+            self.assertEqual(1, len(reader))
+            self.assertEqual(['3'], reader.keys())
+            self.assertEqual([('3', 3)], list(reader.iteritems()))
+            self.assertEqual(3, reader['3'])
+            self.failIf(reader.has_key('4'))
+            self.assertRaises(KeyError, lambda: reader['4'])
+            self.assertRaises(KeyError, lambda: reader.getmany(['3', '4']))
+            def stmt():
+                reader['4'] = 4
+            self.assertRaises(IOError, stmt)
+            reader.close()
+
+            # nor do reads or failed deletes in write mode create shards
+            writer = ShardedShelf('sparse')
+            self.assertEqual(1, len(writer))
+            self.assertEqual(['3'], list(writer))
+            self.failIf('4' in writer)
+            def remove():
+                del writer['4']
+            self.assertRaises(KeyError, remove)
+            self.assertEqual(7, len([i for i in range(8) if not
+                                     os.path.exists(_shardFilename('sparse',
+                                                                   i))]))
+            writer['4'] = 4
+            self.assertEqual(6, len([i for i in range(8) if not
+                                     os.path.exists(_shardFilename('sparse',
+                                                                   i))]))
+            del writer['4']
+            writer.close()
+        finally:
+            for name in os.listdir('sparse'):
+                os.remove(os.path.join('sparse', name))
+            os.rmdir('sparse')
+
+    ########################
+
+    def testOpenShard(self):
+        key = '12'
+        i = self.shelf.shardIndex(key)
+        self.shelf.close()
+        shard = openShard('sharded', i)
+        try:
+            self.assertEqual([12], shard[key])
+        finally:
+            shard.close()
+
+
+########################
+
+class SpillStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        # room for two of the 8000 byte arrays
+        self.storage = SpillStorage(memoryBytes = 20000, minSpillBytes = 4000,
+                                    directory = '.')
+        self.arrays = dict([('a%d' % i, numpy.arange(1000.) + i)
+                            for i in range(4)])
+
+    ########################
+
+    def tearDown(self):
+
+        self.storage.close()
+
+    ########################
+
+    def testSpillAndReload(self):
+        for i in range(4):
+            self.storage['a%d' % i] = self.arrays['a%d' % i]
+        self.storage['small'] = 'x'
+        self.failUnless(self.storage.isSpilled('a0'))
+        self.failUnless(self.storage.isSpilled('a1'))
+        self.failIf(self.storage.isSpilled('a3'))
+        self.failIf(self.storage.isSpilled('small'))
+        self.failUnless(self.storage.nbytes <= 20000)
+
+        a0 = self.storage['a0']
+        self.failUnless(isinstance(a0, numpy.ndarray))
+        self.failUnless((self.arrays['a0'] == a0).all())
+        self.failIf(self.storage.isSpilled('a0'))
+        self.failUnless(self.storage.isSpilled('a2'))
+
+        self.assertEqual(sorted(self.arrays.keys() + ['small']),
+                         sorted(self.storage.keys()))
+        self.assertEqual(5, len(self.storage))
+        for (key, val) in self.arrays.iteritems():
+            self.failUnless((val == self.storage[key]).all())
+
+    ########################
+
+    def testOverwriteAndDelete(self):
+        for i in range(4):
+            self.storage['a%d' % i] = self.arrays['a%d' % i]
+        self.storage['a0'] = 'replaced'
+        self.assertEqual('replaced', self.storage['a0'])
+        del self.storage['a1']
+        self.failIf('a1' in self.storage)
+        self.assertRaises(KeyError, lambda: self.storage['a1'])
+        def remove():
+            del self.storage['a1']
+        self.assertRaises(KeyError, remove)
+        self.assertEqual(3, len(self.storage))
+
+    ########################
+
+    def testOversizedValue(self):
+        big = numpy.zeros(10000)
+        self.storage['big'] = big
+        self.failIf(self.storage.isSpilled('big'))
+        self.storage['other'] = numpy.ones(1000)
+        self.failUnless(self.storage.isSpilled('big'))
+        self.failUnless((big == self.storage['big']).all())
+
+    ########################
+
+    def testKeys(self):
+        self.storage[u'a\xe9'] = self.arrays['a0']
+        self.storage[u'a1'] = self.arrays['a1']
+        self.storage['a2'] = self.arrays['a2']
+        self.failUnless(self.storage.isSpilled(u'a\xe9'))
+        self.failUnless((self.arrays['a0'] == self.storage[u'a\xe9']).all())
+        self.failUnless(self.storage.isSpilled('a1'))
+        self.failUnless((self.arrays['a1'] == self.storage['a1']).all())
+        def store():
+            self.storage[(1, 2)] = 'x'
+        self.assertRaises(TypeError, store)
+
+    ########################
+
+    def testSmallValuesOverBudget(self):
+        self.storage['a0'] = self.arrays['a0']
+        for i in range(30):
+            self.storage['small%d' % i] = 'x' * 1000
+        # only the large value could go
+        self.failUnless(self.storage.isSpilled('a0'))
+        self.assertEqual(30000, self.storage.nbytes)
+        self.assertEqual(0, len(self.storage.spillable))
+        self.storage['a1'] = self.arrays['a1']
+        self.assertEqual(['a1'], self.storage.spillable.keys())
+        self.failIf(self.storage.isSpilled('a1'))
+
+    ########################
+
+    def testClose(self):
+        for i in range(4):
+            self.storage['a%d' % i] = self.arrays['a%d' % i]
+        filename = self.storage.filename
+        self.failUnless(os.path.exists(filename))
+        self.storage.close()
+        self.failIf(os.path.exists(filename))
 
 
 ################################################
@@ -448,6 +3010,17 @@ if __name__ == "__main__":
     suites = []
     suites.append(unittest.TestLoader().loadTestsFromTestCase(FileStructTestCase))
     suites.append(unittest.TestLoader().loadTestsFromTestCase(DictOpsTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(IndexTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(LogStructureTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(CompactionTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(NativeArrayTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(BulkOpsTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(CacheTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(LockingTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(IterationTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(FiltersTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(ShardedShelfTestCase))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(SpillStorageTestCase))
     unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(suites))
         
 
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+############################
+# @file shelfbench.py
+#
+# @brief Measures PytableShelf write/read speed and compression ratio for
+# a range of compressor settings, on catalog-like payloads
+#############################
+
+import cPickle
+import os
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+
+import numpy
+import tables
+
+import pytableshelf
+
+####################################
+
+def parse_args():
+
+    usage = '''\n
+NAME
+        shelfbench.py
+
+PURPOSE
+        Benchmarks PytableShelf compressor settings on representative
+        catalog payloads: float columns (positions, shapes, magnitudes),
+        integer id columns, and pickled per-object records.
+
+USAGE
+        shelfbench.py [options]
+
+        ******Use -h for list of options******
+
+OUTPUTS
+        One line per payload and setting (STDOUT):
+        payload complib:level:shuffle  write MB/s  read MB/s  ratio
+
+        MB/s are of uncompressed payload; ratio is payload bytes divided
+        by the size of the shelf file.
+
+REVISION HISTORY:
+  2026-10-18 Started
+
+\n'''
+    parser = OptionParser(usage = usage)
+    parser.add_option("-n", "--nobjects", dest="nobjects", type="int",
+                      help="Objects per catalog column", default=100000)
+    parser.add_option("-k", "--nkeys", dest="nkeys", type="int",
+                      help="Number of entries written per payload",
+                      default=20)
+    parser.add_option("-l", "--complibs", dest="complibs",
+                      default="zlib,lzo,bzip2,blosc",
+                      help="Comma separated compressors to try")
+    parser.add_option("-c", "--levels", dest="levels", default="1,5,9",
+                      help="Comma separated compression levels to try")
+    parser.add_option("-s", "--noshuffle", dest="shuffle",
+                      action="store_false", default=True,
+                      help="Turn the shuffle filter off")
+    parser.add_option("-p", "--payloads", dest="payloads",
+                      default="floats,ids,records",
+                      help="Comma separated payloads to try")
+    parser.add_option("-o", "--object", dest="native",
+                      action="store_false", default=True,
+                      help="Pickle arrays instead of storing them natively")
+    parser.add_option("-d", "--dir", dest="dir", default=None,
+                      help="Directory for scratch files")
+
+    (options, args) = parser.parse_args()
+
+    options.complibs = options.complibs.split(',')
+    options.levels = [int(x) for x in options.levels.split(',')]
+    options.payloads = options.payloads.split(',')
+    for payload in options.payloads:
+        if payload not in payloads:
+            parser.error("Unknown payload: %s" % payload)
+
+    return options
+
+###################################
+
+def floatColumn(nobjects, seed):
+    '''A smooth float column plus noise, like positions or ellipticities.'''
+    rand = numpy.random.RandomState(seed)
+    base = numpy.linspace(0., 5000., nobjects)
+    return base + rand.normal(scale = 0.3, size = nobjects)
+
+def idColumn(nobjects, seed):
+    '''Mostly increasing object ids, as a catalog sorted by id has.'''
+    rand = numpy.random.RandomState(seed)
+    return numpy.cumsum(rand.randint(1, 5, size = nobjects)).astype(numpy.int64)
+
+def records(nobjects, seed):
+    '''Per-object dicts, as intermediate pipeline results often are.'''
+    rand = numpy.random.RandomState(seed)
+    n = max(1, nobjects / 100)
+    return [{'id' : i, 'mag' : float(rand.normal(22., 1.)),
+             'flags' : int(rand.randint(0, 8)), 'note' : 'obj%d' % i}
+            for i in range(n)]
+
+payloads = {'floats' : floatColumn,
+            'ids' : idColumn,
+            'records' : records}
+
+###################################
+
+def payloadBytes(val):
+
+    if isinstance(val, numpy.ndarray):
+        return val.nbytes
+    return len(cPickle.dumps(val, cPickle.HIGHEST_PROTOCOL))
+
+###################################
+
+def available(complib):
+
+    (library, codec) = (complib.split(':') + [None])[:2]
+    try:
+        if tables.whichLibVersion(library) is None:
+            return False
+    except ValueError:
+        return False
+    if codec is None:
+        return True
+    # blosc sub-codecs depend on how blosc was built, and PyTables
+    # versions without blosc_compressor_list have none
+    if library != 'blosc' or not hasattr(tables, 'blosc_compressor_list'):
+        return False
+    return codec in tables.blosc_compressor_list()
+
+###################################
+
+def readAll(val):
+
+    if isinstance(val, pytableshelf.ArrayProxy):
+        return val.read()
+    return val
+
+###################################
+
+def runOne(filename, payload, complib, level, shuffle, native,
+           nobjects, nkeys):
+    '''Returns (write MB/s, read MB/s, compression ratio).'''
+
+    vals = [payloads[payload](nobjects, seed) for seed in range(nkeys)]
+    nbytes = sum([payloadBytes(val) for val in vals])
+
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    start = time.time()
+    shelf = pytableshelf.PytableShelf(filename, compression = level,
+                                      complib = complib, shuffle = shuffle,
+                                      nativeArrays = native)
+    for (i, val) in enumerate(vals):
+        shelf['%s%d' % (payload, i)] = val
+    shelf.close()
+    writeTime = time.time() - start
+
+    filesize = os.path.getsize(filename)
+
+    start = time.time()
+    shelf = pytableshelf.PytableShelf(filename, mode = 'r')
+    for (key, val) in shelf.iteritems():
+        readAll(val)
+    shelf.close()
+    readTime = time.time() - start
+
+    megabytes = nbytes / 2.**20
+    return (megabytes / writeTime, megabytes / readTime,
+            float(nbytes) / filesize)
+
+###################################
+
+def main():
+
+    options = parse_args()
+
+    scratch = tempfile.mkdtemp(dir = options.dir)
+    filename = os.path.join(scratch, 'bench.h5')
+    try:
+        print '#payload setting write_MB/s read_MB/s ratio'
+        for payload in options.payloads:
+            for complib in options.complibs:
+                if not available(complib):
+                    print '# %s not available, skipped' % complib
+                    continue
+                for level in options.levels:
+                    result = runOne(filename, payload, complib, level,
+                                    options.shuffle, options.native,
+                                    options.nobjects, options.nkeys)
+                    setting = '%s:%d:%d' % (complib, level, options.shuffle)
+                    print '%s %s %.1f %.1f %.2f' % \
+                        ((payload, setting) + result)
+    finally:
+        shutil.rmtree(scratch)
+
+#####################################
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+############################
+# @file stagecache.py
+#
+# @brief Lists, trims or purges a pipeline StageCache directory
+#############################
+
+import time
+from optparse import OptionParser
+
+import pipeline
+
+####################################
+
+def parse_args():
+
+    usage = '''\n
+NAME
+        stagecache.py
+
+PURPOSE
+        Inspects the cache of savepoint outputs that pipelines write when
+        run with cache=<directory>, and removes entries from it.
+
+USAGE
+        stagecache.py [options] cachedir
+
+        ******Use -h for list of options******
+
+OUTPUTS
+        With no options, one line per entry (STDOUT), most recently used
+        first:
+        key stage kB created last_used
+
+        followed by the total size. --purge and --trim report the number
+        of entries removed.
+
+REVISION HISTORY:
+  2026-10-18 Started
+
+\n'''
+    parser = OptionParser(usage = usage)
+    parser.add_option("-p", "--purge", dest="purge", action="store_true",
+                      default=False,
+                      help="Remove all entries (or those of --stage)")
+    parser.add_option("-s", "--stage", dest="stage", default=None,
+                      help="Only list or purge entries of this stage")
+    parser.add_option("-t", "--trim", dest="trim", type="float",
+                      default=None,
+                      help="Remove least recently used entries until the "
+                      "cache fits in this many MB")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("Give exactly one cache directory")
+    options.directory = args[0]
+
+    return options
+
+###################################
+
+def formatTime(seconds):
+
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(seconds))
+
+###################################
+
+def main():
+
+    options = parse_args()
+    cache = pipeline.StageCache(options.directory, maxBytes = None)
+
+    if options.purge:
+        print '%d entries removed' % len(cache.purge(options.stage))
+        return
+
+    if options.trim is not None:
+        removed = cache.evict(int(options.trim * 2**20))
+        print '%d entries removed' % len(removed)
+        return
+
+    total = 0
+    for (key, stage, nbytes, created, used) in cache.entries():
+        if options.stage is not None and stage != options.stage:
+            continue
+        total += nbytes
+        print '%s %s %.1f %s %s' % (key, stage, nbytes / 1024.,
+                                    formatTime(created), formatTime(used))
+    print '# total %.1f MB' % (total / 2.**20)
+
+#####################################
+
+if __name__ == "__main__":
+    main()